@@ -0,0 +1,266 @@
+# admission.py
+# Admission control for the expensive endpoints (scan analysis and comparison)
+#
+# At most ANALYSIS_CONCURRENCY requests run at once per process. The rest wait
+# in bounded queues, one per priority class; a freed slot goes to the most
+# urgent class first and, within a class, to the earliest deadline. Requests
+# are refused immediately (429/503 with Retry-After) when their client already
+# has too many requests in flight, their queue is full, or they could not
+# finish before their deadline; a queued request whose deadline becomes
+# unreachable is dropped instead of being run late.
+#
+# All limits are per worker process: with N gunicorn workers the server runs up
+# to N * ANALYSIS_CONCURRENCY requests and a client may have N * CLIENT_MAX_IN_FLIGHT
+# in flight. A slot count at or above a gthread worker's thread count would never
+# queue anything (the request threads run out first), so it is kept below it.
+
+import os
+import math
+import time
+import heapq
+import logging
+import itertools
+import threading
+from collections import deque
+from contextlib import contextmanager
+from typing import Dict, Any, Optional
+import numpy as np
+
+# Configure logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Configuration
+ADMISSION_ENABLED = os.environ.get('ADMISSION_CONTROL', '1') != '0'
+# Request threads per worker, as configured in gunicorn.conf.py (a sync worker has one)
+WORKER_CLASS = os.environ.get('MEDVISOR_WORKER_CLASS', 'gthread')
+WORKER_THREADS = 1 if WORKER_CLASS == 'sync' else int(os.environ.get('MEDVISOR_THREADS', 4))
+# Requests running at once per process; one thread is left for the cheap endpoints
+ANALYSIS_CONCURRENCY = int(os.environ.get('ANALYSIS_CONCURRENCY', max(1, WORKER_THREADS - 1)))
+CLIENT_MAX_IN_FLIGHT = int(os.environ.get('CLIENT_MAX_IN_FLIGHT', 4))  # Running + queued per client
+# Priority classes, most urgent first: (queue limit, default deadline in seconds)
+PRIORITY_CLASSES = {
+    "stat": (int(os.environ.get('ADMISSION_QUEUE_STAT', 32)), 120.0),
+    "urgent": (int(os.environ.get('ADMISSION_QUEUE_URGENT', 16)), 300.0),
+    "routine": (int(os.environ.get('ADMISSION_QUEUE_ROUTINE', 8)), 600.0)
+}
+DEFAULT_PRIORITY = "routine"
+SERVICE_TIME_ALPHA = 0.2  # Weight of the newest sample in the service time average
+INITIAL_SERVICE_TIME = 10.0  # Seconds assumed before any request has finished
+WAIT_SAMPLES = 1000  # Recent queue waits kept per class for percentiles
+
+if WORKER_CLASS == 'gthread' and ANALYSIS_CONCURRENCY >= WORKER_THREADS > 1:
+    logger.warning(f"ANALYSIS_CONCURRENCY={ANALYSIS_CONCURRENCY} is not below the {WORKER_THREADS} request threads "
+                   f"per worker, so requests would never queue; using {WORKER_THREADS - 1}")
+    ANALYSIS_CONCURRENCY = WORKER_THREADS - 1
+
+
+class AdmissionRejected(Exception):
+    """The request was not admitted; status is 429 (client limit) or 503 (overload)"""
+
+    def __init__(self, message: str, status: int, retry_after: float, reason: str):
+        super().__init__(message)
+        self.status = status
+        self.retry_after = max(1, math.ceil(retry_after))
+        self.reason = reason
+
+
+class Ticket:
+    """A request waiting for, or holding, a slot"""
+
+    def __init__(self, operation: str, priority: str, client_id: str, deadline: float):
+        self.operation = operation
+        self.priority = priority
+        self.client_id = client_id
+        self.deadline = deadline  # time.monotonic() value
+        self.enqueued_at = time.monotonic()
+        self.granted = threading.Event()
+        self.cancelled = False
+
+    def remaining(self) -> float:
+        """Seconds left until the deadline"""
+        return self.deadline - time.monotonic()
+
+
+class AdmissionController:
+    """Priority queues with earliest-deadline-first dispatch in front of a fixed number of slots"""
+
+    def __init__(self, concurrency: int = ANALYSIS_CONCURRENCY, client_max_in_flight: int = CLIENT_MAX_IN_FLIGHT,
+                 classes: Dict[str, tuple] = PRIORITY_CLASSES):
+        self.concurrency = concurrency
+        self.client_max_in_flight = client_max_in_flight
+        self.classes = classes
+        self._lock = threading.Lock()
+        self._running = 0
+        self._queues: Dict[str, list] = {priority: [] for priority in classes}  # Heaps of (deadline, seq, ticket)
+        self._sequence = itertools.count()
+        self._client_in_flight: Dict[str, int] = {}
+        self._service_time: Dict[str, float] = {}  # Moving average per operation
+        self._waits: Dict[str, deque] = {priority: deque(maxlen=WAIT_SAMPLES) for priority in classes}
+        self._counters: Dict[str, Dict[str, int]] = {
+            priority: {"admitted": 0, "rejected_client_limit": 0, "rejected_queue_full": 0,
+                       "rejected_deadline": 0, "dropped_deadline": 0}
+            for priority in classes
+        }
+
+    def parse_priority(self, value: Optional[str]) -> str:
+        """Priority class from a request field; raises ValueError for unknown classes"""
+        if value is not None and not isinstance(value, str):
+            raise ValueError(f"Invalid priority {value!r}. Allowed: {', '.join(self.classes)}")
+        priority = (value or DEFAULT_PRIORITY).strip().lower()
+        if priority not in self.classes:
+            raise ValueError(f"Invalid priority '{value}'. Allowed: {', '.join(self.classes)}")
+        return priority
+
+    def default_timeout(self, priority: str) -> float:
+        return self.classes[priority][1]
+
+    def _expected_service(self, operation: str) -> float:
+        return self._service_time.get(operation, INITIAL_SERVICE_TIME)
+
+    def _prune(self):
+        """Remove tickets that timed out while queued (caller holds the lock)"""
+        for priority, queue in self._queues.items():
+            if any(ticket.cancelled for _d, _s, ticket in queue):
+                self._queues[priority] = [entry for entry in queue if not entry[2].cancelled]
+                heapq.heapify(self._queues[priority])
+
+    def _queued_ahead(self, priority: str) -> int:
+        """Requests that would be dispatched before a new request of this class"""
+        ahead = 0
+        for name in self.classes:
+            ahead += len(self._queues[name])
+            if name == priority:
+                break
+        return ahead
+
+    def _estimated_wait(self, priority: str, operation: str) -> float:
+        if self._running < self.concurrency and not self._queued_ahead(priority):
+            return 0.0
+        rounds = (self._queued_ahead(priority) + 1) / self.concurrency
+        return rounds * self._expected_service(operation)
+
+    def _reject(self, ticket: Ticket, reason: str, message: str, status: int, retry_after: float):
+        self._counters[ticket.priority][reason] += 1
+        raise AdmissionRejected(message, status, retry_after, reason)
+
+    def _dispatch(self):
+        """Hand free slots to waiting tickets (caller holds the lock)"""
+        while self._running < self.concurrency:
+            ticket = None
+            for priority in self.classes:
+                queue = self._queues[priority]
+                while queue:
+                    _deadline, _seq, candidate = heapq.heappop(queue)
+                    if candidate.cancelled:
+                        continue
+                    if candidate.remaining() < self._expected_service(candidate.operation):
+                        # Would finish after its deadline; drop it rather than run it late
+                        candidate.cancelled = True
+                        self._counters[candidate.priority]["dropped_deadline"] += 1
+                        candidate.granted.set()
+                        continue
+                    ticket = candidate
+                    break
+                if ticket:
+                    break
+            if ticket is None:
+                return
+            self._running += 1
+            ticket.granted.set()
+
+    def acquire(self, operation: str, priority: str, client_id: str, timeout: Optional[float] = None) -> Ticket:
+        """
+        Wait for a slot; raises AdmissionRejected if the request is refused or dropped
+
+        timeout is the request's deadline in seconds from now (default: its class's).
+        """
+        timeout = self.default_timeout(priority) if timeout is None else timeout
+        ticket = Ticket(operation, priority, client_id, time.monotonic() + timeout)
+
+        with self._lock:
+            self._prune()
+            if self._client_in_flight.get(client_id, 0) >= self.client_max_in_flight:
+                self._reject(ticket, "rejected_client_limit",
+                             f"Too many concurrent requests from this client (limit {self.client_max_in_flight})",
+                             429, self._expected_service(operation))
+            estimated_wait = self._estimated_wait(priority, operation)
+            if estimated_wait + self._expected_service(operation) > timeout:
+                self._reject(ticket, "rejected_deadline",
+                             f"Cannot finish within {timeout:g} seconds (expected wait {estimated_wait:.1f}s, "
+                             f"run time {self._expected_service(operation):.1f}s)",
+                             503, estimated_wait)
+            if self._running >= self.concurrency or self._queued_ahead(priority):
+                if len(self._queues[priority]) >= self.classes[priority][0]:
+                    self._reject(ticket, "rejected_queue_full",
+                                 f"Too many {priority} requests are waiting", 503, estimated_wait)
+                heapq.heappush(self._queues[priority], (ticket.deadline, next(self._sequence), ticket))
+            else:
+                self._running += 1
+                ticket.granted.set()
+            self._client_in_flight[client_id] = self._client_in_flight.get(client_id, 0) + 1
+
+        ticket.granted.wait(max(0.0, ticket.remaining()))
+        with self._lock:
+            if not ticket.granted.is_set() or ticket.cancelled:
+                # Deadline passed in the queue, or the dispatcher dropped the ticket
+                if not ticket.cancelled:
+                    ticket.cancelled = True
+                    self._counters[priority]["dropped_deadline"] += 1
+                self._client_in_flight[client_id] -= 1
+                if not self._client_in_flight[client_id]:
+                    del self._client_in_flight[client_id]
+                raise AdmissionRejected(f"Request could not be started within its {timeout:g} second deadline",
+                                        503, self._expected_service(operation), "dropped_deadline")
+            self._waits[priority].append(time.monotonic() - ticket.enqueued_at)
+            self._counters[priority]["admitted"] += 1
+        return ticket
+
+    def release(self, ticket: Ticket, service_time: Optional[float] = None):
+        with self._lock:
+            self._running -= 1
+            self._client_in_flight[ticket.client_id] -= 1
+            if not self._client_in_flight[ticket.client_id]:
+                del self._client_in_flight[ticket.client_id]
+            if service_time is not None:
+                previous = self._service_time.get(ticket.operation)
+                self._service_time[ticket.operation] = service_time if previous is None else (
+                    SERVICE_TIME_ALPHA * service_time + (1 - SERVICE_TIME_ALPHA) * previous
+                )
+            self._dispatch()
+
+    @contextmanager
+    def admit(self, operation: str, priority: str, client_id: str, timeout: Optional[float] = None):
+        """Run the body in an admission slot: `with controller.admit(...) as ticket:`"""
+        ticket = self.acquire(operation, priority, client_id, timeout)
+        started = time.monotonic()
+        succeeded = False
+        try:
+            yield ticket
+            succeeded = True
+        finally:
+            # Failed calls often fail fast, so only completed ones update the service time
+            self.release(ticket, time.monotonic() - started if succeeded else None)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            classes = {}
+            for priority in self.classes:
+                waits = np.asarray(self._waits[priority]) * 1000
+                classes[priority] = {
+                    "queued": sum(1 for _d, _s, ticket in self._queues[priority] if not ticket.cancelled),
+                    "queue_limit": self.classes[priority][0],
+                    **self._counters[priority],
+                    "wait_ms": {
+                        "p50": round(float(np.percentile(waits, 50)), 1),
+                        "p95": round(float(np.percentile(waits, 95)), 1),
+                        "max": round(float(waits.max()), 1)
+                    } if len(waits) else None
+                }
+            return {
+                "concurrency": self.concurrency,
+                "running": self._running,
+                "clients_in_flight": len(self._client_in_flight),
+                "service_time_s": {operation: round(value, 3) for operation, value in self._service_time.items()},
+                "classes": classes
+            }
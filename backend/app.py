@@ -1,14 +1,74 @@
 # main.py
 import os
-from flask import Flask, request, jsonify
+import math
+import time
+from flask import Flask, request, jsonify, Response, send_file
 import logging
 from report_scan import (
     process_scan, 
     check_health, 
+    init_groq_client,
+    model_caller,
     allowed_file,
     UPLOAD_FOLDER
 )
-from compare import compare_medical_documents, allowed_file
+from compare import (
+    compare_medical_documents,
+    compare_artifact_series,
+    compare_sentences,
+    allowed_file as allowed_document_file,
+    vectorize_document,
+    vectorize_documents,
+    EMBEDDING_DIM
+)
+from similar_cases import (
+    VectorIndex,
+    report_document_text,
+    start_index_sync,
+    SIMILAR_INDEX_DIR
+)
+from compare_pool import create_compare_pool, PoolSaturatedError, CompareTimeoutError, CompareWorkerError
+from longitudinal import (
+    attach_longitudinal_delta,
+    ensure_artifacts_many,
+    load_reports_for_comparison,
+    LONGITUDINAL_TRACKING_ENABLED,
+    MAX_COMPARE_REPORTS,
+    MAX_TRAJECTORY_POINTS
+)
+from report_queries import (
+    ensure_indexes_async,
+    find_report_page,
+    build_listing_projection,
+    build_export_query,
+    iter_export,
+    decode_cursor,
+    parse_listing_sort,
+    CountCache,
+    DEFAULT_SORT,
+    MAX_PAGE_SIZE
+)
+from persistence import create_report_writer, WriteQueueFullError
+from report_stats import (
+    ensure_summary_indexes_async,
+    record_reports,
+    rebuild_summaries,
+    schedule_rebuild,
+    list_patients,
+    anomaly_rate,
+    scan_type_distribution,
+    REPORT_SUMMARIES_ENABLED,
+    MAX_PATIENT_PAGE_SIZE
+)
+from scan_store import ScanStore, SCAN_STORE_DIR
+from uploads import ChunkedUploads, UploadError, UploadNotFoundError, UploadConflictError
+from mesh import MeshService, MeshError
+from slices import SliceServer, SliceError, SLICE_FORMATS
+from admission import AdmissionController, AdmissionRejected, ADMISSION_ENABLED
+from report_condense import condensing_stats
+from model_calls import call_deadline, DeadlineExceeded
+from profiling import init_profiling, stage, slow_requests
+from contextlib import nullcontext, contextmanager
 from flask_cors import CORS
 from pymongo import MongoClient
 from datetime import datetime
@@ -20,30 +80,252 @@ logger = logging.getLogger(__name__)
 
 app = Flask(__name__)
 CORS(app)
+init_profiling(app)
 # Configuration
 app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
 app.config['MAX_CONTENT_LENGTH'] = 32 * 1024 * 1024  # 32MB max upload
 
-# MongoDB connection setup
-try:
-    mongo_client = MongoClient("mongodb://localhost:27017/")
-    db = mongo_client["mediscan_db"]
-    patient_reports = db["patient_reports"]
-    logging.info("Connected to MongoDB")
-except Exception as e:
-    logging.error(f"Failed to connect to MongoDB: {e}")
-    mongo_client = None
-    db = None
+# Set by gunicorn.conf.py: the app is imported once in the master process and forked,
+# so connections, threads and pools are only created in each worker (see init_worker)
+PRELOAD_MODE = os.environ.get('MEDVISOR_PRELOAD') == '1'
+
+mongo_client = None
+db = None
+patient_reports = None
+report_writer = None
+compare_pool = None
+
+def connect_database():
+    """Create the MongoDB client (MongoClient is not fork-safe, so once per process)"""
+    global mongo_client, db, patient_reports
+    # MongoDB connection setup
+    try:
+        mongo_client = MongoClient("mongodb://localhost:27017/")
+        db = mongo_client["mediscan_db"]
+        patient_reports = db["patient_reports"]
+        logging.info("Connected to MongoDB")
+    except Exception as e:
+        logging.error(f"Failed to connect to MongoDB: {e}")
+        mongo_client = None
+        db = None
+
+def update_report_summaries(docs):
+    """Keep the dashboard summary collections up to date with stored reports"""
+    if REPORT_SUMMARIES_ENABLED and db is not None:
+        try:
+            record_reports(db, docs)
+        except Exception as e:
+            logging.error(f"Failed to update report summaries, scheduling a rebuild: {e}")
+            schedule_rebuild(db)
+
+def on_reports_written(docs):
+    """Called by the write-behind writer once new reports are in MongoDB"""
+    # Only now would a recount include them; invalidating at enqueue time let a stale count be cached again
+    for patient_id in {doc.get("patient_id") for doc in docs}:
+        report_counts.invalidate(patient_id)
+    update_report_summaries(docs)
+
+def start_background_services():
+    """Start the threads and pools owned by the serving process"""
+    global report_writer, compare_pool
+    # Indexes backing every allowed listing sort, and the dashboard summary collections
+    if db is not None:
+        ensure_indexes_async(patient_reports)
+        if REPORT_SUMMARIES_ENABLED:
+            ensure_summary_indexes_async(db)
+    
+    # Write-behind queue for new reports (WRITE_BEHIND=0 inserts synchronously instead)
+    report_writer = create_report_writer(patient_reports, on_written=on_reports_written) if db is not None else None
+    
+    # Optional process pool for the CPU-bound compare pipeline (COMPARE_POOL_SIZE > 0)
+    compare_pool = create_compare_pool()
+    
+    # Catch the similar-case index up with reports stored while it was offline
+    if db is not None:
+        start_index_sync(similar_index, patient_reports, vectorize_documents)
+
+def init_worker():
+    """Re-create clients and background services in a worker forked from a preloaded master"""
+    init_groq_client()
+    similar_index.refresh()
+    connect_database()
+    start_background_services()
+
+# Cached per-patient report counts
+report_counts = CountCache()
+
+# Content-addressed store for uploaded scans and their derivatives
+scan_store = ScanStore(SCAN_STORE_DIR)
+
+# Resumable chunked uploads of large scans (finalized into scan_store)
+chunked_uploads = ChunkedUploads()
+
+# Heightmaps and isosurfaces for the 3D viewer, cached next to each scan
+mesh_service = MeshService(scan_store)
+
+# Slices of stored volumes for scrolling through a study (LRU cache with prefetch)
+slice_server = SliceServer(scan_store)
+
+# Priority queues and concurrency limits in front of scan analysis and comparison
+admission = AdmissionController() if ADMISSION_ENABLED else None
+
+# Similar-case vector index over every stored report (memory-mapped, shared by forked workers)
+similar_index = VectorIndex(SIMILAR_INDEX_DIR, EMBEDDING_DIM)
+
+# Spawned comparison workers re-import the script started with `python app.py` as
+# __mp_main__; they only need the comparison code, not the database or writers.
+if not PRELOAD_MODE and __name__ != '__mp_main__':
+    connect_database()
+    start_background_services()
+
+def serialize_longitudinal(delta):
+    """Make a stored longitudinal delta JSON-serializable"""
+    delta = dict(delta)
+    if delta.get('previous_created_at'):
+        delta['previous_created_at'] = delta['previous_created_at'].isoformat()
+    return delta
+
+def store_report_result(result, patient_id, scan_filename, report_text, scan_hash=None, extra_fields=None):
+    """
+    Store an analysis result as a new patient report and index it
+
+    Adds report_id (and the longitudinal delta, if any) to result. Storage errors are
+    logged rather than raised, except WriteQueueFullError.
+    """
+    try:
+        # Create a document to store in MongoDB
+        report_document = {
+            "patient_id": patient_id,
+            "scan_filename": scan_filename,
+            "scan_hash": scan_hash,
+            "report_text": report_text,
+            # A copy, so the report_id and longitudinal fields added to result below are never stored
+            "analysis_result": dict(result),
+            "created_at": datetime.now(),
+            "anomaly_detected": result.get("anomaly_detection", {}).get("anomaly_detected", False)
+        }
+        if extra_fields:
+            report_document.update(extra_fields)
+        
+        # Compare against the patient's previous report and store the delta with this one
+        if LONGITUDINAL_TRACKING_ENABLED:
+            try:
+                with stage("longitudinal"):
+                    # A report still waiting in the write queue is newer than anything in MongoDB
+                    previous = report_writer.latest_pending(patient_id) if report_writer is not None else None
+                    attach_longitudinal_delta(patient_reports, report_document, previous=previous)
+            except Exception as tracking_error:
+                logging.error(f"Failed to compute longitudinal delta: {tracking_error}")
+        
+        # Insert the document into MongoDB, through the write-behind queue when enabled
+        if report_writer is not None:
+            with stage("mongo.enqueue"):
+                report_id = report_writer.submit(report_document)
+            logging.info(f"Queued report with ID {report_id} for patient {patient_id}")
+        else:
+            with stage("mongo.insert"):
+                report_id = patient_reports.insert_one(report_document).inserted_id
+            logging.info(f"Stored report with ID {report_id} for patient {patient_id}")
+            report_counts.invalidate(patient_id)
+            with stage("mongo.summaries"):
+                update_report_summaries([report_document])
+        
+        # Add the MongoDB ID to the result
+        result["report_id"] = str(report_id)
+        if report_document.get("longitudinal"):
+            result["longitudinal"] = serialize_longitudinal(report_document["longitudinal"])
+        
+    except WriteQueueFullError:
+        raise
+    except Exception as db_error:
+        logging.error(f"Failed to store report in database: {db_error}")
+        # We don't want to fail the API call if DB storage fails
+        return
+    
+    try:
+        # Reuse the embedding computed for longitudinal tracking when there is one
+        artifacts = report_document.get("analysis_artifacts")
+        similar_index.add(
+            result["report_id"],
+            artifacts["embedding"] if artifacts else vectorize_document(report_document_text(report_document)),
+            scan_type=result.get("scan_type"),
+            anomaly_detected=report_document["anomaly_detected"]
+        )
+    except Exception as index_error:
+        logging.error(f"Failed to add report to similar-case index: {index_error}")
+
+def admission_slot(operation, fields):
+    """
+    Admission slot for an expensive request: `with admission_slot(...):`
+    
+    fields (form or JSON) may carry "priority" (stat, urgent or routine) and
+    "deadline_ms"; the X-Deadline-Ms and X-Client-Id headers are honoured too. Groq
+    calls made inside the slot get only the time left before the deadline.
+    Raises ValueError for a malformed priority or deadline.
+    """
+    deadline_ms = fields.get('deadline_ms')
+    timeout = parse_deadline_ms(deadline_ms if deadline_ms is not None else request.headers.get('X-Deadline-Ms'))
+    if admission is None:
+        return deadline_slot(nullcontext(), time.monotonic() + timeout if timeout else None)
+    priority = admission.parse_priority(fields.get('priority'))
+    client_id = request.headers.get('X-Client-Id') or request.remote_addr or 'unknown'
+    return deadline_slot(admission.admit(operation, priority, client_id, timeout))
+
+def parse_deadline_ms(value):
+    """Seconds until the deadline from a deadline_ms field or header; None if absent, ValueError if malformed"""
+    if value is None or value == '':
+        return None
+    if isinstance(value, bool) or not isinstance(value, (int, float, str)):
+        raise ValueError("deadline_ms must be a number of milliseconds")
+    try:
+        deadline_ms = float(value)
+    except ValueError:
+        raise ValueError(f"deadline_ms must be a number of milliseconds, got '{value}'")
+    if not math.isfinite(deadline_ms) or deadline_ms <= 0:
+        raise ValueError("deadline_ms must be a positive number of milliseconds")
+    return deadline_ms / 1000
+
+@contextmanager
+def deadline_slot(slot, deadline=None):
+    """Enter an admission slot and hold the model calls made inside it to the request's deadline"""
+    with slot as ticket:
+        with call_deadline(ticket.deadline if ticket is not None else deadline):
+            yield ticket
+
+def admission_rejected_response(rejection):
+    logging.warning(f"Rejected request ({rejection.reason}): {rejection}")
+    response = jsonify({'error': str(rejection), 'reason': rejection.reason})
+    response.headers['Retry-After'] = str(rejection.retry_after)
+    return response, rejection.status
+
+def deadline_exceeded_response(error):
+    logging.warning(f"Analysis ran out of time: {error}")
+    return jsonify({'error': f'Analysis did not finish before the request deadline: {error}'}), 504
+
+def write_queue_full_response(queue_error):
+    logging.error(f"Failed to queue report: {queue_error}")
+    response = jsonify({'error': 'Report storage is overloaded, please retry shortly'})
+    response.headers['Retry-After'] = '5'
+    return response, 503
 
 @app.route('/api/analyze', methods=['POST'])
 def analyze_scan():
+    try:
+        slot = admission_slot('analyze', request.form)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    
+    # A scan sent through /api/uploads is referenced by its upload_id instead of attached
+    if request.form.get('upload_id'):
+        return analyze_uploaded_scan(request.form['upload_id'], slot)
+    
     # Check if image is present in the request
     if 'scan' not in request.files:
         return jsonify({'error': 'No scan file provided'}), 400
     
     scan_file = request.files['scan']
     
-    # Check if filename is valid
+    # If user submits an empty form
     if scan_file.filename == '':
         return jsonify({'error': 'No selected file'}), 400
     
@@ -69,35 +351,37 @@ def analyze_scan():
     patient_id = request.form.get('patient_id', '')
     
     try:
-        # Process the scan using the core functions
-        result, error = process_scan(scan_path, report_text)
+        # Keep the scan in the content-addressed store; a known scan is not decoded again
+        scan_hash = None
+        image_data_url = None
+        try:
+            with stage("scan_store.put"):
+                scan_hash = scan_store.put(scan_path, scan_file.filename)
+                image_data_url = scan_store.data_url(scan_hash)
+        except Exception as store_error:
+            logging.error(f"Failed to store scan: {store_error}")
+        
+        # Process the scan using the core functions, once admitted
+        try:
+            with slot:
+                result, error = process_scan(scan_path, report_text, image_data_url=image_data_url)
+        except AdmissionRejected as rejection:
+            return admission_rejected_response(rejection)
+        except DeadlineExceeded as e:
+            return deadline_exceeded_response(e)
         
         if error:
             return jsonify({'error': error}), 500
         
+        if scan_hash:
+            result["scan_hash"] = scan_hash
+        
         # Store result in MongoDB if we have a patient ID and database connection
         if patient_id and db is not None:
             try:
-                # Create a document to store in MongoDB
-                report_document = {
-                    "patient_id": patient_id,
-                    "scan_filename": scan_file.filename,
-                    "report_text": report_text,
-                    "analysis_result": result,
-                    "created_at": datetime.now(),
-                    "anomaly_detected": result.get("anomaly_detection", {}).get("anomaly_detected", False)
-                }
-                
-                # Insert the document into MongoDB
-                report_id = patient_reports.insert_one(report_document).inserted_id
-                logging.info(f"Stored report with ID {report_id} for patient {patient_id}")
-                
-                # Add the MongoDB ID to the result
-                result["report_id"] = str(report_id)
-                
-            except Exception as db_error:
-                logging.error(f"Failed to store report in database: {db_error}")
-                # We don't want to fail the API call if DB storage fails
+                store_report_result(result, patient_id, scan_file.filename, report_text, scan_hash)
+            except WriteQueueFullError as queue_error:
+                return write_queue_full_response(queue_error)
         
         return jsonify(result)
     
@@ -106,6 +390,376 @@ def analyze_scan():
         if os.path.exists(scan_path):
             os.remove(scan_path)
 
+def analyze_uploaded_scan(upload_id, slot):
+    """Analyze a scan finalized through the chunked upload endpoints (same form fields as /api/analyze)"""
+    try:
+        upload = chunked_uploads.get(upload_id)
+    except UploadNotFoundError as e:
+        return jsonify({'error': str(e)}), 404
+    if upload["status"] != "finalized" or upload["scan_hash"] not in scan_store:
+        return jsonify({'error': 'Upload is not finalized', 'upload': upload}), 409
+    
+    report_text = None
+    if 'report' in request.files and request.files['report'].filename != '':
+        report_text = request.files['report'].read().decode('utf-8')
+    elif 'report_text' in request.form:
+        report_text = request.form['report_text']
+    patient_id = request.form.get('patient_id', '')
+    
+    scan_hash = upload["scan_hash"]
+    with stage("scan_store.load"):
+        image_data_url = scan_store.data_url(scan_hash)
+    try:
+        with slot:
+            result, error = process_scan(scan_store.path(scan_hash), report_text, image_data_url=image_data_url)
+    except AdmissionRejected as rejection:
+        return admission_rejected_response(rejection)
+    except DeadlineExceeded as e:
+        return deadline_exceeded_response(e)
+    if error:
+        return jsonify({'error': error}), 500
+    result["scan_hash"] = scan_hash
+    
+    if patient_id and db is not None:
+        try:
+            store_report_result(result, patient_id, upload["filename"], report_text, scan_hash)
+        except WriteQueueFullError as queue_error:
+            return write_queue_full_response(queue_error)
+    
+    return jsonify(result)
+
+def upload_conflict_response(conflict):
+    """409 telling the client which offset to resume from"""
+    response = jsonify({'error': str(conflict), 'offset': conflict.offset})
+    response.headers['Upload-Offset'] = str(conflict.offset)
+    return response, 409
+
+@app.route('/api/uploads', methods=['POST'])
+def create_upload():
+    """
+    Start a resumable upload for a scan too large for a single request
+    
+    Request JSON:
+    - filename: Scan file name (its extension selects the format)
+    - size: Total size in bytes
+    - sha256: Optional hex digest, verified when the upload is finalized
+    
+    Then PUT each chunk to /api/uploads/<upload_id>?offset=N (raw bytes, at most
+    chunk_size per request), POST /api/uploads/<upload_id>/finalize, and analyze it
+    by sending upload_id to /api/analyze.
+    """
+    data = request.get_json(silent=True) or {}
+    try:
+        size = int(data.get('size', 0))
+    except (TypeError, ValueError):
+        return jsonify({'error': 'size must be an integer'}), 400
+    try:
+        upload = chunked_uploads.create(data.get('filename', ''), size, data.get('sha256'))
+    except UploadError as e:
+        return jsonify({'error': str(e)}), 400
+    return jsonify(upload), 201
+
+@app.route('/api/uploads/<upload_id>', methods=['GET'])
+def get_upload(upload_id):
+    """Upload status; "offset" is where the next chunk must start"""
+    try:
+        upload = chunked_uploads.get(upload_id)
+    except UploadNotFoundError as e:
+        return jsonify({'error': str(e)}), 404
+    response = jsonify(upload)
+    response.headers['Upload-Offset'] = str(upload["offset"])
+    response.headers['Cache-Control'] = 'no-store'
+    return response
+
+@app.route('/api/uploads/<upload_id>', methods=['PUT', 'PATCH'])
+def put_upload_chunk(upload_id):
+    """
+    Append one chunk of raw bytes
+    
+    Query Parameters:
+    - offset: Byte offset of this chunk (defaults to the Upload-Offset header)
+    """
+    offset = request.args.get('offset', request.headers.get('Upload-Offset'))
+    if offset is None or request.content_length is None:
+        return jsonify({'error': 'offset and Content-Length are required'}), 400
+    try:
+        offset = int(offset)
+    except ValueError:
+        return jsonify({'error': 'offset must be an integer'}), 400
+    try:
+        upload = chunked_uploads.write_chunk(upload_id, offset, request.stream, request.content_length)
+    except UploadNotFoundError as e:
+        return jsonify({'error': str(e)}), 404
+    except UploadConflictError as e:
+        return upload_conflict_response(e)
+    except UploadError as e:
+        return jsonify({'error': str(e)}), 400
+    response = jsonify(upload)
+    response.headers['Upload-Offset'] = str(upload["offset"])
+    return response
+
+@app.route('/api/uploads/<upload_id>/finalize', methods=['POST'])
+def finalize_upload(upload_id):
+    """Verify the completed upload and add it to the scan store"""
+    try:
+        with stage("uploads.finalize"):
+            upload = chunked_uploads.finalize(upload_id, scan_store)
+    except UploadNotFoundError as e:
+        return jsonify({'error': str(e)}), 404
+    except UploadConflictError as e:
+        return upload_conflict_response(e)
+    except UploadError as e:
+        return jsonify({'error': str(e)}), 400
+    except Exception as e:
+        logging.error(f"Failed to finalize upload {upload_id}: {e}")
+        return jsonify({'error': f'Failed to store scan: {e}'}), 500
+    return jsonify(upload)
+
+@app.route('/api/uploads/<upload_id>', methods=['DELETE'])
+def abort_upload(upload_id):
+    """Discard an upload and its received bytes"""
+    try:
+        chunked_uploads.abort(upload_id)
+    except UploadNotFoundError as e:
+        return jsonify({'error': str(e)}), 404
+    except UploadConflictError as e:
+        return upload_conflict_response(e)
+    return jsonify({'upload_id': upload_id, 'status': 'aborted'})
+
+@app.route('/api/reanalyze', methods=['POST'])
+def reanalyze_scan():
+    """
+    Re-run analysis on a stored scan without uploading it again
+    
+    Request JSON:
+    - report_id or scan_hash: The report whose scan to analyze, or the scan itself
+    - report_text: Optional report text (defaults to the original report's text)
+    - patient_id: Optional; stores the result as a new report for this patient
+      (defaults to the original report's patient when "save" is true)
+    - save: Store the result as a new report (default: false)
+    - priority, deadline_ms: Admission priority class and deadline (see admission_slot)
+    """
+    data = request.get_json(silent=True) or {}
+    try:
+        slot = admission_slot('analyze', data)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    report_id = data.get('report_id')
+    scan_hash = data.get('scan_hash')
+    if not report_id and not scan_hash:
+        return jsonify({"error": "Provide report_id or scan_hash"}), 400
+    
+    original = None
+    if report_id:
+        if db is None:
+            return jsonify({"error": "Database connection is not available"}), 500
+        try:
+            object_id = ObjectId(report_id)
+        except Exception:
+            return jsonify({"error": f"Invalid report_id '{report_id}'"}), 400
+        original = patient_reports.find_one({"_id": object_id}, {"analysis_artifacts": 0, "longitudinal": 0})
+        if not original and report_writer is not None:
+            original = report_writer.get_pending(object_id)
+        if not original:
+            return jsonify({"error": "Report not found"}), 404
+        scan_hash = original.get("scan_hash")
+        if not scan_hash:
+            return jsonify({"error": "The scan for this report was not stored; upload it again"}), 404
+    
+    if scan_hash not in scan_store:
+        return jsonify({"error": "Scan not found"}), 404
+    
+    report_text = data.get('report_text', original.get('report_text') if original else None)
+    scan_meta = scan_store.meta(scan_hash)
+    
+    with stage("scan_store.load"):
+        image_data_url = scan_store.data_url(scan_hash)
+    try:
+        with slot:
+            result, error = process_scan(scan_store.path(scan_hash), report_text, image_data_url=image_data_url)
+    except AdmissionRejected as rejection:
+        return admission_rejected_response(rejection)
+    except DeadlineExceeded as e:
+        return deadline_exceeded_response(e)
+    if error:
+        return jsonify({'error': error}), 500
+    result["scan_hash"] = scan_hash
+    
+    patient_id = data.get('patient_id') or (original.get('patient_id') if original else '')
+    if data.get('save') and patient_id and db is not None:
+        extra_fields = {"reanalysis_of": str(original["_id"])} if original else None
+        try:
+            store_report_result(result, patient_id, scan_meta["filename"], report_text, scan_hash, extra_fields)
+        except WriteQueueFullError as queue_error:
+            return write_queue_full_response(queue_error)
+    
+    return jsonify(result)
+
+@app.route('/api/scans', methods=['POST'])
+def upload_scan():
+    """Store a scan without analyzing it (e.g. to view it in 3D); returns its metadata"""
+    if 'scan' not in request.files or request.files['scan'].filename == '':
+        return jsonify({'error': 'No scan file provided'}), 400
+    scan_file = request.files['scan']
+    if not allowed_file(scan_file.filename):
+        return jsonify({'error': 'File type not allowed. Supported types: png, jpg, jpeg, dcm, nii, nii.gz'}), 400
+    
+    scan_path = os.path.join(app.config['UPLOAD_FOLDER'], os.path.basename(scan_file.filename))
+    scan_file.save(scan_path)
+    try:
+        with stage("scan_store.put"):
+            scan_hash = scan_store.put(scan_path, scan_file.filename, move=True)
+    except Exception as e:
+        logging.error(f"Failed to store scan: {e}")
+        return jsonify({'error': f'Failed to store scan: {e}'}), 500
+    finally:
+        if os.path.exists(scan_path):
+            os.remove(scan_path)
+    return jsonify(scan_store.meta(scan_hash)), 201
+
+@app.route('/api/scans/<scan_hash>/mesh', methods=['GET'])
+def get_scan_mesh(scan_hash):
+    """
+    3D geometry of a stored scan as binary glTF (model/gltf-binary)
+    
+    Query Parameters:
+    - kind: heightmap (2D scans) or isosurface (volumes); defaults by the scan's is_volume
+    - lod: Level of detail, 0 (finest) to 2 (default: 0)
+    - resolution: Heightmap grid cells per pixel, up to 2 (default: 1)
+    - smoothing: Heightmap smoothing passes (default: 0)
+    - level: Isosurface intensity (default: chosen with Otsu's method)
+    
+    Heights are brightness in [0, 1]; the viewer applies its own height scale.
+    """
+    meta = scan_store.meta(scan_hash)
+    if meta is None:
+        return jsonify({"error": "Scan not found"}), 404
+    try:
+        kind = request.args.get('kind') or MeshService.default_kind(meta)
+        lod = int(request.args.get('lod', 0))
+        resolution = float(request.args.get('resolution', 1.0))
+        smoothing = int(request.args.get('smoothing', 0))
+        level = float(request.args['level']) if request.args.get('level') else None
+    except ValueError:
+        return jsonify({"error": "lod, resolution, smoothing and level must be numbers"}), 400
+    
+    try:
+        with stage("mesh"):
+            path = mesh_service.get(scan_hash, kind, lod, resolution, smoothing, level)
+    except MeshError as e:
+        return jsonify({"error": str(e)}), 400
+    except Exception as e:
+        logger.error(f"Failed to build mesh for scan {scan_hash}: {e}")
+        return jsonify({"error": f"Failed to build mesh: {e}"}), 500
+    
+    response = send_file(path, mimetype='model/gltf-binary', conditional=True,
+                         etag=f"{scan_hash}-{os.path.basename(path)}")
+    # The parameters are part of the URL and the scan never changes
+    response.headers['Cache-Control'] = 'public, max-age=31536000, immutable'
+    return response
+
+@app.route('/api/scans/<scan_hash>/volume', methods=['GET'])
+def get_scan_volume(scan_hash):
+    """Shape, voxel spacing, slices per plane and default window of a stored volume"""
+    try:
+        info = slice_server.volume_info(scan_hash)
+    except SliceError as e:
+        return jsonify({"error": str(e)}), 400
+    except Exception as e:
+        logger.error(f"Failed to open volume of scan {scan_hash}: {e}")
+        return jsonify({"error": f"Failed to open volume: {e}"}), 500
+    if info is None:
+        return jsonify({"error": "Scan not found"}), 404
+    return jsonify(info)
+
+@app.route('/api/scans/<scan_hash>/slices/<plane>/<int:index>', methods=['GET'])
+def get_scan_slice(scan_hash, plane, index):
+    """
+    One slice of a stored volume as an image
+    
+    URL Parameters:
+    - plane: axial, coronal or sagittal
+    - index: Slice number (see /api/scans/<scan_hash>/volume for the counts)
+    
+    Query Parameters:
+    - size: Longest edge in pixels (default: native resolution); request a small
+      size first while scrolling, then the full one
+    - center, width: Display window (default: the volume's window)
+    - format: png (default) or jpeg (progressive)
+    - prefetch: Encode the next slices in the scroll direction (default: 1)
+    """
+    try:
+        size = int(request.args['size']) if request.args.get('size') else None
+        center = float(request.args['center']) if request.args.get('center') else None
+        width = float(request.args['width']) if request.args.get('width') else None
+    except ValueError:
+        return jsonify({"error": "size, center and width must be numbers"}), 400
+    img_format = request.args.get('format', 'png')
+    prefetch = request.args.get('prefetch', '1') != '0'
+    
+    try:
+        with stage("slice"):
+            result = slice_server.get_slice(scan_hash, plane, index, size, center, width, img_format, prefetch)
+    except SliceError as e:
+        return jsonify({"error": str(e)}), 400
+    except Exception as e:
+        logger.error(f"Failed to render slice {plane} {index} of scan {scan_hash}: {e}")
+        return jsonify({"error": f"Failed to render slice: {e}"}), 500
+    if result is None:
+        return jsonify({"error": "Scan not found"}), 404
+    
+    data, cache_hit = result
+    response = Response(data, mimetype=SLICE_FORMATS[img_format])
+    # The scan and every rendering parameter are in the URL, so the image never changes
+    response.headers['Cache-Control'] = 'public, max-age=31536000, immutable'
+    response.headers['X-Slice-Cache'] = 'hit' if cache_hit else 'miss'
+    return response
+
+@app.route('/api/scans/<scan_hash>', methods=['GET'])
+def get_scan_metadata(scan_hash):
+    """Metadata of a stored scan, including the available derivatives"""
+    meta = scan_store.meta(scan_hash)
+    if meta is None:
+        return jsonify({"error": "Scan not found"}), 404
+    return jsonify(meta)
+
+@app.route('/api/scans/<scan_hash>', methods=['DELETE'])
+def delete_scan(scan_hash):
+    """
+    Remove a stored scan, its derivatives and its cache
+    
+    Reports keep their scan_hash, but can no longer be re-analyzed or viewed in 3D.
+    """
+    if not scan_store.delete(scan_hash):
+        return jsonify({"error": "Scan not found"}), 404
+    slice_server.forget(scan_hash)
+    return jsonify({"scan_hash": scan_hash, "status": "deleted"})
+
+@app.route('/api/scans/<scan_hash>/cache', methods=['DELETE'])
+def clear_scan_cache(scan_hash):
+    """Remove the meshes and decoded volume computed for a scan; they are rebuilt on the next request"""
+    freed = scan_store.clear_cache(scan_hash)
+    if freed is None:
+        return jsonify({"error": "Scan not found"}), 404
+    slice_server.forget(scan_hash)
+    return jsonify({"scan_hash": scan_hash, "bytes_freed": freed})
+
+@app.route('/api/scans/<scan_hash>/<kind>', methods=['GET'])
+def get_scan_file(scan_hash, kind):
+    """
+    Download a stored scan
+    
+    URL Parameters:
+    - kind: original, normalized, or a derivative name (preview, thumbnail)
+    """
+    path = scan_store.path(scan_hash, kind)
+    if path is None:
+        return jsonify({"error": "Scan not found"}), 404
+    response = send_file(path, conditional=True, etag=f"{scan_hash}-{kind}")
+    # Content-addressed: the bytes behind this URL never change
+    response.headers['Cache-Control'] = 'public, max-age=31536000, immutable'
+    return response
+
 @app.route('/api/patient/<patient_id>/reports', methods=['GET'])
 def get_patient_reports(patient_id):
     """
@@ -115,58 +769,188 @@ def get_patient_reports(patient_id):
     - patient_id: The ID of the patient
     
     Query Parameters:
-    - limit: Maximum number of reports to return (default: 100)
-    - skip: Number of reports to skip (for pagination, default: 0)
-    - sort: Field to sort by (default: created_at)
+    - limit: Maximum number of reports to return (default: 100, max: 100)
+    - cursor: Continuation token from a previous page's next_cursor (preferred over skip)
+    - skip: Number of reports to skip (for pagination without a cursor, default: 0)
+    - sort: Field to sort by: created_at, anomaly_detected or scan_type (default: created_at)
     - order: Sort order (asc or desc, default: desc)
+    - include_total: Whether to include the total report count (default: true, cached briefly)
+    - view: summary (id, created_at, scan_filename, scan_type, anomaly_detected, finding_count)
+            or full (whole documents) (default: summary)
+    - fields: Comma-separated list of fields to return instead of a view, e.g. fields=created_at,report_text
     """
-    if not db:
+    if db is None:
         return jsonify({"error": "Database connection is not available"}), 500
     
     # Parse query parameters
     try:
-        limit = int(request.args.get('limit', 100))
+        limit = min(int(request.args.get('limit', MAX_PAGE_SIZE)), MAX_PAGE_SIZE)
         skip = int(request.args.get('skip', 0))
     except ValueError:
         return jsonify({"error": "Invalid limit or skip parameters"}), 400
+    if limit < 1 or skip < 0:
+        return jsonify({"error": "limit must be at least 1 and skip must not be negative"}), 400
+    
+    try:
+        sort_key, sort_direction = parse_listing_sort(
+            request.args.get('sort', DEFAULT_SORT),
+            request.args.get('order', 'desc')
+        )
+        page_cursor = decode_cursor(request.args['cursor']) if request.args.get('cursor') else None
+        projection = build_listing_projection(
+            request.args.get('view', 'summary'),
+            request.args.get('fields')
+        )
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
     
-    sort_field = request.args.get('sort', 'created_at')
-    sort_order = request.args.get('order', 'desc')
-    sort_direction = -1 if sort_order.lower() == 'desc' else 1
+    include_total = request.args.get('include_total', 'true').lower() != 'false'
     
     try:
         # Query MongoDB for patient reports
-        cursor = patient_reports.find(
-            {"patient_id": patient_id}
-        ).sort(
-            sort_field, sort_direction
-        ).skip(skip).limit(limit)
+        docs, next_cursor = find_report_page(
+            patient_reports, patient_id, sort_key, sort_direction, limit,
+            cursor=page_cursor, skip=skip, projection=projection
+        )
         
         # Convert MongoDB documents to JSON-serializable format
         reports = []
-        for doc in cursor:
+        for doc in docs:
             # Convert ObjectId to string
             doc['_id'] = str(doc['_id'])
             # Convert datetime objects to strings
             if 'created_at' in doc:
                 doc['created_at'] = doc['created_at'].isoformat()
+            if doc.get('longitudinal'):
+                doc['longitudinal'] = serialize_longitudinal(doc['longitudinal'])
             reports.append(doc)
         
-        # Get total count
-        total_reports = patient_reports.count_documents({"patient_id": patient_id})
-        
-        return jsonify({
+        response = {
             "patient_id": patient_id,
             "reports": reports,
-            "total": total_reports,
             "limit": limit,
-            "skip": skip
-        })
+            "skip": skip,
+            "next_cursor": next_cursor,
+            "has_more": next_cursor is not None
+        }
+        
+        # Get total count (cached per patient, invalidated on insert)
+        if include_total:
+            response["total"] = report_counts.get_or_count(patient_reports, patient_id)
+        
+        return jsonify(response)
+    
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
     
     except Exception as e:
         logging.error(f"Error retrieving patient reports: {e}")
         return jsonify({"error": f"Failed to retrieve patient reports: {str(e)}"}), 500
 
+@app.route('/api/reports/export', methods=['GET'])
+def export_reports():
+    """
+    Stream reports for QA review or offline analysis without loading them all into memory
+    
+    Query Parameters:
+    - patient_ids: Comma-separated patient IDs (default: all patients)
+    - from: Only reports created at or after this ISO date/time
+    - to: Only reports created before this ISO date/time
+    - anomaly_detected: true or false
+    - format: ndjson (one JSON document per line) or json (a single array) (default: ndjson)
+    - view / fields: Same projection options as the patient report listing (default: full)
+    """
+    if db is None:
+        return jsonify({"error": "Database connection is not available"}), 500
+    
+    try:
+        patient_ids = [pid.strip() for pid in request.args.get('patient_ids', '').split(',') if pid.strip()]
+        date_from, date_to = parse_date_range()
+        anomaly_detected = None
+        if request.args.get('anomaly_detected') is not None:
+            value = request.args['anomaly_detected'].lower()
+            if value not in ('true', 'false'):
+                raise ValueError("anomaly_detected must be true or false")
+            anomaly_detected = value == 'true'
+        projection = build_listing_projection(request.args.get('view', 'full'), request.args.get('fields'))
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    
+    output_format = request.args.get('format', 'ndjson')
+    if output_format not in ('ndjson', 'json'):
+        return jsonify({"error": "Invalid format. Allowed: ndjson, json"}), 400
+    
+    query = build_export_query(patient_ids, date_from, date_to, anomaly_detected)
+    mimetype = 'application/x-ndjson' if output_format == 'ndjson' else 'application/json'
+    filename = f"reports-export.{output_format}"
+    
+    return Response(
+        iter_export(patient_reports, query, projection, output_format),
+        mimetype=mimetype,
+        headers={'Content-Disposition': f'attachment; filename="{filename}"'}
+    )
+
+@app.route('/api/patient/<patient_id>/trajectory', methods=['GET'])
+def get_patient_trajectory(patient_id):
+    """
+    Retrieve a patient's progress over time from the deltas stored at insert time
+    
+    Each report carries its comparison against the previous report, so nothing is recomputed here.
+    
+    URL Parameters:
+    - patient_id: The ID of the patient
+    
+    Query Parameters:
+    - limit: Maximum number of follow-ups to return (default: 100, 1 to MAX_TRAJECTORY_POINTS)
+    """
+    if db is None:
+        return jsonify({"error": "Database connection is not available"}), 500
+    
+    try:
+        limit = int(request.args.get('limit', 100))
+    except ValueError:
+        return jsonify({"error": "Invalid limit parameter"}), 400
+    if not 1 <= limit <= MAX_TRAJECTORY_POINTS:
+        return jsonify({"error": f"limit must be between 1 and {MAX_TRAJECTORY_POINTS}"}), 400
+    
+    try:
+        cursor = patient_reports.find(
+            {"patient_id": patient_id},
+            {
+                "created_at": 1,
+                "anomaly_detected": 1,
+                "longitudinal.follow_up_index": 1,
+                "longitudinal.previous_report_id": 1,
+                "longitudinal.similarity": 1,
+                "longitudinal.progress_report.recovery_metrics": 1,
+                "longitudinal.progress_report.progress_summary": 1
+            }
+        ).sort([("created_at", 1), ("_id", 1)]).limit(limit)
+        
+        trajectory = []
+        for doc in cursor:
+            delta = doc.get('longitudinal') or {}
+            progress_report = delta.get('progress_report') or {}
+            trajectory.append({
+                "report_id": str(doc['_id']),
+                "created_at": doc['created_at'].isoformat() if doc.get('created_at') else None,
+                "anomaly_detected": doc.get('anomaly_detected'),
+                "follow_up_index": delta.get('follow_up_index'),
+                "previous_report_id": delta.get('previous_report_id'),
+                "similarity_to_previous": delta.get('similarity'),
+                "recovery_metrics": progress_report.get('recovery_metrics'),
+                "progress_summary": progress_report.get('progress_summary')
+            })
+        
+        return jsonify({
+            "patient_id": patient_id,
+            "trajectory": trajectory
+        })
+    
+    except Exception as e:
+        logging.error(f"Error retrieving patient trajectory: {e}")
+        return jsonify({"error": f"Failed to retrieve patient trajectory: {str(e)}"}), 500
+
 @app.route('/api/report/<report_id>', methods=['GET'])
 def get_report_by_id(report_id):
     """
@@ -175,7 +959,7 @@ def get_report_by_id(report_id):
     URL Parameters:
     - report_id: The MongoDB ID of the report
     """
-    if not db:
+    if db is None:
         return jsonify({"error": "Database connection is not available"}), 500
     
     try:
@@ -183,7 +967,13 @@ def get_report_by_id(report_id):
         object_id = ObjectId(report_id)
         
         # Query MongoDB for the specific report
-        report = patient_reports.find_one({"_id": object_id})
+        report = patient_reports.find_one({"_id": object_id}, {"analysis_artifacts": 0})
+        
+        # The report may still be waiting in the write-behind queue
+        if not report and report_writer is not None:
+            pending = report_writer.get_pending(object_id)
+            if pending:
+                report = {key: value for key, value in pending.items() if key != "analysis_artifacts"}
         
         if not report:
             return jsonify({"error": "Report not found"}), 404
@@ -193,6 +983,8 @@ def get_report_by_id(report_id):
         # Convert datetime objects to strings
         if 'created_at' in report:
             report['created_at'] = report['created_at'].isoformat()
+        if report.get('longitudinal'):
+            report['longitudinal'] = serialize_longitudinal(report['longitudinal'])
         
         return jsonify(report)
     
@@ -200,6 +992,100 @@ def get_report_by_id(report_id):
         logging.error(f"Error retrieving report: {e}")
         return jsonify({"error": f"Failed to retrieve report: {str(e)}"}), 500
 
+@app.route('/api/reports/similar', methods=['POST'])
+def find_similar_reports():
+    """
+    Find stored reports similar to a given report
+    
+    Expected JSON body:
+    - report_text: Text of the query report
+    OR
+    - report_id: ID of a stored report to use as the query
+    
+    Optional fields:
+    - top_k: Number of results to return (default: 10, max: 100)
+    - scan_type: Only return reports of this scan type
+    - anomaly_detected: Only return reports with this anomaly flag
+    - exact: Force an exact search even when an approximate index exists
+    """
+    data = request.get_json(silent=True) or {}
+    
+    try:
+        top_k = min(int(data.get('top_k', 10)), 100)
+    except (TypeError, ValueError):
+        return jsonify({"error": "Invalid top_k parameter"}), 400
+    if top_k < 1:
+        return jsonify({"error": "top_k must be at least 1"}), 400
+    
+    report_id = data.get('report_id')
+    query_text = data.get('report_text')
+    
+    if report_id:
+        if db is None:
+            return jsonify({"error": "Database connection is not available"}), 500
+        try:
+            object_id = ObjectId(report_id)
+        except Exception as e:
+            return jsonify({"error": f"Invalid report_id: {str(e)}"}), 400
+        # A report still waiting in the write-behind queue is not in MongoDB yet
+        query_doc = report_writer.get_pending(object_id) if report_writer is not None else None
+        if not query_doc:
+            query_doc = patient_reports.find_one({"_id": object_id})
+        if not query_doc:
+            return jsonify({"error": "Report not found"}), 404
+        query_text = report_document_text(query_doc)
+    
+    if not query_text:
+        return jsonify({"error": "Either report_text or report_id is required"}), 400
+    
+    anomaly_detected = data.get('anomaly_detected')
+    if isinstance(anomaly_detected, str):
+        anomaly_detected = anomaly_detected.lower() == 'true'
+    
+    try:
+        # Ask for one extra hit so the query report itself can be dropped
+        hits = similar_index.search(
+            vectorize_document(query_text),
+            top_k=top_k + (1 if report_id else 0),
+            scan_type=data.get('scan_type'),
+            anomaly_detected=anomaly_detected,
+            exact=bool(data.get('exact', False))
+        )
+        hits = [(hit_id, score) for hit_id, score in hits if hit_id != report_id][:top_k]
+        
+        # Fetch display metadata for all hits in one query
+        metadata = {}
+        if hits and db is not None:
+            cursor = patient_reports.find(
+                {"_id": {"$in": [ObjectId(hit_id) for hit_id, _ in hits]}},
+                {"patient_id": 1, "scan_filename": 1, "created_at": 1, "anomaly_detected": 1, "analysis_result.scan_type": 1}
+            )
+            for doc in cursor:
+                metadata[str(doc['_id'])] = doc
+        
+        results = []
+        for hit_id, score in hits:
+            doc = metadata.get(hit_id, {})
+            created_at = doc.get('created_at')
+            results.append({
+                "report_id": hit_id,
+                "similarity": score,
+                "patient_id": doc.get('patient_id'),
+                "scan_filename": doc.get('scan_filename'),
+                "scan_type": (doc.get('analysis_result') or {}).get('scan_type'),
+                "anomaly_detected": doc.get('anomaly_detected'),
+                "created_at": created_at.isoformat() if created_at else None
+            })
+        
+        return jsonify({
+            "results": results,
+            "index": similar_index.stats()
+        })
+    
+    except Exception as e:
+        logging.error(f"Error searching similar reports: {e}")
+        return jsonify({"error": f"Similar report search failed: {str(e)}"}), 500
+
 @app.route('/api/compare', methods=['POST'])
 def compare_documents():
     """
@@ -214,8 +1100,27 @@ def compare_documents():
     
     - docs: JSON array of document content (for text-based documents)
     
+    OR, for reports already stored (see compare_stored_reports):
+    
+    - report_ids: JSON array of report IDs
+    - patient_id (with optional from/to): the patient's reports in that range
+    
+    Uploaded and inline documents may also set priority and deadline_ms (see admission_slot).
+    Any request may set sentence_diff=true to add a sentence-by-sentence diff to each pair.
+    
     Returns a JSON with comparison results and progress report
     """
+    data = request.get_json(silent=True) if request.is_json else None
+    if data and ('report_ids' in data or 'patient_id' in data):
+        return compare_stored_reports(data)
+    
+    fields = data if data is not None else request.form
+    sentence_diff = str(fields.get('sentence_diff', '')).lower() in ('1', 'true')
+    try:
+        slot = admission_slot('compare', fields)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    
     documents = []
     
     # Check if files are present in the request
@@ -233,7 +1138,7 @@ def compare_documents():
             if file.filename == '':
                 continue
             
-            if not allowed_file(file.filename):
+            if not allowed_document_file(file.filename):
                 return jsonify({'error': f'File type not allowed for {doc_key}. Supported types: pdf, txt, jpg, jpeg, png, dcm'}), 400
             
             # Read file content
@@ -272,18 +1177,290 @@ def compare_documents():
         return jsonify({'error': 'At least two valid documents are required for comparison'}), 400
     
     try:
-        # Compare documents and generate report
-        result = compare_medical_documents(documents)
+        # Compare documents and generate report, off the request thread when a pool is configured
+        with slot as ticket:
+            if compare_pool is not None:
+                with stage("compare_pool"):
+                    # The pool gives up on the task when the request's deadline passes
+                    result = compare_pool.run(documents, timeout=ticket.remaining() if ticket else None,
+                                              sentence_diff=sentence_diff)
+            else:
+                result = compare_medical_documents(documents, sentence_diff)
         
         if 'error' in result:
             return jsonify({'error': result['error']}), 500
         
         return jsonify(result)
     
+    except AdmissionRejected as rejection:
+        return admission_rejected_response(rejection)
+    
+    except PoolSaturatedError as e:
+        logger.warning(f"Rejecting comparison: {e}")
+        return jsonify({'error': 'Comparison service is busy, please retry shortly'}), 503, {'Retry-After': '5'}
+    
+    except CompareTimeoutError as e:
+        logger.error(f"Comparison timed out: {e}")
+        return jsonify({'error': str(e)}), 504
+    
+    except CompareWorkerError as e:
+        logger.error(f"Comparison worker failed: {e}")
+        return jsonify({'error': 'Comparison service is restarting, please retry shortly'}), 503, {'Retry-After': '5'}
+    
     except Exception as e:
         logger.error(f"Error in document comparison endpoint: {e}")
         return jsonify({'error': f'Comparison failed: {str(e)}'}), 500
 
+def compare_stored_reports(data):
+    """
+    Compare stored reports, oldest first, without the client sending their text
+    
+    Each report's stored artifacts (embedding, entities, recovery signals) are reused;
+    reports stored without them get them computed once, in one batch, and saved.
+    
+    Request JSON:
+    - report_ids: Reports to compare (at least two)
+    OR
+    - patient_id: Compare this patient's reports
+    - from, to: Optional ISO dates bounding created_at (to is exclusive)
+    - sentence_diff: Optional, add a sentence-by-sentence diff of each consecutive pair
+    """
+    if db is None:
+        return jsonify({"error": "Database connection is not available"}), 500
+    
+    report_ids = None
+    date_from = date_to = None
+    if 'report_ids' in data:
+        raw_ids = data['report_ids']
+        if not isinstance(raw_ids, list) or len(raw_ids) < 2:
+            return jsonify({'error': 'report_ids must list at least two reports'}), 400
+        try:
+            report_ids = list(dict.fromkeys(ObjectId(report_id) for report_id in raw_ids))
+        except Exception:
+            return jsonify({'error': 'report_ids contains an invalid report ID'}), 400
+        if len(report_ids) > MAX_COMPARE_REPORTS:
+            return jsonify({'error': f'At most {MAX_COMPARE_REPORTS} reports can be compared at once'}), 400
+    else:
+        try:
+            date_from = datetime.fromisoformat(data['from']) if data.get('from') else None
+            date_to = datetime.fromisoformat(data['to']) if data.get('to') else None
+        except (TypeError, ValueError):
+            return jsonify({'error': 'from and to must be ISO 8601 dates'}), 400
+    
+    try:
+        with stage("load_reports"):
+            reports = load_reports_for_comparison(
+                patient_reports, report_ids, data.get('patient_id'), date_from, date_to,
+                limit=MAX_COMPARE_REPORTS + 1
+            )
+        if report_ids is not None and report_writer is not None and len(reports) < len(report_ids):
+            # Reports still queued for writing are not in MongoDB yet
+            found = {report["_id"] for report in reports}
+            pending = [report_writer.get_pending(report_id) for report_id in report_ids if report_id not in found]
+            reports = sorted(reports + [report for report in pending if report],
+                             key=lambda report: (report["created_at"], report["_id"]))
+        
+        if report_ids is not None and len(reports) < len(report_ids):
+            found = {report["_id"] for report in reports}
+            missing = [str(report_id) for report_id in report_ids if report_id not in found]
+            return jsonify({'error': 'Reports not found', 'missing_report_ids': missing}), 404
+        if len(reports) > MAX_COMPARE_REPORTS:
+            return jsonify({'error': f'More than {MAX_COMPARE_REPORTS} reports match; narrow the date range'}), 400
+        if len(reports) < 2:
+            return jsonify({'error': 'At least two stored reports are required for comparison'}), 400
+        
+        with stage("artifacts"):
+            artifacts = ensure_artifacts_many(patient_reports, reports)
+        names = [f"{report['_id']} ({report['created_at'].isoformat()})" for report in reports]
+        result = compare_artifact_series(names, artifacts)
+        if 'error' in result:
+            return jsonify({'error': result['error']}), 500
+        if str(data.get('sentence_diff', '')).lower() in ('1', 'true'):
+            with stage("sentence_diff"):
+                texts = [report_document_text(report) for report in reports]
+                for i, pair in enumerate(result["pairwise_comparisons"]):
+                    pair["sentence_diff"] = compare_sentences(texts[i], texts[i + 1])
+        
+        result["reports"] = [
+            {
+                "report_id": str(report["_id"]),
+                "patient_id": report.get("patient_id"),
+                "created_at": report["created_at"].isoformat()
+            }
+            for report in reports
+        ]
+        return jsonify(result)
+    
+    except Exception as e:
+        logger.error(f"Error comparing stored reports: {e}")
+        return jsonify({'error': f'Comparison failed: {str(e)}'}), 500
+
+def parse_date_range():
+    """Read the from/to query parameters as datetimes; raises ValueError if malformed"""
+    date_from = datetime.fromisoformat(request.args['from']) if request.args.get('from') else None
+    date_to = datetime.fromisoformat(request.args['to']) if request.args.get('to') else None
+    return date_from, date_to
+
+def use_summaries_requested():
+    """Dashboards read the summary collections unless source=reports asks for a live aggregation"""
+    return REPORT_SUMMARIES_ENABLED and request.args.get('source', 'summaries') != 'reports'
+
+@app.route('/api/patients', methods=['GET'])
+def get_patients():
+    """
+    List patients by most recent report
+    
+    Query Parameters:
+    - search: Only patients whose ID starts with this value
+    - limit: Maximum number of patients to return (default: 50, max: 200)
+    - skip: Number of patients to skip (default: 0)
+    - source: summaries (default) or reports to aggregate patient_reports directly
+    """
+    if db is None:
+        return jsonify({"error": "Database connection is not available"}), 500
+    
+    try:
+        limit = min(int(request.args.get('limit', 50)), MAX_PATIENT_PAGE_SIZE)
+        skip = int(request.args.get('skip', 0))
+    except ValueError:
+        return jsonify({"error": "Invalid limit or skip parameters"}), 400
+    if limit < 1 or skip < 0:
+        return jsonify({"error": "limit must be at least 1 and skip must not be negative"}), 400
+    
+    try:
+        patients, total = list_patients(
+            db, request.args.get('search', '').strip() or None, limit, skip,
+            use_summaries=use_summaries_requested()
+        )
+        for patient in patients:
+            for field in ('first_report_at', 'last_report_at'):
+                if patient.get(field):
+                    patient[field] = patient[field].isoformat()
+            if patient.get('last_report_id'):
+                patient['last_report_id'] = str(patient['last_report_id'])
+        
+        return jsonify({
+            "patients": patients,
+            "total": total,
+            "limit": limit,
+            "skip": skip
+        })
+    
+    except Exception as e:
+        logging.error(f"Error listing patients: {e}")
+        return jsonify({"error": f"Failed to list patients: {str(e)}"}), 500
+
+@app.route('/api/stats/anomaly-rate', methods=['GET'])
+def get_anomaly_rate():
+    """
+    Anomaly rate per period
+    
+    Query Parameters:
+    - period: day, week (ISO week) or month (default: month)
+    - from / to: ISO date range (from inclusive, to exclusive)
+    - scan_type: Only reports of this scan type
+    - patient_id: Only this patient's reports
+    - source: summaries (default) or reports to aggregate patient_reports directly
+    """
+    if db is None:
+        return jsonify({"error": "Database connection is not available"}), 500
+    
+    try:
+        date_from, date_to = parse_date_range()
+        periods = anomaly_rate(
+            db,
+            request.args.get('period', 'month'),
+            date_from,
+            date_to,
+            scan_type=request.args.get('scan_type') or None,
+            patient_id=request.args.get('patient_id') or None,
+            use_summaries=use_summaries_requested()
+        )
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    except Exception as e:
+        logging.error(f"Error computing anomaly rate: {e}")
+        return jsonify({"error": f"Failed to compute anomaly rate: {str(e)}"}), 500
+    
+    return jsonify({"period": request.args.get('period', 'month'), "periods": periods})
+
+@app.route('/api/stats/scan-types', methods=['GET'])
+def get_scan_type_distribution():
+    """
+    Report counts per scan type
+    
+    Query Parameters:
+    - from / to: ISO date range (from inclusive, to exclusive)
+    - patient_id: Only this patient's reports
+    - source: summaries (default) or reports to aggregate patient_reports directly
+    """
+    if db is None:
+        return jsonify({"error": "Database connection is not available"}), 500
+    
+    try:
+        date_from, date_to = parse_date_range()
+        distribution = scan_type_distribution(
+            db, date_from, date_to,
+            patient_id=request.args.get('patient_id') or None,
+            use_summaries=use_summaries_requested()
+        )
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    except Exception as e:
+        logging.error(f"Error computing scan type distribution: {e}")
+        return jsonify({"error": f"Failed to compute scan type distribution: {str(e)}"}), 500
+    
+    return jsonify({"scan_types": distribution})
+
+@app.route('/api/admin/summaries/rebuild', methods=['POST'])
+def rebuild_report_summaries():
+    """Recompute the dashboard summary collections from patient_reports"""
+    if db is None:
+        return jsonify({"error": "Database connection is not available"}), 500
+    
+    try:
+        return jsonify(rebuild_summaries(db))
+    except Exception as e:
+        logging.error(f"Error rebuilding report summaries: {e}")
+        return jsonify({"error": f"Failed to rebuild report summaries: {str(e)}"}), 500
+
+@app.route('/api/admin/scans/prune-cache', methods=['POST'])
+def prune_scan_caches():
+    """
+    Clear the caches of scans whose cached files are all older than max_age_days
+    
+    Expected JSON body:
+    - max_age_days: Age in days (default: 30)
+    """
+    data = request.get_json(silent=True) or {}
+    try:
+        max_age_days = float(data.get('max_age_days', 30))
+    except (TypeError, ValueError):
+        return jsonify({"error": "Invalid max_age_days parameter"}), 400
+    if not max_age_days >= 0:
+        return jsonify({"error": "max_age_days must not be negative"}), 400
+    
+    try:
+        return jsonify(scan_store.prune_caches(max_age_days * 86400))
+    except Exception as e:
+        logging.error(f"Error pruning scan caches: {e}")
+        return jsonify({"error": f"Failed to prune scan caches: {str(e)}"}), 500
+
+@app.route('/api/admin/profiles/slow', methods=['GET'])
+def list_slow_requests():
+    """
+    List recent profiled requests that exceeded PROFILE_SLOW_MS, newest first
+    
+    Query Parameters:
+    - min_ms: Only return requests slower than this (default: 0)
+    """
+    try:
+        min_ms = float(request.args.get('min_ms', 0))
+    except ValueError:
+        return jsonify({"error": "Invalid min_ms parameter"}), 400
+    
+    return jsonify({"requests": slow_requests(min_ms)})
+
 @app.route('/api/health', methods=['GET'])
 def health_check():
     # Extend health check to include MongoDB connection status
@@ -291,6 +1468,16 @@ def health_check():
     
     # Add MongoDB status
     health_status["mongodb_connected"] = db is not None
+    health_status["similar_index"] = similar_index.stats()
+    if compare_pool is not None:
+        health_status["compare_pool"] = compare_pool.stats()
+    if report_writer is not None:
+        health_status["write_behind"] = report_writer.stats()
+    health_status["slice_cache"] = slice_server.stats()
+    if admission is not None:
+        health_status["admission"] = admission.stats()
+    health_status["report_condensing"] = condensing_stats()
+    health_status["model_calls"] = model_caller.stats()
     
     return jsonify(health_status)
 
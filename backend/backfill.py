@@ -0,0 +1,243 @@
+# backfill.py
+# Resumable backfill of analysis artifacts (entities, recovery signals, embedding) for stored reports
+#
+# Reports stored before a new artifact version shipped get their artifacts lazily,
+# on first comparison, which makes those first queries slow. This job computes them
+# for the whole collection ahead of time:
+#   - reports are read in _id order, one page per query, so the job can stop and resume anywhere
+#   - pages are embedded in batches in a process pool, several pages in flight at once
+#   - results are written back with one unordered bulk_write per page
+#   - the last fully written _id is checkpointed to a file after every page
+#   - a docs/s cap and a write-latency brake keep the load on the live database bounded
+#
+# Usage (from the backend directory):
+#   python backfill.py                            # resume from the checkpoint, if any
+#   python backfill.py --workers 4 --max-rate 200
+#   python backfill.py --restart --dry-run
+
+import os
+import json
+import time
+import logging
+import argparse
+import multiprocessing
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, Any, List, Optional
+from bson.objectid import ObjectId
+from pymongo import MongoClient, UpdateOne
+
+# Configure logging
+logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(message)s')
+logger = logging.getLogger(__name__)
+
+# Configuration
+MONGO_URI = os.environ.get('MONGO_URI', 'mongodb://localhost:27017/')
+MONGO_DB = os.environ.get('MONGO_DB', 'mediscan_db')
+BACKFILL_CHECKPOINT = os.environ.get(
+    'BACKFILL_CHECKPOINT',
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), 'journal', 'backfill_checkpoint.json')
+)
+BACKFILL_BATCH_SIZE = 256  # Reports per read, embedding batch and bulk write
+BACKFILL_WORKERS = max(1, (os.cpu_count() or 2) // 2)
+PROGRESS_INTERVAL = 10  # Seconds between progress lines
+WRITE_LATENCY_TARGET = 0.5  # Seconds per bulk write above which the job slows down
+
+# Fields report_document_text needs
+REPORT_TEXT_PROJECTION = {
+    "report_text": 1,
+    "analysis_result.anomaly_detection.analysis": 1,
+    "analysis_result.report_analysis.report_analysis": 1
+}
+
+
+def _init_worker():
+    """Load the sentence transformer model once per worker"""
+    import compare
+    compare.vectorize_document("warm up")
+
+
+def compute_artifacts(texts: List[str]) -> List[Dict[str, Any]]:
+    """Artifacts for a batch of report texts, with one model call for all embeddings"""
+    from compare import build_document_artifacts, vectorize_documents
+    embeddings = vectorize_documents(texts)
+    return [build_document_artifacts(text, embedding) for text, embedding in zip(texts, embeddings)]
+
+
+def load_checkpoint(path: str) -> Dict[str, Any]:
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+
+def save_checkpoint(path: str, checkpoint: Dict[str, Any]):
+    """Write the checkpoint atomically, so an interruption never leaves a torn file"""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(checkpoint, f)
+    os.replace(tmp_path, path)
+
+
+def format_duration(seconds: float) -> str:
+    seconds = int(seconds)
+    return f"{seconds // 3600}h{seconds % 3600 // 60:02d}m{seconds % 60:02d}s"
+
+
+class Backfill:
+    """Reads pages of reports needing artifacts, computes them in a pool and writes them back"""
+
+    def __init__(self, collection, checkpoint_path: str = BACKFILL_CHECKPOINT,
+                 batch_size: int = BACKFILL_BATCH_SIZE, workers: int = BACKFILL_WORKERS,
+                 max_rate: Optional[float] = None, dry_run: bool = False, restart: bool = False):
+        from compare import ARTIFACT_VERSION
+        self.collection = collection
+        self.checkpoint_path = checkpoint_path
+        self.batch_size = batch_size
+        self.workers = workers
+        self.max_rate = max_rate
+        self.dry_run = dry_run
+        # Missing artifacts match too, since a missing field is "not equal"
+        self.query = {"analysis_artifacts.version": {"$ne": ARTIFACT_VERSION}}
+        # With restart the saved checkpoint is ignored, not deleted, so a dry run leaves it intact
+        self.checkpoint = {} if restart else load_checkpoint(checkpoint_path)
+        if self.checkpoint.get("artifact_version") != ARTIFACT_VERSION:
+            # A new artifact version (or a restart) needs a full pass
+            self.checkpoint = {"artifact_version": ARTIFACT_VERSION, "last_id": None, "processed": 0, "updated": 0}
+        self._started = None
+        self._processed = 0
+        self._last_progress = 0.0
+
+    def _pages(self):
+        """Pages of reports after the checkpoint, in _id order; each page is a fresh query"""
+        last_id = ObjectId(self.checkpoint["last_id"]) if self.checkpoint["last_id"] else None
+        while True:
+            query = dict(self.query)
+            if last_id is not None:
+                query["_id"] = {"$gt": last_id}
+            page = list(self.collection.find(query, REPORT_TEXT_PROJECTION)
+                        .sort("_id", 1).limit(self.batch_size))
+            if not page:
+                return
+            last_id = page[-1]["_id"]
+            yield page
+
+    def _write(self, page: List[Dict[str, Any]], artifacts: List[Dict[str, Any]]) -> float:
+        """Persist a page's artifacts; returns the seconds the write took"""
+        if self.dry_run:
+            return 0.0
+        # Guard on the version so a report updated by the live service meanwhile is not overwritten
+        updates = [
+            UpdateOne({"_id": doc["_id"], **self.query}, {"$set": {"analysis_artifacts": doc_artifacts}})
+            for doc, doc_artifacts in zip(page, artifacts)
+        ]
+        started = time.monotonic()
+        result = self.collection.bulk_write(updates, ordered=False)
+        self.checkpoint["updated"] += result.modified_count
+        return time.monotonic() - started
+
+    def _throttle(self, write_seconds: float):
+        """Sleep to stay under max_rate docs/s, and back off while bulk writes are slow"""
+        if self.max_rate:
+            ahead = self._processed / self.max_rate - (time.monotonic() - self._started)
+            if ahead > 0:
+                time.sleep(ahead)
+        if write_seconds > WRITE_LATENCY_TARGET:
+            # The database is struggling; give it as long again as the write took
+            time.sleep(write_seconds)
+
+    def _report(self, remaining: int):
+        now = time.monotonic()
+        if now - self._last_progress < PROGRESS_INTERVAL:
+            return
+        self._last_progress = now
+        elapsed = now - self._started
+        rate = self._processed / elapsed if elapsed > 0 else 0.0
+        left = max(0, remaining - self._processed)
+        eta = format_duration(left / rate) if rate > 0 else "unknown"
+        logger.info(f"{self._processed}/{remaining} reports ({rate:.1f} docs/s), "
+                    f"{self.checkpoint['updated']} updated in total, ETA {eta}")
+
+    def run(self) -> Dict[str, Any]:
+        query = dict(self.query)
+        if self.checkpoint["last_id"]:
+            query["_id"] = {"$gt": ObjectId(self.checkpoint["last_id"])}
+            logger.info(f"Resuming after report {self.checkpoint['last_id']}")
+        remaining = self.collection.count_documents(query)
+        logger.info(f"{remaining} reports need artifacts")
+
+        from similar_cases import report_document_text
+        executor = None
+        if self.workers > 0:
+            executor = ProcessPoolExecutor(
+                max_workers=self.workers,
+                mp_context=multiprocessing.get_context('spawn'),
+                initializer=_init_worker
+            )
+        self._started = time.monotonic()
+        in_flight = deque()  # (page, future), oldest first, so pages are written and checkpointed in order
+
+        def finish_oldest():
+            page, future = in_flight.popleft()
+            artifacts = future.result() if executor else future
+            write_seconds = self._write(page, artifacts)
+            self._processed += len(page)
+            self.checkpoint["processed"] += len(page)
+            self.checkpoint["last_id"] = str(page[-1]["_id"])
+            if not self.dry_run:
+                save_checkpoint(self.checkpoint_path, self.checkpoint)
+            self._report(remaining)
+            self._throttle(write_seconds)
+
+        try:
+            for page in self._pages():
+                texts = [report_document_text(doc) for doc in page]
+                if executor:
+                    in_flight.append((page, executor.submit(compute_artifacts, texts)))
+                else:
+                    in_flight.append((page, compute_artifacts(texts)))
+                # Keep every worker busy plus one page ready, without reading far ahead
+                while len(in_flight) > self.workers:
+                    finish_oldest()
+            while in_flight:
+                finish_oldest()
+        except KeyboardInterrupt:
+            logger.info(f"Interrupted; rerun to resume after report {self.checkpoint['last_id']}")
+            raise
+        finally:
+            if executor:
+                executor.shutdown(wait=False, cancel_futures=True)
+
+        logger.info(f"Backfill complete: {self._processed} reports in {format_duration(time.monotonic() - self._started)}"
+                    + (" (dry run, nothing written)" if self.dry_run else ""))
+        return self.checkpoint
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Precompute analysis artifacts for stored reports")
+    parser.add_argument('--mongo-uri', default=MONGO_URI)
+    parser.add_argument('--db', default=MONGO_DB)
+    parser.add_argument('--batch-size', type=int, default=BACKFILL_BATCH_SIZE, help="Reports per read and write")
+    parser.add_argument('--workers', type=int, default=BACKFILL_WORKERS, help="Embedding processes (0 = inline)")
+    parser.add_argument('--max-rate', type=float, help="Upper bound on reports per second")
+    parser.add_argument('--checkpoint', default=BACKFILL_CHECKPOINT, help="Progress file used to resume")
+    parser.add_argument('--restart', action='store_true', help="Ignore the checkpoint and start from the first report")
+    parser.add_argument('--dry-run', action='store_true', help="Compute artifacts without writing them")
+    args = parser.parse_args(argv)
+
+    if args.restart and not args.dry_run and os.path.exists(args.checkpoint):
+        os.remove(args.checkpoint)
+    collection = MongoClient(args.mongo_uri)[args.db]["patient_reports"]
+    backfill = Backfill(collection, args.checkpoint, args.batch_size, args.workers, args.max_rate, args.dry_run,
+                        restart=args.restart)
+    try:
+        backfill.run()
+    except KeyboardInterrupt:
+        return 130
+    return 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
@@ -0,0 +1,171 @@
+# corpus.py
+# Synthetic report text and scan files for benchmarks and load tests
+
+import os
+import random
+from typing import Dict, List, Optional
+import numpy as np
+import fitz  # PyMuPDF
+import nibabel as nib
+from PIL import Image
+from pydicom.dataset import FileDataset, FileMetaDataset
+from pydicom.uid import ExplicitVRLittleEndian, generate_uid
+
+# Phrases that the regex extractors in compare.py pick up, grouped by entity category
+ENTITY_PHRASES = {
+    "conditions": [
+        "Patient diagnosed with distal radius fracture",
+        "History of chronic obstructive pulmonary disease",
+        "Presents with suspected infection of the left lower lobe",
+        "Findings are consistent with a benign tumor"
+    ],
+    "treatments": [
+        "Treated with cast immobilization",
+        "Prescribed oral antibiotics",
+        "Administered intravenous contrast",
+        "Physical therapy was recommended after surgery"
+    ],
+    "measurements": [
+        "The lesion measures 12.5 mm in greatest dimension",
+        "Size: 3.2 cm by 2.1 cm",
+        "Effusion volume estimated at 45 ml",
+        "Nodule of 8 mm is again seen"
+    ],
+    "findings": [
+        "Imaging revealed mild cortical thickening",
+        "Noted small pleural effusion",
+        "Alignment is normal",
+        "The previously described opacity is unchanged"
+    ],
+    "recovery_indicators": [
+        "There is early callus formation at the fracture site",
+        "Signs of healing are present with partial recovery",
+        "Healing is at 40% compared to prior",
+        "Decreased pain and increased mobility reported"
+    ]
+}
+
+# Neutral boilerplate sentences with no entities
+FILLER_SENTENCES = [
+    "The study was performed according to the standard departmental protocol",
+    "Comparison is made with the prior examination",
+    "Image quality is adequate for interpretation",
+    "The soft tissues appear within expected limits for age",
+    "Clinical correlation is recommended",
+    "No additional views were obtained at the time of the examination",
+    "The report was dictated by the attending radiologist",
+    "Electronically signed and verified"
+]
+
+
+def generate_report_text(n_sentences: int = 20, entity_density: float = 0.5, seed: Optional[int] = None) -> str:
+    """
+    Generate a synthetic radiology report
+
+    Args:
+        n_sentences: Number of sentences in the report
+        entity_density: Fraction of sentences (0-1) that contain an extractable medical entity
+        seed: Random seed for reproducible corpora
+    """
+    rng = random.Random(seed)
+    categories = list(ENTITY_PHRASES)
+    sentences = []
+    for _ in range(n_sentences):
+        if rng.random() < entity_density:
+            sentences.append(rng.choice(ENTITY_PHRASES[rng.choice(categories)]))
+        else:
+            sentences.append(rng.choice(FILLER_SENTENCES))
+    return "FINDINGS: " + ". ".join(sentences) + "."
+
+
+def generate_report_series(n_reports: int, n_sentences: int = 20, entity_density: float = 0.5,
+                           seed: int = 0) -> List[str]:
+    """Generate a series of follow-up reports for one synthetic patient"""
+    return [generate_report_text(n_sentences, entity_density, seed + i) for i in range(n_reports)]
+
+
+def write_pdf(path: str, text: str, chars_per_page: int = 3000) -> str:
+    """Write text into a PDF, splitting it across pages"""
+    with fitz.open() as doc:
+        for start in range(0, max(len(text), 1), chars_per_page):
+            page = doc.new_page()
+            page.insert_textbox(fitz.Rect(36, 36, 576, 806), text[start:start + chars_per_page], fontsize=9)
+        doc.save(path)
+    return path
+
+
+def synthetic_image(rows: int, cols: int, seed: int = 0, dtype=np.uint16, max_value: int = 4095) -> np.ndarray:
+    """A smooth elliptical 'anatomy' blob with noise, so encoders see realistic entropy"""
+    rng = np.random.default_rng(seed)
+    y, x = np.mgrid[0:rows, 0:cols]
+    blob = 1.0 - ((x - cols / 2) / (cols / 2.5)) ** 2 - ((y - rows / 2) / (rows / 2.2)) ** 2
+    image = np.clip(blob, 0, 1) * 0.8 + rng.random((rows, cols)) * 0.2
+    return (image * max_value).astype(dtype)
+
+
+def write_png(path: str, size: int = 512, seed: int = 0) -> str:
+    Image.fromarray(synthetic_image(size, size, seed, np.uint8, 255)).save(path)
+    return path
+
+
+def write_dicom(path: str, rows: int = 512, cols: int = 512, frames: int = 1,
+                modality: str = 'CT', seed: int = 0) -> str:
+    """Write a single-frame or multi-frame 16-bit DICOM file"""
+    file_meta = FileMetaDataset()
+    file_meta.MediaStorageSOPClassUID = '1.2.840.10008.5.1.4.1.1.2'  # CT Image Storage
+    file_meta.MediaStorageSOPInstanceUID = generate_uid()
+    file_meta.TransferSyntaxUID = ExplicitVRLittleEndian
+
+    ds = FileDataset(path, {}, file_meta=file_meta, preamble=b"\0" * 128)
+    ds.SOPClassUID = file_meta.MediaStorageSOPClassUID
+    ds.SOPInstanceUID = file_meta.MediaStorageSOPInstanceUID
+    ds.Modality = modality
+    ds.PatientID = 'BENCHMARK'
+    ds.Rows = rows
+    ds.Columns = cols
+    ds.SamplesPerPixel = 1
+    ds.PhotometricInterpretation = 'MONOCHROME2'
+    ds.BitsAllocated = 16
+    ds.BitsStored = 12
+    ds.HighBit = 11
+    ds.PixelRepresentation = 0
+
+    pixels = np.stack([synthetic_image(rows, cols, seed + i) for i in range(frames)])
+    if frames > 1:
+        ds.NumberOfFrames = frames
+    else:
+        pixels = pixels[0]
+    ds.PixelData = pixels.tobytes()
+    ds.save_as(path, enforce_file_format=True)
+    return path
+
+
+def write_nifti(path: str, shape=(256, 256, 128), seed: int = 0) -> str:
+    """Write a NIfTI volume; use a .nii.gz path for a compressed file"""
+    volume = np.stack([synthetic_image(shape[0], shape[1], seed + i, np.int16, 2000) for i in range(shape[2])], axis=-1)
+    nib.save(nib.Nifti1Image(volume, affine=np.eye(4)), path)
+    return path
+
+
+def build_corpus(out_dir: str, quick: bool = False, seed: int = 0) -> Dict[str, str]:
+    """
+    Write one of each benchmark input to out_dir and return their paths by name
+
+    quick=True uses smaller images and volumes.
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    size = 256 if quick else 512
+    frames = 8 if quick else 32
+    depth = 32 if quick else 128
+
+    paths = {}
+    short_text = generate_report_text(20, 0.5, seed)
+    long_text = generate_report_text(400, 0.5, seed + 1)
+    paths['pdf_short'] = write_pdf(os.path.join(out_dir, 'report_short.pdf'), short_text)
+    paths['pdf_long'] = write_pdf(os.path.join(out_dir, 'report_long.pdf'), long_text)
+    paths['png'] = write_png(os.path.join(out_dir, 'scan.png'), size, seed)
+    paths['dicom_single'] = write_dicom(os.path.join(out_dir, 'scan_single.dcm'), size, size, 1, seed=seed)
+    paths['dicom_multiframe'] = write_dicom(os.path.join(out_dir, 'scan_multi.dcm'), size, size, frames, seed=seed)
+    paths['nifti'] = write_nifti(os.path.join(out_dir, 'volume.nii'), (size, size, depth), seed)
+    paths['nifti_gz'] = write_nifti(os.path.join(out_dir, 'volume.nii.gz'), (size, size, depth), seed)
+    return paths
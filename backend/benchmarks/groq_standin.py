@@ -0,0 +1,295 @@
+# groq_standin.py
+# Local stand-in for the Groq chat completions API, for load tests that must not spend provider quota
+#
+# Point the backend at it with GROQ_BASE_URL=http://127.0.0.1:8900 (any GROQ_API_KEY works).
+# Three modes:
+#   synthetic  canned answers in the format each prompt asks for, with a configurable
+#              latency distribution, error rate and streaming
+#   record     forwards every request to the real API (--upstream) and saves the
+#              response and its latency under --recordings
+#   replay     answers from --recordings only, with the recorded latency (or --latency),
+#              so a run is repeatable offline; unknown requests get a 404
+#
+# Usage (from the backend directory):
+#   python -m benchmarks.groq_standin --latency lognormal:800,0.5 --error-rate 0.01
+#   GROQ_API_KEY=gsk_... python -m benchmarks.groq_standin --mode record --recordings recordings/
+#   python -m benchmarks.groq_standin --mode replay --recordings recordings/
+
+import os
+import json
+import time
+import uuid
+import random
+import hashlib
+import argparse
+import threading
+import urllib.error
+import urllib.request
+from typing import Dict, Any, Optional, Callable
+from flask import Flask, request, jsonify, Response
+
+CHAT_COMPLETIONS_PATH = '/openai/v1/chat/completions'
+DEFAULT_UPSTREAM = 'https://api.groq.com'
+CHARS_PER_TOKEN = 4
+STREAM_CHUNK_CHARS = 16  # Characters per streamed delta
+
+# Canned answers, matched against the prompt text in order
+SYNTHETIC_ANSWERS = [
+    ("What type of medical scan", "X-ray"),
+    ("Analyze this medical scan for anomalies", (
+        "ANOMALY: YES\n"
+        "The scan shows a transverse fracture of the distal radius with mild dorsal angulation. "
+        "Surrounding soft tissue swelling is present.\n"
+        "FINDINGS:\n"
+        "1. Fracture: Transverse fracture of the distal radius, approximately 2 cm proximal to the articular surface "
+        "(confidence: high)\n"
+        "2. Soft tissue: Mild swelling over the dorsal wrist (confidence: medium)"
+    )),
+    ("Analyze this medical report", (
+        "SUMMARY: Healing distal radius fracture with early callus formation.\n"
+        "KEY FINDINGS:\n"
+        "- Distal radius fracture in near-anatomic alignment\n"
+        "- Early callus formation\n"
+        "- No new fracture or dislocation"
+    ))
+]
+DEFAULT_ANSWER = "OK"
+
+
+def parse_latency(spec: str) -> Callable[[], float]:
+    """
+    A latency sampler in seconds from "fixed:MS", "uniform:MIN_MS,MAX_MS",
+    "lognormal:MEDIAN_MS,SIGMA" or "pareto:MIN_MS,ALPHA" (heavy tail)
+    """
+    kind, _, params = spec.partition(':')
+    values = [float(value) for value in params.split(',')] if params else []
+    try:
+        if kind == 'fixed':
+            return lambda: values[0] / 1000
+        if kind == 'uniform':
+            return lambda: random.uniform(values[0], values[1]) / 1000
+        if kind == 'lognormal':
+            median, sigma = values
+            return lambda: random.lognormvariate(0, sigma) * median / 1000
+        if kind == 'pareto':
+            minimum, alpha = values
+            return lambda: random.paretovariate(alpha) * minimum / 1000
+    except (IndexError, ValueError):
+        pass
+    raise argparse.ArgumentTypeError(f"Invalid latency '{spec}'")
+
+
+def prompt_text(body: Dict[str, Any]) -> str:
+    """All text parts of the request's messages"""
+    parts = []
+    for message in body.get('messages', []):
+        content = message.get('content')
+        if isinstance(content, str):
+            parts.append(content)
+        elif isinstance(content, list):
+            parts.extend(part.get('text', '') for part in content if part.get('type') == 'text')
+    return '\n'.join(parts)
+
+
+def request_key(body: Dict[str, Any]) -> str:
+    """Recording key: the request without `stream`, since a recording can be served either way"""
+    canonical = {name: value for name, value in body.items() if name != 'stream'}
+    return hashlib.sha256(json.dumps(canonical, sort_keys=True).encode()).hexdigest()
+
+
+def estimate_tokens(body: Dict[str, Any]) -> int:
+    """Rough prompt size; image parts count by their encoded length"""
+    size = 0
+    for message in body.get('messages', []):
+        content = message.get('content')
+        if isinstance(content, str):
+            size += len(content)
+        elif isinstance(content, list):
+            for part in content:
+                size += len(part.get('text', '')) + len((part.get('image_url') or {}).get('url', '')) // 100
+    return max(1, size // CHARS_PER_TOKEN)
+
+
+def completion_response(body: Dict[str, Any], content: str) -> Dict[str, Any]:
+    prompt_tokens = estimate_tokens(body)
+    completion_tokens = max(1, len(content) // CHARS_PER_TOKEN)
+    return {
+        "id": f"chatcmpl-{uuid.uuid4().hex[:24]}",
+        "object": "chat.completion",
+        "created": int(time.time()),
+        "model": body.get('model', 'standin'),
+        "choices": [{
+            "index": 0,
+            "message": {"role": "assistant", "content": content},
+            "logprobs": None,
+            "finish_reason": "stop"
+        }],
+        "usage": {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "total_tokens": prompt_tokens + completion_tokens
+        },
+        "system_fingerprint": "standin"
+    }
+
+
+def stream_chunks(completion: Dict[str, Any], chunk_delay: float):
+    """Server-sent events for a completion, as the API sends them with stream=True"""
+    content = completion["choices"][0]["message"]["content"]
+
+    def chunk(delta: Dict[str, Any], finish_reason: Optional[str] = None, usage: Optional[Dict] = None) -> str:
+        event = {
+            "id": completion["id"],
+            "object": "chat.completion.chunk",
+            "created": completion["created"],
+            "model": completion["model"],
+            "choices": [{"index": 0, "delta": delta, "logprobs": None, "finish_reason": finish_reason}]
+        }
+        if usage is not None:
+            event["x_groq"] = {"id": completion["id"], "usage": usage}
+        return f"data: {json.dumps(event)}\n\n"
+
+    yield chunk({"role": "assistant", "content": ""})
+    for start in range(0, len(content), STREAM_CHUNK_CHARS):
+        if chunk_delay:
+            time.sleep(chunk_delay)
+        yield chunk({"content": content[start:start + STREAM_CHUNK_CHARS]})
+    yield chunk({}, "stop", completion.get("usage"))
+    yield "data: [DONE]\n\n"
+
+
+class RecordingStore:
+    """Recorded responses, one JSON file per request key"""
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        self._lock = threading.Lock()
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, f"{key}.json")
+
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        try:
+            with open(self._path(key)) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+
+    def put(self, key: str, recording: Dict[str, Any]):
+        temp_path = self._path(key) + f".{uuid.uuid4().hex}.tmp"
+        with open(temp_path, 'w') as f:
+            json.dump(recording, f)
+        with self._lock:
+            os.replace(temp_path, self._path(key))
+
+
+def create_app(mode: str = 'synthetic', latency: Optional[Callable[[], float]] = None, error_rate: float = 0.0,
+               stream_chunk_ms: float = 20, recordings: Optional[str] = None,
+               upstream: str = DEFAULT_UPSTREAM, api_key: Optional[str] = None) -> Flask:
+    app = Flask(__name__)
+    store = RecordingStore(recordings) if recordings else None
+    counters = {"requests": 0, "errors_injected": 0, "recorded": 0, "replayed": 0, "replay_misses": 0}
+    counters_lock = threading.Lock()
+
+    def count(name: str):
+        with counters_lock:
+            counters[name] += 1
+
+    def forward(body: Dict[str, Any]) -> Dict[str, Any]:
+        # Recorded without streaming; replay streams it if asked
+        upstream_request = urllib.request.Request(
+            upstream.rstrip('/') + CHAT_COMPLETIONS_PATH,
+            data=json.dumps(dict(body, stream=False)).encode(),
+            headers={'Content-Type': 'application/json', 'Authorization': f"Bearer {api_key}"},
+            method='POST'
+        )
+        with urllib.request.urlopen(upstream_request, timeout=300) as response:
+            return json.loads(response.read())
+
+    @app.route(CHAT_COMPLETIONS_PATH, methods=['POST'])
+    def chat_completions():
+        count("requests")
+        body = request.get_json(silent=True)
+        if not isinstance(body, dict) or not body.get('messages'):
+            return jsonify({'error': {'message': "'messages' is required", 'type': 'invalid_request_error'}}), 400
+
+        if mode == 'record':
+            key = request_key(body)
+            started = time.monotonic()
+            try:
+                completion = forward(body)
+            except urllib.error.HTTPError as e:
+                return Response(e.read(), status=e.code, content_type='application/json')
+            store.put(key, {
+                "request": {"model": body.get('model'), "prompt": prompt_text(body)[:500]},
+                "response": completion,
+                "latency_ms": round((time.monotonic() - started) * 1000, 1)
+            })
+            count("recorded")
+        elif mode == 'replay':
+            recording = store.get(request_key(body))
+            if recording is None:
+                count("replay_misses")
+                return jsonify({'error': {'message': "No recording for this request",
+                                          'type': 'not_found_error'}}), 404
+            completion = dict(recording["response"], created=int(time.time()))
+            time.sleep(latency() if latency else recording.get("latency_ms", 0) / 1000)
+            count("replayed")
+        else:
+            time.sleep(latency() if latency else 0)
+            if random.random() < error_rate:
+                count("errors_injected")
+                status = random.choice([429, 500, 503])
+                response = jsonify({'error': {'message': f"Injected error ({status})", 'type': 'standin_error'}})
+                if status == 429:
+                    response.headers['Retry-After'] = '1'
+                return response, status
+            text = prompt_text(body)
+            content = next((answer for marker, answer in SYNTHETIC_ANSWERS if marker in text), DEFAULT_ANSWER)
+            completion = completion_response(body, content)
+
+        if body.get('stream'):
+            return Response(stream_chunks(completion, stream_chunk_ms / 1000), content_type='text/event-stream')
+        return jsonify(completion)
+
+    @app.route('/stats', methods=['GET'])
+    def stats():
+        with counters_lock:
+            return jsonify({"mode": mode, **counters})
+
+    return app
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Local stand-in for the Groq chat completions API")
+    parser.add_argument('--mode', default='synthetic', choices=['synthetic', 'record', 'replay'])
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8900)
+    parser.add_argument('--latency', type=parse_latency,
+                        help="fixed:MS, uniform:MIN,MAX, lognormal:MEDIAN,SIGMA or pareto:MIN,ALPHA "
+                             "(default: none for synthetic, the recorded latency for replay)")
+    parser.add_argument('--error-rate', type=float, default=0.0, help="Fraction of synthetic requests that fail")
+    parser.add_argument('--stream-chunk-ms', type=float, default=20, help="Delay between streamed chunks")
+    parser.add_argument('--recordings', help="Directory of recorded responses (record and replay modes)")
+    parser.add_argument('--upstream', default=DEFAULT_UPSTREAM, help="API to record from")
+    parser.add_argument('--seed', type=int, help="Seed for latency and error sampling")
+    args = parser.parse_args(argv)
+
+    if args.mode != 'synthetic' and not args.recordings:
+        parser.error(f"--recordings is required in {args.mode} mode")
+    api_key = os.environ.get('GROQ_API_KEY')
+    if args.mode == 'record' and not api_key:
+        parser.error("GROQ_API_KEY must be set to record from the real API")
+    if args.seed is not None:
+        random.seed(args.seed)
+
+    app = create_app(args.mode, args.latency, args.error_rate, args.stream_chunk_ms,
+                     args.recordings, args.upstream, api_key)
+    print(f"Groq stand-in ({args.mode}) on http://{args.host}:{args.port}; "
+          f"set GROQ_BASE_URL=http://{args.host}:{args.port}")
+    app.run(host=args.host, port=args.port, threaded=True)
+
+
+if __name__ == '__main__':
+    main()
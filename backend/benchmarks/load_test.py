@@ -0,0 +1,361 @@
+# load_test.py
+# HTTP load test for a running server, and worker-scaling runs under gunicorn
+#
+# Clients are closed-loop (--concurrency) or open-loop at a fixed arrival rate (--rps).
+# The analyze scenario calls the model provider for every request; --standin starts
+# benchmarks.groq_standin and points the servers started by --scale at it.
+#
+# Usage (from the backend directory):
+#   python -m benchmarks.load_test --url http://localhost:5000 --concurrency 16 --duration 30
+#   python -m benchmarks.load_test --scale 1,2,4,8 --worker-class gthread --output scaling.json
+#   python -m benchmarks.load_test --scenario analyze --scale 4 --standin --rps 20 --duration 60
+
+import os
+import sys
+import json
+import time
+import uuid
+import signal
+import argparse
+import platform
+import itertools
+import threading
+import subprocess
+import urllib.error
+import urllib.request
+from io import BytesIO
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Any, List, Optional, Callable, Tuple, Union
+import numpy as np
+from PIL import Image
+
+from benchmarks.corpus import generate_report_series, synthetic_image
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+# A request body: JSON, or an already encoded (bytes, content type) pair
+Body = Union[Dict[str, Any], Tuple[bytes, str], None]
+
+
+def multipart_body(fields: Dict[str, str], files: Dict[str, Tuple[str, bytes, str]]) -> Tuple[bytes, str]:
+    """Encode form fields and files ({name: (filename, data, content type)}) as multipart/form-data"""
+    boundary = uuid.uuid4().hex
+    parts = []
+    for name, value in fields.items():
+        parts.append(f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"\r\n\r\n{value}\r\n'.encode())
+    for name, (filename, data, content_type) in files.items():
+        parts.append(f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"; filename="{filename}"\r\n'
+                     f'Content-Type: {content_type}\r\n\r\n'.encode() + data + b'\r\n')
+    parts.append(f'--{boundary}--\r\n'.encode())
+    return b''.join(parts), f'multipart/form-data; boundary={boundary}'
+
+
+def build_scenarios(n_sentences: int) -> Dict[str, Callable[[int], Tuple[str, str, Body]]]:
+    """Request factories by scenario name; each takes the request number and returns (method, path, body)"""
+    series = generate_report_series(8, n_sentences, 0.6, seed=11)
+    # A few fixed scans, so the stand-in's recordings are reused from run to run
+    scans = []
+    for seed in range(4):
+        buffer = BytesIO()
+        Image.fromarray(synthetic_image(256, 256, seed, np.uint8, 255)).save(buffer, format='PNG')
+        scans.append(buffer.getvalue())
+
+    def compare(i: int):
+        # Rotate through report pairs so every request does real embedding work
+        docs = [{'name': f'report_{j}', 'content': series[(i + j) % len(series)]} for j in range(2)]
+        return 'POST', '/api/compare', {'docs': docs}
+
+    def health(_i: int):
+        return 'GET', '/api/health', None
+
+    def similar(i: int):
+        return 'POST', '/api/reports/similar', {'report_text': series[i % len(series)], 'top_k': 10}
+
+    def analyze(i: int):
+        fields = {'patient_id': f'loadtest-{i % 16}', 'report_text': series[i % len(series)]}
+        files = {'scan': (f'scan_{i % len(scans)}.png', scans[i % len(scans)], 'image/png')}
+        return 'POST', '/api/analyze', multipart_body(fields, files)
+
+    return {'compare': compare, 'health': health, 'similar': similar, 'analyze': analyze}
+
+
+def send_request(base_url: str, method: str, path: str, body: Body, timeout: float) -> str:
+    """Send one request and return its status code, or the exception name if it failed"""
+    if isinstance(body, dict):
+        data, headers = json.dumps(body).encode(), {'Content-Type': 'application/json'}
+    elif body is not None:
+        data, headers = body[0], {'Content-Type': body[1]}
+    else:
+        data, headers = None, {}
+    request = urllib.request.Request(base_url + path, data=data, headers=headers, method=method)
+    try:
+        with urllib.request.urlopen(request, timeout=timeout) as response:
+            response.read()
+            return str(response.status)
+    except urllib.error.HTTPError as e:
+        return str(e.code)
+    except Exception as e:
+        return type(e).__name__
+
+
+def summarize(latencies: List[float], statuses: Dict[str, int], elapsed: float) -> Dict[str, Any]:
+    result = {
+        "duration_s": round(elapsed, 2),
+        "requests": sum(statuses.values()),
+        "statuses": statuses,
+        "throughput_per_s": round(len(latencies) / elapsed, 3)
+    }
+    if latencies:
+        values = np.asarray(latencies)
+        result["latency_ms"] = {
+            "p50": round(float(np.percentile(values, 50)), 1),
+            "p95": round(float(np.percentile(values, 95)), 1),
+            "p99": round(float(np.percentile(values, 99)), 1),
+            "max": round(float(values.max()), 1)
+        }
+    return result
+
+
+def run_load(base_url: str, make_request: Callable[[int], Tuple[str, str, Body]], concurrency: int,
+             duration: float, timeout: float = 120) -> Dict[str, Any]:
+    """Send requests from `concurrency` closed-loop clients for `duration` seconds"""
+    latencies: List[float] = []
+    statuses: Dict[str, int] = {}
+    lock = threading.Lock()
+    counter = itertools.count()
+    deadline = time.monotonic() + duration
+
+    def client():
+        while time.monotonic() < deadline:
+            method, path, body = make_request(next(counter))
+            started = time.perf_counter()
+            status = send_request(base_url, method, path, body, timeout)
+            elapsed_ms = (time.perf_counter() - started) * 1000
+            with lock:
+                statuses[status] = statuses.get(status, 0) + 1
+                if status == '200':
+                    latencies.append(elapsed_ms)
+
+    started = time.perf_counter()
+    threads = [threading.Thread(target=client, daemon=True) for _ in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+
+    return {"concurrency": concurrency, **summarize(latencies, statuses, elapsed)}
+
+
+def run_rate(base_url: str, make_request: Callable[[int], Tuple[str, str, Body]], rps: float,
+             duration: float, max_in_flight: int = 256, timeout: float = 120) -> Dict[str, Any]:
+    """
+    Send requests at a fixed arrival rate for `duration` seconds (open loop)
+
+    Latency is measured from each request's scheduled send time, so a server that
+    falls behind shows it in the percentiles instead of silently lowering the load.
+    Arrivals while max_in_flight requests are outstanding are counted as "skipped".
+    """
+    latencies: List[float] = []
+    statuses: Dict[str, int] = {}
+    lock = threading.Lock()
+    in_flight = threading.BoundedSemaphore(max_in_flight)
+
+    def issue(i: int, scheduled: float):
+        try:
+            method, path, body = make_request(i)
+            status = send_request(base_url, method, path, body, timeout)
+            elapsed_ms = (time.perf_counter() - scheduled) * 1000
+            with lock:
+                statuses[status] = statuses.get(status, 0) + 1
+                if status == '200':
+                    latencies.append(elapsed_ms)
+        finally:
+            in_flight.release()
+
+    interval = 1.0 / rps
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=max_in_flight) as executor:
+        for i in itertools.count():
+            scheduled = started + i * interval
+            if scheduled - started >= duration:
+                break
+            time.sleep(max(0.0, scheduled - time.perf_counter()))
+            if not in_flight.acquire(blocking=False):
+                with lock:
+                    statuses["skipped"] = statuses.get("skipped", 0) + 1
+                continue
+            executor.submit(issue, i, scheduled)
+    elapsed = time.perf_counter() - started
+
+    return {"target_rps": rps, **summarize(latencies, statuses, elapsed)}
+
+
+def wait_until_ready(base_url: str, timeout: float = 180) -> bool:
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            with urllib.request.urlopen(base_url + '/api/health', timeout=5) as response:
+                if response.status == 200:
+                    return True
+        except Exception:
+            time.sleep(1)
+    return False
+
+
+def start_server(workers: int, worker_class: str, threads: int, port: int,
+                 extra_env: Optional[Dict[str, str]] = None) -> subprocess.Popen:
+    """Launch gunicorn with the production config and the given worker settings"""
+    env = dict(os.environ,
+               MEDVISOR_WORKERS=str(workers),
+               MEDVISOR_WORKER_CLASS=worker_class,
+               MEDVISOR_THREADS=str(threads),
+               MEDVISOR_BIND=f"127.0.0.1:{port}",
+               **(extra_env or {}))
+    return subprocess.Popen(
+        [sys.executable, '-m', 'gunicorn', '-c', 'gunicorn.conf.py', 'app:app'],
+        cwd=BACKEND_DIR, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+        start_new_session=True
+    )
+
+
+def start_standin(port: int, standin_args: List[str]) -> subprocess.Popen:
+    """Launch benchmarks.groq_standin and wait until it answers"""
+    process = subprocess.Popen(
+        [sys.executable, '-m', 'benchmarks.groq_standin', '--port', str(port)] + standin_args,
+        cwd=BACKEND_DIR, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, start_new_session=True
+    )
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        try:
+            with urllib.request.urlopen(f"http://127.0.0.1:{port}/stats", timeout=2):
+                return process
+        except Exception:
+            time.sleep(0.2)
+    stop_server(process)
+    raise RuntimeError("Groq stand-in did not start")
+
+
+def stop_server(process: subprocess.Popen):
+    process.send_signal(signal.SIGTERM)
+    try:
+        process.wait(timeout=60)
+    except subprocess.TimeoutExpired:
+        os.killpg(process.pid, signal.SIGKILL)
+        process.wait()
+
+
+def cpu_model() -> Optional[str]:
+    """Processor name from /proc/cpuinfo (Linux), else whatever platform reports"""
+    try:
+        with open('/proc/cpuinfo') as f:
+            for line in f:
+                if line.startswith('model name'):
+                    return line.split(':', 1)[1].strip()
+    except OSError:
+        pass
+    return platform.processor() or None
+
+
+def print_result(label: str, result: Dict[str, Any]):
+    latency = result.get("latency_ms", {})
+    print(f"{label:<24} {result['throughput_per_s']:>10}/s  p50={latency.get('p50')}ms "
+          f"p95={latency.get('p95')}ms p99={latency.get('p99')}ms statuses={result['statuses']}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Load test the MedVisor API")
+    parser.add_argument('--url', default='http://127.0.0.1:5000', help="Server to test (ignored with --scale)")
+    parser.add_argument('--scenario', default='compare', choices=['compare', 'health', 'similar', 'analyze'])
+    parser.add_argument('--concurrency', type=int, default=16, help="Concurrent closed-loop clients")
+    parser.add_argument('--rps', type=float, help="Open-loop arrival rate instead of closed-loop clients")
+    parser.add_argument('--max-in-flight', type=int, default=256, help="Outstanding requests allowed with --rps")
+    parser.add_argument('--duration', type=float, default=30, help="Seconds of load per run")
+    parser.add_argument('--sentences', type=int, default=40, help="Sentences per synthetic report")
+    parser.add_argument('--scale', help="Comma-separated worker counts; starts gunicorn for each")
+    parser.add_argument('--worker-class', default='gthread', help="gunicorn worker class for --scale")
+    parser.add_argument('--threads', type=int, default=4, help="Threads per worker for --scale")
+    parser.add_argument('--port', type=int, default=5055, help="Port for servers started by --scale")
+    parser.add_argument('--standin', action='store_true',
+                        help="Start benchmarks.groq_standin and point the servers started by --scale at it")
+    parser.add_argument('--standin-port', type=int, default=8900)
+    parser.add_argument('--standin-args', default='--latency lognormal:800,0.5',
+                        help="Arguments for the stand-in, e.g. '--mode replay --recordings recordings/'")
+    parser.add_argument('--output', help="Write results to this JSON file")
+    parser.add_argument('--note', help="Free-form description of the test environment, stored with the results")
+    args = parser.parse_args(argv)
+
+    if args.standin and not args.scale:
+        parser.error("--standin needs --scale; point a running server at the stand-in with GROQ_BASE_URL instead")
+
+    make_request = build_scenarios(args.sentences)[args.scenario]
+    runs = []
+
+    def load(base_url: str, duration: float) -> Dict[str, Any]:
+        if args.rps:
+            return run_rate(base_url, make_request, args.rps, duration, args.max_in_flight)
+        return run_load(base_url, make_request, args.concurrency, duration)
+
+    if args.scale:
+        base_url = f"http://127.0.0.1:{args.port}"
+        server_env = None
+        standin = None
+        if args.standin:
+            standin = start_standin(args.standin_port, args.standin_args.split())
+            server_env = {'GROQ_BASE_URL': f"http://127.0.0.1:{args.standin_port}",
+                          'GROQ_API_KEY': os.environ.get('GROQ_API_KEY', 'standin')}
+        try:
+            for workers in [int(value) for value in args.scale.split(',')]:
+                process = start_server(workers, args.worker_class, args.threads, args.port, server_env)
+                try:
+                    if not wait_until_ready(base_url):
+                        print(f"workers={workers}: server did not become ready")
+                        continue
+                    # Warm up every worker before measuring
+                    load(base_url, min(5.0, args.duration))
+                    result = load(base_url, args.duration)
+                finally:
+                    stop_server(process)
+                result.update(workers=workers, worker_class=args.worker_class, threads=args.threads)
+                runs.append(result)
+                print_result(f"workers={workers}", result)
+        finally:
+            if standin is not None:
+                stop_server(standin)
+
+        if runs and runs[0]["throughput_per_s"]:
+            print(f"\n{'workers':>8} {'throughput/s':>14} {'speedup':>9}")
+            for run in runs:
+                print(f"{run['workers']:>8} {run['throughput_per_s']:>14} "
+                      f"{run['throughput_per_s'] / runs[0]['throughput_per_s']:>8.2f}x")
+    else:
+        result = load(args.url.rstrip('/'), args.duration)
+        runs.append(result)
+        print_result(args.url, result)
+
+    report = {
+        "meta": {
+            "timestamp": time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+            "scenario": args.scenario,
+            "concurrency": args.concurrency,
+            "target_rps": args.rps,
+            "standin": args.standin_args if args.standin else None,
+            "duration_s": args.duration,
+            "cpu_count": os.cpu_count(),
+            "cpu_model": cpu_model(),
+            "platform": platform.platform(),
+            "python": platform.python_version(),
+            "note": args.note
+        },
+        "runs": runs
+    }
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+        print(f"\nWrote results to {args.output}")
+    return report
+
+
+if __name__ == '__main__':
+    main()
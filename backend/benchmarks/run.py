@@ -0,0 +1,302 @@
+# run.py
+# Benchmark suite for the compare and scan pipelines
+#
+# Usage (from the backend directory):
+#   python -m benchmarks.run --output results.json
+#   python -m benchmarks.run --quick --baseline results.json
+#   python -m benchmarks.run --only compare
+#
+# The e2e:/api/analyze case calls the model provider; to run it without one, start
+# benchmarks.groq_standin and set GROQ_API_KEY=standin GROQ_BASE_URL=http://127.0.0.1:8900.
+
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import tempfile
+import subprocess
+from typing import Callable, Dict, List, Any, Optional
+import numpy as np
+
+from benchmarks.corpus import build_corpus, generate_report_text, generate_report_series
+from compare import (
+    extract_text_from_pdf,
+    extract_medical_entities,
+    vectorize_document,
+    compare_medical_documents
+)
+from report_scan import get_image_data_url
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+E2E_CASE_NAMES = ("e2e:/api/compare", "e2e:/api/analyze")
+
+
+def current_rss_mb() -> Optional[float]:
+    """Resident set size of this process now; None where /proc is unavailable"""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * resource.getpagesize() / (1024 * 1024)
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+def reset_peak_rss() -> bool:
+    """Restart the kernel's peak RSS tracking (Linux); False where the peak cannot be reset"""
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return True
+    except OSError:
+        return False
+
+
+def peak_rss_mb() -> Optional[float]:
+    """Peak resident set size since the last reset_peak_rss(), or since the process started (None if unknown)"""
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024
+    except (OSError, ValueError):
+        pass
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS
+    return peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024
+
+
+def record_memory(result: Dict[str, Any], rss_before: Optional[float], peak_is_per_case: bool):
+    """
+    Peak RSS while the benchmark ran, and how far it rose above the RSS it started with
+
+    Where the peak cannot be reset (not Linux) it is the process-wide high-water mark,
+    so it includes every earlier benchmark and rss_delta_mb is left out.
+    """
+    peak = peak_rss_mb()
+    result["peak_rss_mb"] = round(peak, 1) if peak is not None else None
+    result["peak_rss_scope"] = "benchmark" if peak_is_per_case else "process"
+    result["rss_delta_mb"] = (
+        round(peak - rss_before, 1) if peak_is_per_case and peak is not None and rss_before is not None else None
+    )
+
+
+def measure(name: str, func: Callable[[], Any], repeat: int, warmup: int = 1,
+            params: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+    """Time repeated calls of func and summarize latency and throughput"""
+    result = {"name": name, "params": params or {}}
+    rss_before = current_rss_mb()
+    peak_is_per_case = reset_peak_rss()
+    try:
+        for _ in range(warmup):
+            func()
+        latencies = []
+        started = time.perf_counter()
+        for _ in range(repeat):
+            call_started = time.perf_counter()
+            func()
+            latencies.append((time.perf_counter() - call_started) * 1000)
+        elapsed = time.perf_counter() - started
+    except Exception as e:
+        result["error"] = f"{type(e).__name__}: {e}"
+        record_memory(result, rss_before, peak_is_per_case)
+        return result
+
+    latencies = np.asarray(latencies)
+    result.update({
+        "iterations": repeat,
+        "throughput_per_s": round(repeat / elapsed, 3) if elapsed > 0 else None,
+        "latency_ms": {
+            "mean": round(float(latencies.mean()), 3),
+            "p50": round(float(np.percentile(latencies, 50)), 3),
+            "p95": round(float(np.percentile(latencies, 95)), 3),
+            "p99": round(float(np.percentile(latencies, 99)), 3),
+            "max": round(float(latencies.max()), 3)
+        }
+    })
+    record_memory(result, rss_before, peak_is_per_case)
+    return result
+
+
+def benchmark_cases(corpus: Dict[str, str], repeat: int) -> List[tuple]:
+    """Build the list of (name, callable, repeat, params) cases"""
+    short_text = generate_report_text(20, 0.5, seed=1)
+    long_text = generate_report_text(400, 0.5, seed=2)
+    dense_text = generate_report_text(400, 1.0, seed=3)
+    series = generate_report_series(5, 40, 0.6, seed=4)
+
+    with open(corpus['pdf_short'], 'rb') as f:
+        pdf_short_bytes = f.read()
+    with open(corpus['pdf_long'], 'rb') as f:
+        pdf_long_bytes = f.read()
+
+    text_pair = [{'name': f'report_{i}.txt', 'type': 'txt', 'content': text} for i, text in enumerate(series[:2])]
+    text_series = [{'name': f'report_{i}.txt', 'type': 'txt', 'content': text} for i, text in enumerate(series)]
+    pdf_pair = [
+        {'name': 'report_short.pdf', 'type': 'pdf', 'content': pdf_short_bytes},
+        {'name': 'report_long.pdf', 'type': 'pdf', 'content': pdf_long_bytes}
+    ]
+
+    cases = [
+        ("extract_text_from_pdf", lambda: extract_text_from_pdf(corpus['pdf_short']), repeat, {"pdf": "short"}),
+        ("extract_text_from_pdf", lambda: extract_text_from_pdf(corpus['pdf_long']), repeat, {"pdf": "long"}),
+        ("extract_medical_entities", lambda: extract_medical_entities(short_text), repeat * 5, {"sentences": 20, "density": 0.5}),
+        ("extract_medical_entities", lambda: extract_medical_entities(long_text), repeat, {"sentences": 400, "density": 0.5}),
+        ("extract_medical_entities", lambda: extract_medical_entities(dense_text), repeat, {"sentences": 400, "density": 1.0}),
+        ("vectorize_document", lambda: vectorize_document(short_text), repeat, {"sentences": 20}),
+        ("vectorize_document", lambda: vectorize_document(long_text), repeat, {"sentences": 400}),
+        ("compare_medical_documents", lambda: compare_medical_documents(text_pair), repeat, {"docs": 2, "type": "txt"}),
+        ("compare_medical_documents", lambda: compare_medical_documents(text_series), repeat, {"docs": 5, "type": "txt"}),
+        ("compare_medical_documents", lambda: compare_medical_documents(pdf_pair), repeat, {"docs": 2, "type": "pdf"}),
+    ]
+    for key in ('png', 'dicom_single', 'dicom_multiframe', 'nifti', 'nifti_gz'):
+        path = corpus[key]
+        cases.append(("get_image_data_url", lambda path=path: get_image_data_url(path), repeat, {"input": key}))
+    return cases
+
+
+def end_to_end_cases(corpus: Dict[str, str], repeat: int, only: Optional[str] = None) -> List[tuple]:
+    """Full /api/compare and /api/analyze requests through the Flask stack (test client)"""
+    if only and not any(only in name for name in E2E_CASE_NAMES):
+        # Importing app connects to MongoDB and starts the background services
+        return []
+    from app import app
+
+    client = app.test_client()
+    with open(corpus['pdf_short'], 'rb') as f:
+        pdf_short_bytes = f.read()
+    with open(corpus['pdf_long'], 'rb') as f:
+        pdf_long_bytes = f.read()
+    with open(corpus['png'], 'rb') as f:
+        png_bytes = f.read()
+    series = generate_report_series(2, 40, 0.6, seed=5)
+
+    def compare_pdfs():
+        from io import BytesIO
+        response = client.post('/api/compare', data={
+            'doc1': (BytesIO(pdf_short_bytes), 'report_short.pdf'),
+            'doc2': (BytesIO(pdf_long_bytes), 'report_long.pdf')
+        })
+        if response.status_code != 200:
+            raise RuntimeError(f"/api/compare returned {response.status_code}")
+
+    def compare_json():
+        response = client.post('/api/compare', json={
+            'docs': [{'name': f'report_{i}', 'content': text} for i, text in enumerate(series)]
+        })
+        if response.status_code != 200:
+            raise RuntimeError(f"/api/compare returned {response.status_code}")
+
+    def analyze_png():
+        from io import BytesIO
+        response = client.post('/api/analyze', data={
+            'scan': (BytesIO(png_bytes), 'scan.png'),
+            'report_text': series[0],
+            'patient_id': 'benchmark'
+        })
+        if response.status_code != 200:
+            raise RuntimeError(f"/api/analyze returned {response.status_code}")
+
+    return [
+        ("e2e:/api/compare", compare_pdfs, repeat, {"docs": 2, "type": "pdf"}),
+        ("e2e:/api/compare", compare_json, repeat, {"docs": 2, "type": "json"}),
+        ("e2e:/api/analyze", analyze_png, repeat, {"scan": "png", "report": "text"})
+    ]
+
+
+def git_revision() -> Optional[str]:
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], stderr=subprocess.DEVNULL).decode().strip()
+    except Exception:
+        return None
+
+
+def compare_with_baseline(results: List[Dict[str, Any]], baseline: Dict[str, Any]):
+    """Print p50/p95/throughput changes against a previous results file"""
+    def key(entry):
+        return entry["name"], json.dumps(entry["params"], sort_keys=True)
+
+    previous = {key(entry): entry for entry in baseline.get("results", [])}
+    print(f"\n{'benchmark':<60} {'p50 ms':>18} {'p95 ms':>18} {'throughput/s':>20}")
+    for entry in results:
+        old = previous.get(key(entry))
+        if not old or "error" in entry or "error" in old:
+            continue
+
+        def change(new_value, old_value):
+            if not old_value:
+                return f"{new_value:>9}"
+            return f"{new_value:>9} ({(new_value - old_value) / old_value * 100:+.1f}%)"
+
+        label = f"{entry['name']} {json.dumps(entry['params'], sort_keys=True)}"
+        print(f"{label:<60} "
+              f"{change(entry['latency_ms']['p50'], old['latency_ms']['p50']):>18} "
+              f"{change(entry['latency_ms']['p95'], old['latency_ms']['p95']):>18} "
+              f"{change(entry['throughput_per_s'], old['throughput_per_s']):>20}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the MedVisor analysis pipelines")
+    parser.add_argument('--repeat', type=int, default=20, help="Timed iterations per benchmark")
+    parser.add_argument('--quick', action='store_true', help="Smaller inputs and fewer iterations")
+    parser.add_argument('--only', help="Only run benchmarks whose name contains this string")
+    parser.add_argument('--no-e2e', action='store_true', help="Skip the end-to-end Flask benchmarks")
+    parser.add_argument('--corpus-dir', help="Where to write synthetic inputs (default: a temp directory)")
+    parser.add_argument('--output', help="Write machine-readable results to this JSON file")
+    parser.add_argument('--baseline', help="Compare against a previous results JSON file")
+    args = parser.parse_args(argv)
+
+    repeat = max(3, args.repeat // 4) if args.quick else args.repeat
+    corpus_dir = args.corpus_dir or tempfile.mkdtemp(prefix='medvisor-bench-')
+    corpus = build_corpus(corpus_dir, quick=args.quick)
+
+    cases = benchmark_cases(corpus, repeat)
+    if not args.no_e2e:
+        cases += end_to_end_cases(corpus, repeat, args.only)
+    if args.only:
+        cases = [case for case in cases if args.only in case[0]]
+
+    results = []
+    for name, func, case_repeat, params in cases:
+        entry = measure(name, func, case_repeat, params=params)
+        results.append(entry)
+        if "error" in entry:
+            print(f"{name} {params}: ERROR {entry['error']}")
+        else:
+            print(f"{name} {params}: p50={entry['latency_ms']['p50']}ms p95={entry['latency_ms']['p95']}ms "
+                  f"p99={entry['latency_ms']['p99']}ms {entry['throughput_per_s']}/s rss={entry['peak_rss_mb']}MB"
+                  + (f" (+{entry['rss_delta_mb']}MB)" if entry['rss_delta_mb'] is not None else ""))
+
+    report = {
+        "meta": {
+            "timestamp": time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+            "git_revision": git_revision(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+            "quick": args.quick,
+            "repeat": repeat
+        },
+        "results": results
+    }
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+        print(f"\nWrote results to {args.output}")
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            compare_with_baseline(results, json.load(f))
+
+    return report
+
+
+if __name__ == '__main__':
+    main()
@@ -9,7 +9,11 @@ from sklearn.metrics.pairwise import cosine_similarity
 from sentence_transformers import SentenceTransformer
 import logging
 import json
+import hashlib
 import tempfile
+import threading
+from collections import OrderedDict
+from profiling import timed_stage
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
@@ -22,13 +26,33 @@ UPLOAD_FOLDER = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'upload
 # Ensure upload directory exists
 os.makedirs(UPLOAD_FOLDER, exist_ok=True)
 
+# Patterns for explicitly stated recovery percentages
+PERCENTAGE_PATTERNS = [
+    r"(\d+)(?:\s*)%(?:\s*)(healing|recovery|improvement|progress)",
+    r"(healing|recovery|improvement|progress)(?:\s*)(?:is|at)(?:\s*)(\d+)(?:\s*)%"
+]
+
+# Version of the per-report artifacts stored alongside reports
+ARTIFACT_VERSION = 1
+
+# Sentence-level comparison
+SENTENCE_CACHE_SIZE = int(os.environ.get('SENTENCE_CACHE_SIZE', 20000))  # Sentence embeddings kept per process
+SENTENCE_MATCH_SIMILARITY = 0.6  # Aligned sentences must be at least this similar, else they are added/removed
+SENTENCE_UNCHANGED_SIMILARITY = 0.97  # Aligned sentences at least this similar count as unchanged
+SENTENCE_ALIGN_BAND = 32  # Sentences an alignment may drift from the diagonal
+SENTENCE_ALIGN_MAX_BAND = 256  # Cap on the band after widening it by the length difference
+# Terminal punctuation and whitespace before a capital, digit or bracket, whatever the case before it
+SENTENCE_SPLIT_PATTERN = re.compile(r"(?<=[.!?])\s+(?=[A-Z0-9(])")
+
 # Initialize the sentence transformer model (lightweight)
 model = SentenceTransformer('all-MiniLM-L6-v2')  # Small model (~80MB) that runs on CPU
+EMBEDDING_DIM = model.get_sentence_embedding_dimension()
 
 def allowed_file(filename: str) -> bool:
     """Check if the file extension is allowed"""
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
+@timed_stage("pdf_extract")
 def extract_text_from_pdf(pdf_path: str) -> str:
     """Extract text from a PDF file"""
     try:
@@ -59,15 +83,22 @@ def extract_text_from_document(file_path: str) -> str:
     else:
         return ""
 
+@timed_stage("embedding")
 def vectorize_document(text: str) -> np.ndarray:
     """Convert document text to a vector representation"""
     return model.encode([text])[0]
 
+@timed_stage("embedding")
+def vectorize_documents(texts: List[str]) -> np.ndarray:
+    """Convert a batch of document texts to vectors in a single model call"""
+    return model.encode(texts)
+
 def compare_documents(doc1_vector: np.ndarray, doc2_vector: np.ndarray) -> float:
     """Compare two document vectors using cosine similarity"""
     similarity = cosine_similarity([doc1_vector], [doc2_vector])[0][0]
     return float(similarity)
 
+@timed_stage("entity_regex")
 def extract_medical_entities(text: str) -> Dict[str, List[str]]:
     """
     Extract medical entities from text using regex patterns
@@ -217,6 +248,38 @@ def extract_severity_indicators(text: str) -> Dict[str, List[str]]:
     
     return indicators
 
+def extract_explicit_percentages(text: str) -> List[List[List]]:
+    """
+    Extract explicitly stated recovery percentages such as "40% healing"
+    
+    Returns one list of [percentage, indicator] pairs per pattern in PERCENTAGE_PATTERNS
+    """
+    per_pattern = []
+    for pattern in PERCENTAGE_PATTERNS:
+        found = []
+        for match in re.findall(pattern, text):
+            try:
+                # Extract percentage regardless of pattern order
+                if match[0].isdigit():
+                    found.append([int(match[0]), match[1]])
+                else:
+                    found.append([int(match[1]), match[0]])
+            except (ValueError, IndexError):
+                continue
+        per_pattern.append(found)
+    return per_pattern
+
+@timed_stage("recovery_regex")
+def extract_recovery_signals(text: str) -> Dict:
+    """Extract everything estimate_recovery_percentage needs from a single document"""
+    indicators = extract_severity_indicators(text)
+    return {
+        "severity": indicators["severity"],
+        "improvement": indicators["improvement"],
+        "explicit_percentages": extract_explicit_percentages(text),
+        "callus_formation": re.search(r"callus formation", text) is not None
+    }
+
 def estimate_recovery_percentage(old_text: str, new_text: str, changes: Dict) -> Dict:
     """
     Estimate recovery percentage based on textual analysis and entity changes
@@ -224,6 +287,14 @@ def estimate_recovery_percentage(old_text: str, new_text: str, changes: Dict) ->
     This is a more advanced function that analyzes text for recovery indicators
     and provides percentage estimates based on them
     """
+    return estimate_recovery_from_signals(
+        extract_recovery_signals(old_text),
+        extract_recovery_signals(new_text),
+        changes
+    )
+
+def estimate_recovery_from_signals(old_signals: Dict, new_signals: Dict, changes: Dict) -> Dict:
+    """Estimate recovery percentage from signals produced by extract_recovery_signals"""
     recovery_metrics = {
         "overall_recovery_percentage": 0,
         "bone_healing_percentage": 0, 
@@ -231,37 +302,19 @@ def estimate_recovery_percentage(old_text: str, new_text: str, changes: Dict) ->
         "key_indicators": []
     }
     
-    # Extract severity and improvement indicators
-    old_indicators = extract_severity_indicators(old_text)
-    new_indicators = extract_severity_indicators(new_text)
+    # Severity and improvement indicators
+    old_indicators = old_signals
+    new_indicators = new_signals
     
     # Count recovery indicators
     recovery_indicators = changes.get("added", {}).get("recovery_indicators", [])
     n_recovery_indicators = len(recovery_indicators)
     
-    # Look for specific phrases indicating recovery percentages
-    percentage_patterns = [
-        r"(\d+)(?:\s*)%(?:\s*)(healing|recovery|improvement|progress)",
-        r"(healing|recovery|improvement|progress)(?:\s*)(?:is|at)(?:\s*)(\d+)(?:\s*)%"
-    ]
-    
+    # Explicit percentages, pattern by pattern, old document before new
     explicit_percentages = []
-    for pattern in percentage_patterns:
-        for text in [old_text, new_text]:
-            matches = re.findall(pattern, text)
-            for match in matches:
-                try:
-                    # Extract percentage regardless of pattern order
-                    if match[0].isdigit():
-                        percentage = int(match[0])
-                        indicator = match[1]
-                    else:
-                        percentage = int(match[1])
-                        indicator = match[0]
-                    
-                    explicit_percentages.append((percentage, indicator))
-                except (ValueError, IndexError):
-                    continue
+    for old_found, new_found in zip(old_signals["explicit_percentages"], new_signals["explicit_percentages"]):
+        explicit_percentages.extend((percentage, indicator) for percentage, indicator in old_found)
+        explicit_percentages.extend((percentage, indicator) for percentage, indicator in new_found)
     
     # If we found explicit percentages, use them
     if explicit_percentages:
@@ -294,8 +347,7 @@ def estimate_recovery_percentage(old_text: str, new_text: str, changes: Dict) ->
             recovery_metrics["key_indicators"].append("Significant recovery indicators found")
         
         # If we found callus formation specifically (important in bone healing)
-        callus_formation = any(re.search(r"callus formation", text) for text in [new_text])
-        if callus_formation:
+        if new_signals["callus_formation"]:
             improvement_score += 25
             recovery_metrics["bone_healing_percentage"] = 25
             recovery_metrics["key_indicators"].append("Callus formation detected (25% bone healing)")
@@ -343,8 +395,14 @@ def estimate_recovery_percentage(old_text: str, new_text: str, changes: Dict) ->
     
     return recovery_metrics
 
-def generate_progress_report(old_doc: str, new_doc: str, similarity: float, changes: Dict) -> Dict:
-    """Generate a progress report based on document comparison"""
+@timed_stage("progress_report")
+def generate_progress_report(old_doc: Optional[str], new_doc: Optional[str], similarity: float, changes: Dict,
+                             recovery_metrics: Optional[Dict] = None) -> Dict:
+    """
+    Generate a progress report based on document comparison
+    
+    If recovery_metrics is given it is used as-is and the document texts are not needed
+    """
     report = {
         "similarity_score": similarity,
         "similarity_interpretation": "",
@@ -355,7 +413,8 @@ def generate_progress_report(old_doc: str, new_doc: str, similarity: float, chan
     }
     
     # Calculate recovery metrics
-    recovery_metrics = estimate_recovery_percentage(old_doc, new_doc, changes)
+    if recovery_metrics is None:
+        recovery_metrics = estimate_recovery_percentage(old_doc, new_doc, changes)
     report["recovery_metrics"] = recovery_metrics
     
     # Interpret similarity score
@@ -430,6 +489,202 @@ def generate_progress_report(old_doc: str, new_doc: str, similarity: float, chan
     
     return report
 
+def build_document_artifacts(text: str, embedding: Optional[np.ndarray] = None) -> Dict:
+    """
+    Compute the per-document analysis artifacts needed to compare a document later
+    
+    The result is JSON/BSON serializable so it can be stored next to a report
+    """
+    if embedding is None:
+        embedding = vectorize_document(text)
+    return {
+        "version": ARTIFACT_VERSION,
+        "entities": extract_medical_entities(text),
+        "recovery_signals": extract_recovery_signals(text),
+        "embedding": [float(value) for value in embedding]
+    }
+
+def compare_document_artifacts(old_artifacts: Dict, new_artifacts: Dict) -> Dict:
+    """Compare two documents using only their stored artifacts"""
+    similarity = compare_documents(
+        np.asarray(old_artifacts["embedding"], dtype=np.float32),
+        np.asarray(new_artifacts["embedding"], dtype=np.float32)
+    )
+    changes = identify_changes(old_artifacts["entities"], new_artifacts["entities"])
+    recovery_metrics = estimate_recovery_from_signals(
+        old_artifacts["recovery_signals"],
+        new_artifacts["recovery_signals"],
+        changes
+    )
+    return {
+        "similarity": similarity,
+        "changes": changes,
+        "report": generate_progress_report(None, None, similarity, changes, recovery_metrics=recovery_metrics)
+    }
+
+def compare_artifact_series(names: List[str], artifacts: List[Dict]) -> Dict:
+    """
+    Compare documents in chronological order using only their stored artifacts
+
+    Returns the same structure as compare_medical_documents
+    """
+    if len(artifacts) < 2:
+        return {"error": "At least two documents are required for comparison"}
+
+    pairwise = []
+    for i in range(len(artifacts) - 1):
+        comparison = compare_document_artifacts(artifacts[i], artifacts[i+1])
+        pairwise.append({
+            "old_doc": names[i],
+            "new_doc": names[i+1],
+            "similarity": comparison["similarity"],
+            "changes": comparison["changes"],
+            "report": comparison["report"]
+        })
+
+    # Overall progress report from the first and last document
+    overall = compare_document_artifacts(artifacts[0], artifacts[-1])
+    return {
+        "overall_similarity": sum(pair["similarity"] for pair in pairwise) / len(pairwise),
+        "pairwise_comparisons": pairwise,
+        "progress_report": overall["report"]
+    }
+
+_sentence_cache: "OrderedDict[str, np.ndarray]" = OrderedDict()
+_sentence_cache_lock = threading.Lock()
+
+def segment_sentences(text: str) -> List[str]:
+    """Split report text into sentences (line breaks always end a sentence)"""
+    sentences = []
+    for line in (text or "").splitlines():
+        for sentence in SENTENCE_SPLIT_PATTERN.split(line.strip()):
+            if sentence.strip():
+                sentences.append(" ".join(sentence.split()))
+    return sentences
+
+@timed_stage("sentence_embedding")
+def embed_sentences(sentences: List[str]) -> np.ndarray:
+    """
+    Unit-length embeddings of sentences, one row each
+    
+    Embeddings are cached by sentence hash, and the sentences not yet cached are
+    encoded in a single model call.
+    """
+    keys = [hashlib.sha1(sentence.encode()).hexdigest() for sentence in sentences]
+    vectors = [None] * len(sentences)
+    with _sentence_cache_lock:
+        for i, key in enumerate(keys):
+            vector = _sentence_cache.get(key)
+            if vector is not None:
+                _sentence_cache.move_to_end(key)
+                vectors[i] = vector
+    
+    missing = {}
+    for i, key in enumerate(keys):
+        if vectors[i] is None:
+            missing.setdefault(key, []).append(i)
+    if missing:
+        texts = [sentences[indices[0]] for indices in missing.values()]
+        encoded = model.encode(texts, normalize_embeddings=True).astype(np.float32)
+        with _sentence_cache_lock:
+            for (key, indices), vector in zip(missing.items(), encoded):
+                for i in indices:
+                    vectors[i] = vector
+                _sentence_cache[key] = vector
+            while len(_sentence_cache) > SENTENCE_CACHE_SIZE:
+                _sentence_cache.popitem(last=False)
+    
+    if not vectors:
+        return np.zeros((0, EMBEDDING_DIM), dtype=np.float32)
+    return np.stack(vectors)
+
+def align_sentences(similarity: np.ndarray, threshold: float = SENTENCE_MATCH_SIMILARITY,
+                    band: int = SENTENCE_ALIGN_BAND,
+                    max_band: int = SENTENCE_ALIGN_MAX_BAND) -> List[Tuple[Optional[int], Optional[int]]]:
+    """
+    Order-preserving alignment of old (rows) and new (columns) sentences
+    
+    Finds the monotone matching that maximizes the total similarity above
+    `threshold` (Needleman-Wunsch with free gaps), searching only cells near the
+    diagonal: `band` plus the length difference, at most `max_band`. The cost is
+    therefore linear in the report length; sentences that drifted further than
+    that are reported as removed and added.
+    Returns (old index, new index) pairs in order, with None for a removed or added sentence.
+    """
+    n, m = similarity.shape
+    gain = similarity - threshold
+    # Diagonal from (0, 0) to (n, m), widened by the length difference so a block of
+    # inserted or deleted sentences can still be skipped, up to the cap
+    width = min(band + abs(n - m), max_band)
+    upper = [min(m, -(-(i * m) // n) + width) if n else m for i in range(n + 1)]
+    # Each row starts no later than the previous row ends, so every band cell stays reachable
+    lower = [0] + [min(max(0, (i * m) // n - width), upper[i - 1]) for i in range(1, n + 1)]
+    
+    score = np.full((n + 1, m + 1), -np.inf, dtype=np.float64)
+    move = np.zeros((n + 1, m + 1), dtype=np.int8)  # 1 match, 2 removed (up), 3 added (left)
+    score[0, :upper[0] + 1] = 0.0
+    move[0, 1:upper[0] + 1] = 3
+    for i in range(1, n + 1):
+        for j in range(lower[i], upper[i] + 1):
+            best, step = score[i - 1, j], 2
+            if j > 0:
+                if score[i, j - 1] > best:
+                    best, step = score[i, j - 1], 3
+                if gain[i - 1, j - 1] > 0 and score[i - 1, j - 1] + gain[i - 1, j - 1] > best:
+                    best, step = score[i - 1, j - 1] + gain[i - 1, j - 1], 1
+            score[i, j] = best
+            move[i, j] = step
+    
+    pairs = []
+    i, j = n, m
+    while i > 0 or j > 0:
+        step = move[i, j] if i > 0 else 3
+        if step == 1:
+            pairs.append((i - 1, j - 1))
+            i, j = i - 1, j - 1
+        elif step == 2:
+            pairs.append((i - 1, None))
+            i -= 1
+        else:
+            pairs.append((None, j - 1))
+            j -= 1
+    pairs.reverse()
+    return pairs
+
+@timed_stage("sentence_diff")
+def compare_sentences(old_text: str, new_text: str) -> Dict:
+    """
+    Sentence-by-sentence diff of two reports
+    
+    Each sentence is marked unchanged, modified (with its similarity to the old
+    sentence it replaces), added or removed, in report order.
+    """
+    old_sentences = segment_sentences(old_text)
+    new_sentences = segment_sentences(new_text)
+    embeddings = embed_sentences(old_sentences + new_sentences)
+    old_vectors, new_vectors = embeddings[:len(old_sentences)], embeddings[len(old_sentences):]
+    similarity = old_vectors @ new_vectors.T  # Cosine similarity, the embeddings are unit length
+    
+    sentences = []
+    summary = {"unchanged": 0, "modified": 0, "added": 0, "removed": 0}
+    for i, j in align_sentences(similarity):
+        if i is None:
+            entry = {"status": "added", "old": None, "new": new_sentences[j], "similarity": None}
+        elif j is None:
+            entry = {"status": "removed", "old": old_sentences[i], "new": None, "similarity": None}
+        else:
+            score = float(similarity[i, j])
+            same = old_sentences[i] == new_sentences[j] or score >= SENTENCE_UNCHANGED_SIMILARITY
+            entry = {
+                "status": "unchanged" if same else "modified",
+                "old": old_sentences[i],
+                "new": new_sentences[j],
+                "similarity": round(min(score, 1.0), 4)
+            }
+        summary[entry["status"]] += 1
+        sentences.append(entry)
+    return {"summary": summary, "sentences": sentences}
+
 def save_file_temporarily(file_content: bytes, file_extension: str) -> str:
     """Save a file temporarily and return the path"""
     fd, path = tempfile.mkstemp(suffix=f'.{file_extension}')
@@ -437,7 +692,7 @@ def save_file_temporarily(file_content: bytes, file_extension: str) -> str:
         tmp.write(file_content)
     return path
 
-def compare_medical_documents(docs: List[Dict[str, Any]]) -> Dict:
+def compare_medical_documents(docs: List[Dict[str, Any]], sentence_diff: bool = False) -> Dict:
     """
     Compare multiple medical documents and generate a progress report
     
@@ -447,6 +702,7 @@ def compare_medical_documents(docs: List[Dict[str, Any]]) -> Dict:
               - 'content': bytes or string content of the document
               - 'type': file type (e.g., 'pdf', 'txt')
               - 'name': filename or identifier
+        sentence_diff: Add a sentence-level diff (see compare_sentences) to each pairwise comparison
     
     Returns:
         Dict containing comparison results and progress report
@@ -504,6 +760,8 @@ def compare_medical_documents(docs: List[Dict[str, Any]]) -> Dict:
                 "changes": changes,
                 "report": report
             })
+            if sentence_diff:
+                results["pairwise_comparisons"][-1]["sentence_diff"] = compare_sentences(docs_text[i], docs_text[i+1])
         
         # Calculate overall similarity (average of pairwise similarities)
         if similarities:
@@ -0,0 +1,214 @@
+# compare_pool.py
+# Process-pool execution mode for the document comparison pipeline
+#
+# PDF parsing, regex extraction and sentence embedding are CPU-bound and hold the
+# GIL, so running them on the Flask request thread serializes concurrent requests.
+# This module runs compare_medical_documents in worker processes instead.
+#
+# Each worker is a process of its own with a private pipe, rather than a
+# ProcessPoolExecutor: a running task cannot be cancelled, and killing one
+# executor process breaks the whole executor. Here a task that times out is
+# stopped by killing only the worker running it, which is then replaced.
+
+import os
+import time
+import queue
+import logging
+import threading
+import multiprocessing
+from typing import List, Dict, Any, Optional
+
+# Configure logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Configuration
+COMPARE_POOL_SIZE = int(os.environ.get('COMPARE_POOL_SIZE', 0))  # 0 runs comparisons inline
+COMPARE_POOL_MAX_QUEUE = int(os.environ.get('COMPARE_POOL_MAX_QUEUE', 8))  # Tasks allowed to wait for a worker
+COMPARE_TASK_TIMEOUT = float(os.environ.get('COMPARE_TASK_TIMEOUT', 60))  # Seconds
+COMPARE_POOL_START_METHOD = os.environ.get('COMPARE_POOL_START_METHOD', 'spawn')
+WORKER_STOP_TIMEOUT = 5  # Seconds a worker gets to exit before it is killed
+
+
+class PoolSaturatedError(Exception):
+    """Raised when the pool already has as many tasks as it may queue"""
+
+
+class CompareTimeoutError(Exception):
+    """Raised when a comparison does not finish within its timeout"""
+
+
+class CompareWorkerError(Exception):
+    """Raised when the worker process running a comparison died"""
+
+
+def _init_worker():
+    """Load the sentence transformer model once when the worker starts"""
+    import compare
+    compare.vectorize_document("warm up")
+    logger.info(f"Compare worker {os.getpid()} ready")
+
+
+def _run_compare(docs: List[Dict[str, Any]], sentence_diff: bool = False) -> Dict:
+    from compare import compare_medical_documents
+    return compare_medical_documents(docs, sentence_diff)
+
+
+def _worker_main(connection):
+    """Worker process: run (docs, sentence_diff) tasks from the pipe until it closes or sends None"""
+    _init_worker()
+    while True:
+        try:
+            task = connection.recv()
+        except EOFError:
+            return
+        if task is None:
+            return
+        try:
+            reply = (True, _run_compare(*task))
+        except Exception as e:
+            reply = (False, e)
+        try:
+            connection.send(reply)
+        except Exception as e:
+            # The result or exception could not be pickled
+            connection.send((False, RuntimeError(f"Could not return comparison result: {e}")))
+
+
+class _Worker:
+    """One worker process and the parent's end of its pipe"""
+
+    def __init__(self, context):
+        self.connection, child_connection = context.Pipe()
+        self.process = context.Process(target=_worker_main, args=(child_connection,), daemon=True)
+        self.process.start()
+        child_connection.close()
+
+    def kill(self):
+        self.connection.close()
+        if self.process.is_alive():
+            self.process.kill()
+        self.process.join(WORKER_STOP_TIMEOUT)
+
+    def stop(self):
+        try:
+            self.connection.send(None)
+        except (OSError, ValueError):
+            pass
+        self.process.join(WORKER_STOP_TIMEOUT)
+        self.kill()
+
+
+class ComparePool:
+    """
+    Bounded process pool for compare_medical_documents
+
+    At most size + max_queue tasks are admitted at once; further submissions fail
+    fast with PoolSaturatedError so callers can shed load instead of piling up.
+    Time spent waiting for a free worker counts against a task's timeout.
+    """
+
+    def __init__(self, size: int, max_queue: int = COMPARE_POOL_MAX_QUEUE,
+                 timeout: float = COMPARE_TASK_TIMEOUT, start_method: str = COMPARE_POOL_START_METHOD):
+        self.size = size
+        self.max_queue = max_queue
+        self.timeout = timeout
+        self.start_method = start_method
+        self._context = multiprocessing.get_context(start_method)
+        self._slots = threading.BoundedSemaphore(size + max_queue)
+        self._lock = threading.Lock()
+        self._in_flight = 0
+        self._completed = 0
+        self._rejected = 0
+        self._timed_out = 0
+        self._replaced = 0
+        self._idle: "queue.Queue[_Worker]" = queue.Queue()
+        self._workers = set()
+        for _ in range(size):
+            self._add_worker()
+
+    def _add_worker(self):
+        worker = _Worker(self._context)
+        with self._lock:
+            self._workers.add(worker)
+        self._idle.put(worker)
+
+    def _replace_worker(self, worker: _Worker, reason: str):
+        """Kill a stuck or dead worker and start another in its place; other workers are unaffected"""
+        logger.error(f"Replacing comparison worker {worker.process.pid}: {reason}")
+        with self._lock:
+            self._workers.discard(worker)
+            self._replaced += 1
+        worker.kill()
+        self._add_worker()
+
+    def run(self, docs: List[Dict[str, Any]], timeout: Optional[float] = None, sentence_diff: bool = False) -> Dict:
+        """Run a comparison in the pool and wait for its result"""
+        timeout = self.timeout if timeout is None else timeout
+        if timeout <= 0:
+            with self._lock:
+                self._timed_out += 1
+            raise CompareTimeoutError("No time left to run the comparison")
+        if not self._slots.acquire(blocking=False):
+            with self._lock:
+                self._rejected += 1
+            raise PoolSaturatedError(f"Comparison pool is full ({self.size} workers, {self.max_queue} queued)")
+        with self._lock:
+            self._in_flight += 1
+        started = time.monotonic()
+        try:
+            try:
+                worker = self._idle.get(timeout=timeout)
+            except queue.Empty:
+                with self._lock:
+                    self._timed_out += 1
+                raise CompareTimeoutError(f"No comparison worker became free within {timeout:g} seconds")
+
+            try:
+                worker.connection.send((docs, sentence_diff))
+                if not worker.connection.poll(max(0.0, timeout - (time.monotonic() - started))):
+                    with self._lock:
+                        self._timed_out += 1
+                    self._replace_worker(worker, f"comparison ran past its {timeout:g} second timeout")
+                    raise CompareTimeoutError(f"Comparison did not finish within {timeout:g} seconds")
+                succeeded, value = worker.connection.recv()
+            except (EOFError, OSError) as e:
+                # The worker died (e.g. killed for using too much memory)
+                self._replace_worker(worker, f"worker exited ({type(e).__name__})")
+                raise CompareWorkerError("Comparison worker stopped before finishing")
+            self._idle.put(worker)
+            if not succeeded:
+                raise value
+            return value
+        finally:
+            with self._lock:
+                self._in_flight -= 1
+                self._completed += 1
+            self._slots.release()
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "workers": self.size,
+                "max_queue": self.max_queue,
+                "in_flight": self._in_flight,
+                "completed": self._completed,
+                "rejected": self._rejected,
+                "timed_out": self._timed_out,
+                "recycled": self._replaced
+            }
+
+    def shutdown(self):
+        with self._lock:
+            workers = list(self._workers)
+            self._workers.clear()
+        for worker in workers:
+            worker.stop()
+
+
+def create_compare_pool() -> Optional[ComparePool]:
+    """Create the pool configured by the environment, or None for inline execution"""
+    if COMPARE_POOL_SIZE <= 0:
+        return None
+    logger.info(f"Starting comparison pool with {COMPARE_POOL_SIZE} workers")
+    return ComparePool(COMPARE_POOL_SIZE)
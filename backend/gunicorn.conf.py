@@ -0,0 +1,57 @@
+# gunicorn.conf.py
+# Production server: preload the app in the master process and fork workers
+#
+# Usage (from the backend directory):
+#   gunicorn -c gunicorn.conf.py app:app
+#
+# The sentence transformer weights and other read-only state are loaded once by the
+# master and shared copy-on-write with every worker. Clients, threads and pools that
+# do not survive a fork are created per worker in post_fork.
+
+import os
+import gc
+import multiprocessing
+
+# Tells app.py to defer MongoDB, Groq and background threads to init_worker()
+os.environ['MEDVISOR_PRELOAD'] = '1'
+
+bind = os.environ.get('MEDVISOR_BIND', '0.0.0.0:5000')
+workers = int(os.environ.get('MEDVISOR_WORKERS', multiprocessing.cpu_count()))
+# sync, gthread (threads per worker) or gevent (async; requires the gevent package)
+worker_class = os.environ.get('MEDVISOR_WORKER_CLASS', 'gthread')
+threads = int(os.environ.get('MEDVISOR_THREADS', 4))
+worker_connections = int(os.environ.get('MEDVISOR_WORKER_CONNECTIONS', 100))  # gevent only
+timeout = int(os.environ.get('MEDVISOR_TIMEOUT', 120))  # Groq vision calls can take a while
+graceful_timeout = 30
+keepalive = 5
+preload_app = True
+# Restart workers periodically to bound slow memory growth (0 disables)
+max_requests = int(os.environ.get('MEDVISOR_MAX_REQUESTS', 0))
+max_requests_jitter = max_requests // 10
+
+# Split the cores between workers so torch does not oversubscribe the CPU
+os.environ.setdefault('OMP_NUM_THREADS', str(max(1, multiprocessing.cpu_count() // max(1, workers))))
+
+if worker_class == 'gevent':
+    # Must happen before the app (and the libraries it imports) is preloaded
+    from gevent import monkey
+    monkey.patch_all()
+
+
+def when_ready(server):
+    """
+    Runs in the master after the app is preloaded, before any worker is forked
+
+    Moving every object created so far into the permanent generation keeps the cyclic
+    garbage collector in the workers from touching (and so copying) the shared pages.
+    """
+    gc.collect()
+    gc.freeze()
+    server.log.info(f"Preloaded app; forking {workers} {worker_class} workers")
+
+
+def post_fork(server, worker):
+    """Re-create fork-unsafe clients and start per-worker background services"""
+    import app
+    app.init_worker()
+    server.log.info(f"Worker {worker.pid} initialized")
@@ -0,0 +1,155 @@
+# longitudinal.py
+# Incremental longitudinal tracking: each new report is compared against the
+# patient's previous report once, at insert time, and the delta is stored with it
+
+import os
+import logging
+from datetime import datetime
+from typing import Dict, Any, Optional, List
+from bson.objectid import ObjectId
+from pymongo import UpdateOne
+from compare import (
+    build_document_artifacts,
+    compare_document_artifacts,
+    vectorize_documents,
+    ARTIFACT_VERSION
+)
+from similar_cases import report_document_text
+
+# Configure logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Configuration
+LONGITUDINAL_TRACKING_ENABLED = os.environ.get('LONGITUDINAL_TRACKING', '1') != '0'
+MAX_COMPARE_REPORTS = int(os.environ.get('MAX_COMPARE_REPORTS', 50))  # Stored reports per /api/compare request
+MAX_TRAJECTORY_POINTS = int(os.environ.get('MAX_TRAJECTORY_POINTS', 1000))  # Follow-ups per trajectory request
+
+PREVIOUS_REPORT_PROJECTION = {
+    "created_at": 1,
+    "report_text": 1,
+    "analysis_result.anomaly_detection.analysis": 1,
+    "analysis_result.report_analysis.report_analysis": 1,
+    "analysis_artifacts": 1,
+    "longitudinal.follow_up_index": 1
+}
+
+
+def ensure_artifacts(collection, doc: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Return the stored artifacts of a report, computing and persisting them if missing or outdated
+
+    Reports stored before longitudinal tracking existed have no artifacts yet.
+    """
+    artifacts = doc.get("analysis_artifacts")
+    if artifacts and artifacts.get("version") == ARTIFACT_VERSION:
+        return artifacts
+
+    artifacts = build_document_artifacts(report_document_text(doc))
+    if collection is not None and "_id" in doc:
+        try:
+            collection.update_one({"_id": doc["_id"]}, {"$set": {"analysis_artifacts": artifacts}})
+        except Exception as e:
+            logger.error(f"Failed to persist artifacts for report {doc['_id']}: {e}")
+    return artifacts
+
+
+def ensure_artifacts_many(collection, docs: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """
+    ensure_artifacts for several reports: missing embeddings are computed in one model
+    call and the new artifacts are persisted in one bulk write
+    """
+    missing = [
+        i for i, doc in enumerate(docs)
+        if not doc.get("analysis_artifacts") or doc["analysis_artifacts"].get("version") != ARTIFACT_VERSION
+    ]
+    artifacts = [doc.get("analysis_artifacts") for doc in docs]
+    if not missing:
+        return artifacts
+
+    texts = [report_document_text(docs[i]) for i in missing]
+    embeddings = vectorize_documents(texts)
+    updates = []
+    for i, text, embedding in zip(missing, texts, embeddings):
+        artifacts[i] = build_document_artifacts(text, embedding)
+        if "_id" in docs[i]:
+            updates.append(UpdateOne({"_id": docs[i]["_id"]}, {"$set": {"analysis_artifacts": artifacts[i]}}))
+    if collection is not None and updates:
+        try:
+            collection.bulk_write(updates, ordered=False)
+        except Exception as e:
+            logger.error(f"Failed to persist artifacts for {len(updates)} reports: {e}")
+    return artifacts
+
+
+def load_reports_for_comparison(collection, report_ids: Optional[List[ObjectId]] = None,
+                                patient_id: Optional[str] = None, date_from: Optional[datetime] = None,
+                                date_to: Optional[datetime] = None,
+                                limit: int = MAX_COMPARE_REPORTS) -> List[Dict[str, Any]]:
+    """
+    Load stored reports for comparison, oldest first
+
+    Either fetches the given report_ids in one $in query, or a patient's reports in a
+    date range (served by the patient_id + created_at index).
+    """
+    if report_ids is not None:
+        query = {"_id": {"$in": report_ids}}
+    else:
+        query = {"patient_id": patient_id}
+        if date_from or date_to:
+            query["created_at"] = {}
+            if date_from:
+                query["created_at"]["$gte"] = date_from
+            if date_to:
+                query["created_at"]["$lt"] = date_to
+    cursor = collection.find(query, {**PREVIOUS_REPORT_PROJECTION, "patient_id": 1})
+    return list(cursor.sort([("created_at", 1), ("_id", 1)]).limit(limit))
+
+
+def find_previous_report(collection, patient_id: str) -> Optional[Dict[str, Any]]:
+    """Load the patient's most recent stored report (served by the patient_id + created_at index)"""
+    return collection.find_one(
+        {"patient_id": patient_id},
+        PREVIOUS_REPORT_PROJECTION,
+        sort=[("created_at", -1), ("_id", -1)]
+    )
+
+
+def attach_longitudinal_delta(collection, report_document: Dict[str, Any],
+                              previous: Optional[Dict[str, Any]] = None) -> Optional[Dict[str, Any]]:
+    """
+    Add `analysis_artifacts` and, when a previous report exists, a `longitudinal` delta to a new report document
+
+    The delta is computed only against the single most recent report, so reading a
+    patient's trajectory later means reading one stored delta per follow-up.
+
+    Args:
+        collection: The patient_reports collection
+        report_document: The document about to be inserted (modified in place)
+        previous: The previous report, if the caller already has it; otherwise it is loaded
+
+    Returns:
+        The longitudinal delta, or None for a patient's first report
+    """
+    artifacts = build_document_artifacts(report_document_text(report_document))
+    report_document["analysis_artifacts"] = artifacts
+
+    if previous is None:
+        previous = find_previous_report(collection, report_document["patient_id"])
+    if previous is None:
+        report_document["longitudinal"] = {"follow_up_index": 0, "previous_report_id": None}
+        return None
+
+    comparison = compare_document_artifacts(ensure_artifacts(collection, previous), artifacts)
+    previous_index = (previous.get("longitudinal") or {}).get("follow_up_index", 0)
+
+    delta = {
+        "follow_up_index": previous_index + 1,
+        "previous_report_id": str(previous["_id"]) if "_id" in previous else None,
+        "previous_created_at": previous.get("created_at"),
+        "similarity": comparison["similarity"],
+        "changes": comparison["changes"],
+        "progress_report": comparison["report"]
+    }
+    report_document["longitudinal"] = delta
+    return delta
@@ -0,0 +1,285 @@
+# mesh.py
+# 3D geometry for the scan viewer, built server-side and cached as binary glTF
+#
+# 2D scans become heightmaps (pixel brightness as height); volumes (NIfTI and
+# multi-frame DICOM) become isosurfaces extracted with marching cubes. Each
+# geometry is available at several levels of detail (LOD 0 is the finest), so
+# the viewer can show a coarse model immediately and swap in the detailed one.
+
+import os
+import json
+import struct
+import logging
+import threading
+from typing import Dict, Any, Optional, Tuple
+import numpy as np
+from PIL import Image
+from skimage.measure import marching_cubes
+from skimage.filters import threshold_otsu
+
+# Configure logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Configuration
+# Sampling stride for each level of detail; LOD n keeps every MESH_LOD_STRIDES[n]-th sample
+MESH_LOD_STRIDES = [1, 2, 4]
+HEIGHTMAP_MAX_SEGMENTS = int(os.environ.get('HEIGHTMAP_MAX_SEGMENTS', 1024))  # Grid cells along the longest edge
+HEIGHTMAP_MAX_SMOOTHING = 10
+MESH_SIZE = 100.0  # Longest edge of the model in scene units, as in the viewer's PlaneGeometry
+MESH_KINDS = ('heightmap', 'isosurface')
+
+# glTF constants
+GLB_MAGIC = 0x46546C67
+GLB_JSON_CHUNK = 0x4E4F534A
+GLB_BIN_CHUNK = 0x004E4942
+GL_FLOAT = 5126
+GL_UNSIGNED_INT = 5125
+GL_ARRAY_BUFFER = 34962
+GL_ELEMENT_ARRAY_BUFFER = 34963
+
+
+class MeshError(Exception):
+    """The requested mesh cannot be built for this scan (HTTP 400)"""
+
+
+def load_brightness(image_path: str) -> np.ndarray:
+    """Brightness in [0, 1] of an image, with the viewer's luminance weights"""
+    with Image.open(image_path) as image:
+        rgb = np.asarray(image.convert('RGB'), dtype=np.float32) / 255.0
+    return rgb @ np.array([0.299, 0.587, 0.114], dtype=np.float32)
+
+
+def smooth_heights(heights: np.ndarray, iterations: int) -> np.ndarray:
+    """Average each interior sample with its four neighbours, `iterations` times (edges stay fixed)"""
+    heights = heights.copy()
+    for _ in range(iterations):
+        heights[1:-1, 1:-1] = (
+            heights[:-2, 1:-1] + heights[2:, 1:-1] +
+            heights[1:-1, :-2] + heights[1:-1, 2:] +
+            heights[1:-1, 1:-1]
+        ) / 5
+    return heights
+
+
+def vertex_normals(positions: np.ndarray, indices: np.ndarray) -> np.ndarray:
+    """Area-weighted vertex normals of a triangle mesh"""
+    triangles = positions[indices.reshape(-1, 3)]
+    face_normals = np.cross(triangles[:, 1] - triangles[:, 0], triangles[:, 2] - triangles[:, 0])
+    normals = np.zeros_like(positions)
+    for corner in range(3):
+        np.add.at(normals, indices.reshape(-1, 3)[:, corner], face_normals)
+    lengths = np.linalg.norm(normals, axis=1, keepdims=True)
+    lengths[lengths == 0] = 1.0
+    return (normals / lengths).astype(np.float32)
+
+
+def build_heightmap(brightness: np.ndarray, resolution: float = 1.0, smoothing: int = 0,
+                    lod: int = 0) -> Dict[str, np.ndarray]:
+    """
+    A grid mesh laid out like THREE.PlaneGeometry with z = brightness (0 to 1)
+
+    The viewer scales z by its height setting, so that setting needs no new mesh.
+    """
+    image_height, image_width = brightness.shape
+    scale = min(resolution, HEIGHTMAP_MAX_SEGMENTS / max(image_width, image_height))
+    stride = MESH_LOD_STRIDES[lod]
+    segments_x = max(1, int(image_width * scale) // stride)
+    segments_y = max(1, int(image_height * scale) // stride)
+
+    # Nearest-pixel sampling of a (segments + 1)^2 grid, then smoothing on that grid
+    sample_x = (np.arange(segments_x + 1) * image_width // (segments_x + 1)).astype(np.intp)
+    sample_y = (np.arange(segments_y + 1) * image_height // (segments_y + 1)).astype(np.intp)
+    heights = smooth_heights(brightness[np.ix_(sample_y, sample_x)], smoothing)
+
+    plane_width = MESH_SIZE * image_width / max(image_width, image_height)
+    plane_height = MESH_SIZE * image_height / max(image_width, image_height)
+    grid_x, grid_y = np.meshgrid(np.arange(segments_x + 1), np.arange(segments_y + 1))
+    positions = np.stack([
+        grid_x * (plane_width / segments_x) - plane_width / 2,
+        plane_height / 2 - grid_y * (plane_height / segments_y),
+        heights
+    ], axis=-1).reshape(-1, 3).astype(np.float32)
+    uvs = np.stack([
+        grid_x / segments_x,
+        1 - grid_y / segments_y
+    ], axis=-1).reshape(-1, 2).astype(np.float32)
+
+    # Two triangles per cell, with PlaneGeometry's winding
+    row = segments_x + 1
+    a = (grid_x[:-1, :-1] + row * grid_y[:-1, :-1]).ravel()
+    b = a + row
+    c = b + 1
+    d = a + 1
+    indices = np.stack([a, b, d, b, c, d], axis=-1).ravel().astype(np.uint32)
+
+    return {
+        "positions": positions,
+        "normals": vertex_normals(positions, indices),
+        "uvs": uvs,
+        "indices": indices
+    }
+
+
+def build_isosurface(volume: np.ndarray, spacing: Tuple[float, float, float],
+                     level: Optional[float] = None, lod: int = 0) -> Dict[str, np.ndarray]:
+    """
+    Isosurface of a volume at `level` (default: from Otsu's threshold), centered and scaled to MESH_SIZE
+
+    Coarser levels of detail run marching cubes on a coarser sampling grid.
+    """
+    if level is None:
+        # Otsu picks the histogram bin that separates the classes; the midpoint of the
+        # two class means keeps the surface off the edge of that bin
+        threshold = threshold_otsu(volume)
+        level = float((volume[volume <= threshold].mean() + volume[volume > threshold].mean()) / 2)
+    if not volume.min() < level < volume.max():
+        raise MeshError(f"Level {level:g} is outside the volume's range [{volume.min():g}, {volume.max():g}]")
+
+    vertices, faces, normals, _values = marching_cubes(
+        volume, level=level, spacing=spacing, step_size=MESH_LOD_STRIDES[lod], allow_degenerate=False
+    )
+    if len(faces) == 0:
+        raise MeshError(f"No surface at level {level:g}")
+
+    # Center on the origin and fit the longest extent
+    extent = np.array(volume.shape, dtype=np.float32) * np.array(spacing, dtype=np.float32)
+    vertices = (vertices - extent / 2) * (MESH_SIZE / extent.max())
+    return {
+        "positions": vertices.astype(np.float32),
+        # marching_cubes normals point down the gradient, i.e. into brighter tissue
+        "normals": -normals.astype(np.float32),
+        "uvs": None,
+        "indices": faces.astype(np.uint32).ravel(),
+        "level": level
+    }
+
+
+def encode_glb(geometry: Dict[str, np.ndarray], extras: Optional[Dict[str, Any]] = None) -> bytes:
+    """Pack a triangle mesh into a binary glTF 2.0 file (one mesh, one primitive)"""
+    buffer_views = []
+    accessors = []
+    attributes = {}
+    binary = bytearray()
+
+    def add(array: np.ndarray, component_type: int, accessor_type: str, target: int) -> int:
+        offset = len(binary)
+        data = np.ascontiguousarray(array).tobytes()
+        binary.extend(data)
+        binary.extend(b'\x00' * (-len(binary) % 4))  # Keep every view 4-byte aligned
+        buffer_views.append({"buffer": 0, "byteOffset": offset, "byteLength": len(data), "target": target})
+        accessor = {
+            "bufferView": len(buffer_views) - 1,
+            "componentType": component_type,
+            "count": len(array),
+            "type": accessor_type
+        }
+        if accessor_type == "VEC3" and component_type == GL_FLOAT:
+            accessor["min"] = array.min(axis=0).tolist()
+            accessor["max"] = array.max(axis=0).tolist()
+        accessors.append(accessor)
+        return len(accessors) - 1
+
+    attributes["POSITION"] = add(geometry["positions"], GL_FLOAT, "VEC3", GL_ARRAY_BUFFER)
+    attributes["NORMAL"] = add(geometry["normals"], GL_FLOAT, "VEC3", GL_ARRAY_BUFFER)
+    if geometry.get("uvs") is not None:
+        attributes["TEXCOORD_0"] = add(geometry["uvs"], GL_FLOAT, "VEC2", GL_ARRAY_BUFFER)
+    indices = add(geometry["indices"], GL_UNSIGNED_INT, "SCALAR", GL_ELEMENT_ARRAY_BUFFER)
+
+    document = {
+        "asset": {"version": "2.0", "generator": "MedVisor mesh service"},
+        "scene": 0,
+        "scenes": [{"nodes": [0]}],
+        "nodes": [{"mesh": 0}],
+        "meshes": [{"primitives": [{"attributes": attributes, "indices": indices, "mode": 4}],
+                    "extras": extras or {}}],
+        "accessors": accessors,
+        "bufferViews": buffer_views,
+        "buffers": [{"byteLength": len(binary)}]
+    }
+    json_chunk = json.dumps(document, separators=(',', ':')).encode('utf-8')
+    json_chunk += b' ' * (-len(json_chunk) % 4)
+
+    total_length = 12 + 8 + len(json_chunk) + 8 + len(binary)
+    return b''.join([
+        struct.pack('<III', GLB_MAGIC, 2, total_length),
+        struct.pack('<II', len(json_chunk), GLB_JSON_CHUNK), json_chunk,
+        struct.pack('<II', len(binary), GLB_BIN_CHUNK), bytes(binary)
+    ])
+
+
+class MeshService:
+    """
+    Builds meshes for stored scans and caches the GLB files in the scan store
+
+    Cache entries are named by every parameter that changes the geometry, so a
+    cached file never goes stale. Concurrent requests for the same mesh in one
+    process wait for a single build.
+    """
+
+    def __init__(self, scan_store):
+        self.scan_store = scan_store
+        self._locks: Dict[str, threading.Lock] = {}  # Per cache entry, while it is being built
+        self._locks_lock = threading.Lock()
+
+    @staticmethod
+    def default_kind(meta: Dict[str, Any]) -> str:
+        # Single-frame DICOM and 2D NIfTI are images; entries stored before is_volume existed get a heightmap
+        return 'isosurface' if meta.get("is_volume") else 'heightmap'
+
+    def get(self, scan_hash: str, kind: str, lod: int = 0, resolution: float = 1.0,
+            smoothing: int = 0, level: Optional[float] = None) -> Optional[str]:
+        """Path of the cached GLB for these parameters, building it first if needed; None if the scan is unknown"""
+        meta = self.scan_store.meta(scan_hash)
+        if meta is None:
+            return None
+        if kind not in MESH_KINDS:
+            raise MeshError(f"Invalid mesh kind '{kind}'. Allowed: {', '.join(MESH_KINDS)}")
+        if not 0 <= lod < len(MESH_LOD_STRIDES):
+            raise MeshError(f"lod must be between 0 and {len(MESH_LOD_STRIDES) - 1}")
+
+        if kind == 'heightmap':
+            if not 0 < resolution <= 2:
+                raise MeshError("resolution must be greater than 0 and at most 2")
+            if not 0 <= smoothing <= HEIGHTMAP_MAX_SMOOTHING:
+                raise MeshError(f"smoothing must be between 0 and {HEIGHTMAP_MAX_SMOOTHING}")
+            name = f"heightmap-r{resolution:g}-s{smoothing}-lod{lod}.glb"
+        else:
+            name = f"isosurface-l{'auto' if level is None else format(level, 'g')}-lod{lod}.glb"
+
+        path = self.scan_store.cache_path(scan_hash, name)
+        if os.path.exists(path):
+            return path
+
+        key = f"{scan_hash}/{name}"
+        with self._locks_lock:
+            build_lock = self._locks.setdefault(key, threading.Lock())
+        try:
+            with build_lock:
+                if os.path.exists(path):
+                    return path
+                if kind == 'heightmap':
+                    brightness = load_brightness(self.scan_store.path(scan_hash, 'normalized'))
+                    geometry = build_heightmap(brightness, resolution, smoothing, lod)
+                    extras = {"kind": kind, "lod": lod, "resolution": resolution, "smoothing": smoothing}
+                else:
+                    loaded = self.scan_store.load_volume(scan_hash)
+                    if loaded is None:
+                        raise MeshError("Scan is not a volume; use kind=heightmap")
+                    geometry = build_isosurface(*loaded, level=level, lod=lod)
+                    extras = {"kind": kind, "lod": lod, "level": geometry["level"]}
+                extras.update(vertices=len(geometry["positions"]), triangles=len(geometry["indices"]) // 3)
+
+                # Write under a temporary name so readers never see a partial file
+                temp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+                with open(temp_path, 'wb') as f:
+                    f.write(encode_glb(geometry, extras))
+                os.replace(temp_path, path)
+                logger.info(f"Built {kind} LOD {lod} for scan {scan_hash[:12]}: "
+                            f"{extras['vertices']} vertices, {extras['triangles']} triangles")
+        finally:
+            # Forget the lock once this build is done, so one is not kept for every mesh ever requested
+            with self._locks_lock:
+                if self._locks.get(key) is build_lock:
+                    del self._locks[key]
+        return path
@@ -0,0 +1,233 @@
+# model_calls.py
+# Deadlines and optional hedging for outbound model (Groq) calls
+#
+# A request's deadline (set by the admission slot, or the X-Deadline-Ms header)
+# is carried in a ContextVar, and every model call made while handling the
+# request is given only the time that is left: the call's HTTP timeout is the
+# remaining time (capped at MODEL_CALL_TIMEOUT), and the caller stops waiting
+# when the deadline passes, even if the provider keeps the connection open.
+#
+# With hedging on, a call that has not returned after the HEDGE_PERCENTILE of
+# recent latencies for its operation is sent a second time and the first
+# response wins. Hedges are paid for from a budget of HEDGE_BUDGET extra calls
+# per call, so a slow provider cannot double the load. The losing call cannot
+# be cancelled mid-request; it finishes (or times out) in the background.
+
+import os
+import time
+import logging
+import threading
+import contextvars
+from collections import deque
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from typing import Dict, Any, Optional, Callable
+import numpy as np
+
+# Configure logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Configuration
+MODEL_CALL_TIMEOUT = float(os.environ.get('MODEL_CALL_TIMEOUT', 60))  # Seconds per call when the request has no deadline
+MIN_CALL_TIME = 0.5  # A call is not started with less time than this left
+HEDGE_ENABLED = os.environ.get('HEDGE_REQUESTS', '0') == '1'
+HEDGE_PERCENTILE = float(os.environ.get('HEDGE_PERCENTILE', 95))  # Latency percentile after which a call is hedged
+HEDGE_BUDGET = float(os.environ.get('HEDGE_BUDGET', 0.05))  # Extra calls allowed per call
+HEDGE_BURST = 5  # Unused hedge budget that can be saved up
+HEDGE_MIN_SAMPLES = 20  # Latencies needed before an operation is hedged
+LATENCY_SAMPLES = 500  # Recent latencies kept per operation
+MODEL_CALL_WORKERS = int(os.environ.get('MODEL_CALL_WORKERS', 16))
+
+_deadline: contextvars.ContextVar = contextvars.ContextVar('model_call_deadline', default=None)
+
+
+class DeadlineExceeded(Exception):
+    """The request's deadline passed before the model call returned"""
+
+
+@contextmanager
+def call_deadline(deadline: Optional[float]):
+    """
+    Model calls made inside the block must finish by `deadline` (a time.monotonic() value)
+
+    Nested deadlines can only shorten the outer one; None leaves it unchanged.
+    """
+    outer = _deadline.get()
+    if deadline is not None and outer is not None:
+        deadline = min(deadline, outer)
+    token = _deadline.set(deadline if deadline is not None else outer)
+    try:
+        yield
+    finally:
+        _deadline.reset(token)
+
+
+def remaining_time() -> Optional[float]:
+    """Seconds left until the current deadline, or None without one"""
+    deadline = _deadline.get()
+    return None if deadline is None else deadline - time.monotonic()
+
+
+def _percentiles(samples) -> Optional[Dict[str, float]]:
+    if not samples:
+        return None
+    values = np.asarray(samples) * 1000
+    return {
+        "p50": round(float(np.percentile(values, 50)), 1),
+        "p95": round(float(np.percentile(values, 95)), 1),
+        "p99": round(float(np.percentile(values, 99)), 1)
+    }
+
+
+class _Operation:
+    """Latency history, hedge budget and counters of one kind of model call"""
+
+    def __init__(self):
+        self.attempt_latencies = deque(maxlen=LATENCY_SAMPLES)  # Each call sent, hedged or not
+        self.primary_latencies = deque(maxlen=LATENCY_SAMPLES)  # First attempts only: latency without hedging
+        self.observed_latencies = deque(maxlen=LATENCY_SAMPLES)  # What callers waited
+        self.hedge_tokens = HEDGE_BURST
+        self.counters = {"calls": 0, "hedged": 0, "hedge_won": 0, "hedge_over_budget": 0,
+                         "deadline_exceeded": 0, "errors": 0}
+
+
+class ModelCaller:
+    """Runs model calls within the current deadline, hedging slow ones if enabled"""
+
+    def __init__(self, hedge: bool = HEDGE_ENABLED, hedge_percentile: float = HEDGE_PERCENTILE,
+                 hedge_budget: float = HEDGE_BUDGET):
+        self.hedge = hedge
+        self.hedge_percentile = hedge_percentile
+        self.hedge_budget = hedge_budget
+        self._operations: Dict[str, _Operation] = {}
+        self._lock = threading.Lock()
+        self._executor = None  # Created on first call, i.e. in the worker process
+
+    def _operation(self, name: str) -> _Operation:
+        if name not in self._operations:
+            self._operations[name] = _Operation()
+        return self._operations[name]
+
+    def _submit(self, operation: _Operation, create: Callable, kwargs: Dict[str, Any], primary: bool):
+        started = time.monotonic()
+
+        def record(future):
+            # Failures count too: a call that errors or times out after 30s is the tail hedging is for
+            latency = time.monotonic() - started
+            with self._lock:
+                operation.attempt_latencies.append(latency)
+                if primary:
+                    operation.primary_latencies.append(latency)
+
+        future = self._executor.submit(create, **kwargs)
+        future.add_done_callback(record)
+        return future
+
+    def _hedge_delay(self, operation: _Operation) -> Optional[float]:
+        """Seconds to wait before hedging, or None if this call should not be hedged (caller holds the lock)"""
+        if not self.hedge or len(operation.attempt_latencies) < HEDGE_MIN_SAMPLES:
+            return None
+        return float(np.percentile(np.asarray(operation.attempt_latencies), self.hedge_percentile))
+
+    def call(self, name: str, create: Callable, **kwargs):
+        """
+        create(**kwargs, timeout=...) within the current deadline; raises DeadlineExceeded
+
+        Exceptions from create are re-raised unless a hedged duplicate succeeds.
+        """
+        remaining = remaining_time()
+        timeout = MODEL_CALL_TIMEOUT if remaining is None else min(remaining, MODEL_CALL_TIMEOUT)
+        with self._lock:
+            operation = self._operation(name)
+            operation.counters["calls"] += 1
+            operation.hedge_tokens = min(HEDGE_BURST, operation.hedge_tokens + self.hedge_budget)
+            hedge_delay = self._hedge_delay(operation)
+            if timeout < MIN_CALL_TIME:
+                operation.counters["deadline_exceeded"] += 1
+                raise DeadlineExceeded(f"No time left for {name} ({max(0.0, remaining):.1f}s before the deadline)")
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=MODEL_CALL_WORKERS, thread_name_prefix='model-call')
+
+        started = time.monotonic()
+        kwargs["timeout"] = timeout
+        futures = [self._submit(operation, create, kwargs, primary=True)]
+        try:
+            if hedge_delay is not None and hedge_delay < timeout:
+                done, _pending = wait(futures, timeout=hedge_delay)
+                if not done:
+                    with self._lock:
+                        hedged = operation.hedge_tokens >= 1
+                        if hedged:
+                            operation.hedge_tokens -= 1
+                            operation.counters["hedged"] += 1
+                        else:
+                            operation.counters["hedge_over_budget"] += 1
+                    if hedged:
+                        hedge_kwargs = dict(kwargs, timeout=max(MIN_CALL_TIME, timeout - hedge_delay))
+                        futures.append(self._submit(operation, create, hedge_kwargs, primary=False))
+
+            result = self._first_result(futures, started + timeout)
+        except DeadlineExceeded:
+            with self._lock:
+                operation.counters["deadline_exceeded"] += 1
+            raise
+        except Exception as e:
+            if remaining is not None and time.monotonic() >= started + timeout:
+                # The provider's own timeout, set to the time left, fired first
+                with self._lock:
+                    operation.counters["deadline_exceeded"] += 1
+                raise DeadlineExceeded(f"Model call did not return before the deadline ({e})") from e
+            with self._lock:
+                operation.counters["errors"] += 1
+            raise
+
+        winner, value = result
+        with self._lock:
+            operation.observed_latencies.append(time.monotonic() - started)
+            if winner > 0:
+                operation.counters["hedge_won"] += 1
+        return value
+
+    def _first_result(self, futures, deadline: float):
+        """(index, result) of the first attempt to succeed; the last error if all fail"""
+        pending = set(futures)
+        error = None
+        while pending:
+            done, pending = wait(pending, timeout=max(0.0, deadline - time.monotonic()), return_when=FIRST_COMPLETED)
+            if not done:
+                raise DeadlineExceeded("Model call did not return before the deadline")
+            for future in done:
+                if future.exception() is None:
+                    return futures.index(future), future.result()
+                error = future.exception()
+        raise error
+
+    def stats(self) -> Dict[str, Any]:
+        """
+        Per operation: counters, hedge rate and latency percentiles
+
+        "unhedged_ms" are first-attempt latencies, i.e. what callers would have
+        waited without hedging; "observed_ms" is what they actually waited.
+        """
+        with self._lock:
+            operations = {}
+            for name, operation in self._operations.items():
+                calls = operation.counters["calls"]
+                unhedged = _percentiles(operation.primary_latencies)
+                observed = _percentiles(operation.observed_latencies)
+                operations[name] = {
+                    **operation.counters,
+                    "hedge_rate": round(operation.counters["hedged"] / calls, 4) if calls else 0.0,
+                    "hedge_after_ms": round(self._hedge_delay(operation) * 1000, 1)
+                    if self._hedge_delay(operation) is not None else None,
+                    "unhedged_ms": unhedged,
+                    "observed_ms": observed,
+                    "p99_saved_ms": round(unhedged["p99"] - observed["p99"], 1) if unhedged and observed else None
+                }
+            return {
+                "hedging": self.hedge,
+                "hedge_percentile": self.hedge_percentile,
+                "hedge_budget": self.hedge_budget,
+                "operations": operations
+            }
@@ -0,0 +1,363 @@
+# persistence.py
+# Write-behind persistence for analysis results
+#
+# Reports get their ObjectId up front so the API can return report_id immediately.
+# Documents are journaled to local disk, buffered in a bounded queue and written to
+# MongoDB with insert_many by a background thread, so a slow or briefly unavailable
+# database neither delays responses nor loses results.
+
+import os
+import re
+import copy
+import glob
+import time
+import queue
+import atexit
+import logging
+import threading
+from typing import Dict, Any, Optional, List, Tuple, Callable
+from bson import json_util
+from bson.objectid import ObjectId
+from pymongo.errors import BulkWriteError
+
+try:
+    import fcntl
+except ImportError:  # Windows: only the single-process dev server is supported there
+    fcntl = None
+
+# Configure logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Configuration
+WRITE_BEHIND_ENABLED = os.environ.get('WRITE_BEHIND', '1') != '0'
+WRITE_BEHIND_JOURNAL = os.environ.get(
+    'WRITE_BEHIND_JOURNAL',
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), 'journal', 'pending_reports.jsonl')
+)
+WRITE_BEHIND_MAX_QUEUE = int(os.environ.get('WRITE_BEHIND_MAX_QUEUE', 1000))
+WRITE_BEHIND_BATCH_SIZE = int(os.environ.get('WRITE_BEHIND_BATCH_SIZE', 100))
+WRITE_BEHIND_FLUSH_INTERVAL = float(os.environ.get('WRITE_BEHIND_FLUSH_INTERVAL', 0.5))  # Seconds
+WRITE_BEHIND_ENQUEUE_TIMEOUT = float(os.environ.get('WRITE_BEHIND_ENQUEUE_TIMEOUT', 5))  # Seconds
+WRITE_BEHIND_FSYNC = os.environ.get('WRITE_BEHIND_FSYNC', '1') != '0'
+MAX_RETRY_DELAY = 30  # Seconds between flush attempts while MongoDB is unavailable
+DUPLICATE_KEY_ERROR = 11000
+
+JOURNAL_JSON_OPTIONS = json_util.CANONICAL_JSON_OPTIONS
+
+
+class WriteQueueFullError(Exception):
+    """Raised when the write queue stays full for longer than the enqueue timeout"""
+
+
+def _journal_slot_path(base_path: str, slot: int) -> str:
+    if slot == 0:
+        return base_path
+    root, ext = os.path.splitext(base_path)
+    return f"{root}.{slot}{ext}"
+
+
+def _try_lock(path: str):
+    """Open and exclusively lock path + '.lock'; returns the open file, or None if another process holds it"""
+    lock_file = open(path + '.lock', 'w')
+    try:
+        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        return lock_file
+    except OSError:
+        lock_file.close()
+        return None
+
+
+def claim_journal(base_path: str) -> Tuple[str, Any, List[Tuple[str, Any]]]:
+    """
+    Pick a journal that no other live process is writing to
+
+    With several server workers each process needs its own journal. Every process
+    holds an exclusive lock on its journal for its lifetime, so the lock is released
+    when a worker dies. Returns (journal_path, lock_file, orphans) where orphans are
+    the (path, lock_file) pairs of unlocked journals left behind by dead workers.
+    """
+    if fcntl is None:
+        return base_path, None, []
+
+    slot = 0
+    while True:
+        path = _journal_slot_path(base_path, slot)
+        lock_file = _try_lock(path)
+        if lock_file is not None:
+            break
+        slot += 1
+
+    root, ext = os.path.splitext(base_path)
+    # Only other slots' journals; the glob also matches lock and temp files (e.g. for a path without extension)
+    slot_pattern = re.compile(re.escape(root) + r"\.\d+" + re.escape(ext) + "$")
+    slot_paths = [candidate for candidate in glob.glob(f"{root}.*{ext}") if slot_pattern.match(candidate)]
+    orphans = []
+    for other in sorted(set(slot_paths + [base_path])):
+        if other == path or not os.path.exists(other):
+            continue
+        other_lock = _try_lock(other)
+        if other_lock is not None:
+            orphans.append((other, other_lock))
+    return path, lock_file, orphans
+
+
+class WriteBehindWriter:
+    """
+    Bounded write-behind queue in front of a MongoDB collection
+
+    Every submitted document is appended to a local journal before it is queued, and an
+    acknowledgement record is appended once MongoDB has it. On start, documents without
+    an acknowledgement are replayed. Replays are idempotent because _id is pre-assigned
+    and duplicate-key errors count as success.
+    """
+
+    def __init__(self, collection, journal_path: str = WRITE_BEHIND_JOURNAL,
+                 max_queue: int = WRITE_BEHIND_MAX_QUEUE, batch_size: int = WRITE_BEHIND_BATCH_SIZE,
+                 flush_interval: float = WRITE_BEHIND_FLUSH_INTERVAL, fsync: bool = WRITE_BEHIND_FSYNC,
+                 on_written: Optional[Callable[[List[Dict[str, Any]]], None]] = None):
+        self.collection = collection
+        self.on_written = on_written  # Called with each written batch after it is in MongoDB
+        self.journal_path = journal_path
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.fsync = fsync
+        self._queue: queue.Queue = queue.Queue(maxsize=max_queue)
+        self._backlog: List[Dict[str, Any]] = []  # Replayed documents, written before the queue
+        self._pending: Dict[ObjectId, Dict[str, Any]] = {}
+        self._journal_lock = threading.Lock()
+        self._journal_file_lock = None
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+        self._flushed_total = 0
+        self._flush_count = 0
+        self._failed_flushes = 0
+        self._last_flush_ms = None
+        self._total_flush_ms = 0.0
+        self._last_error = None
+
+        os.makedirs(os.path.dirname(journal_path), exist_ok=True)
+
+    # Journal
+
+    def _append_journal(self, records: List[Dict[str, Any]]):
+        lines = ''.join(json_util.dumps(record, json_options=JOURNAL_JSON_OPTIONS) + '\n' for record in records)
+        with self._journal_lock:
+            with open(self.journal_path, 'a', encoding='utf-8') as journal:
+                journal.write(lines)
+                journal.flush()
+                if self.fsync:
+                    os.fsync(journal.fileno())
+
+    def _compact_journal(self):
+        """Truncate the journal once nothing in it is still pending"""
+        with self._journal_lock:
+            if not self._pending and os.path.exists(self.journal_path):
+                open(self.journal_path, 'w').close()
+
+    def _replay_journal(self, orphan_paths: List[str] = ()) -> int:
+        """Queue every journaled document without an acknowledgement, including those in orphaned journals"""
+        documents: Dict[ObjectId, Dict[str, Any]] = {}
+        acknowledged = set()
+        for path in [self.journal_path, *orphan_paths]:
+            if not os.path.exists(path):
+                continue
+            with open(path, encoding='utf-8') as journal:
+                for line in journal:
+                    line = line.strip()
+                    if not line:
+                        continue
+                    try:
+                        record = json_util.loads(line)
+                    except Exception:
+                        # A torn final line from a crash mid-write
+                        logger.warning("Skipping unreadable write-behind journal line")
+                        continue
+                    if "ack" in record:
+                        acknowledged.update(record["ack"])
+                    else:
+                        documents[record["doc"]["_id"]] = record["doc"]
+
+        unwritten = [doc for doc_id, doc in documents.items() if doc_id not in acknowledged]
+        for doc in unwritten:
+            self._pending[doc["_id"]] = doc
+        self._backlog = list(unwritten)
+
+        # Rewrite the journal with only the unwritten documents, dropping acknowledged and torn lines
+        with self._journal_lock:
+            tmp_path = self.journal_path + '.tmp'
+            with open(tmp_path, 'w', encoding='utf-8') as journal:
+                for doc in unwritten:
+                    journal.write(json_util.dumps({"doc": doc}, json_options=JOURNAL_JSON_OPTIONS) + '\n')
+                journal.flush()
+                os.fsync(journal.fileno())
+            os.replace(tmp_path, self.journal_path)
+        # The orphaned documents now live in this process's journal
+        for path in orphan_paths:
+            os.remove(path)
+
+        if unwritten:
+            logger.info(f"Replaying {len(unwritten)} unwritten reports from the write-behind journal")
+        return len(unwritten)
+
+    # Public API
+
+    def start(self):
+        """Claim a journal, replay it and start the flush thread (call in the process that will serve requests)"""
+        self.journal_path, self._journal_file_lock, orphans = claim_journal(self.journal_path)
+        try:
+            self._replay_journal([path for path, _ in orphans])
+        finally:
+            for _, orphan_lock in orphans:
+                orphan_lock.close()
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, daemon=True, name='write-behind')
+        self._thread.start()
+        atexit.register(self.stop)
+
+    def submit(self, doc: Dict[str, Any], timeout: float = WRITE_BEHIND_ENQUEUE_TIMEOUT) -> ObjectId:
+        """
+        Journal a copy of a document and queue it for insertion; returns its (pre-assigned) _id
+
+        Raises WriteQueueFullError if the queue stays full for `timeout` seconds.
+        """
+        doc.setdefault("_id", ObjectId())
+        # Queue a snapshot: the caller may keep changing its dict (or objects it shares, like the
+        # analysis result) while the flush thread encodes it, and the journal must match what is written
+        doc = copy.deepcopy(doc)
+        # Register as pending before journaling so a concurrent compaction cannot drop it
+        self._pending[doc["_id"]] = doc
+        self._append_journal([{"doc": doc}])
+        try:
+            self._queue.put(doc, timeout=timeout)
+        except queue.Full:
+            self._pending.pop(doc["_id"], None)
+            self._append_journal([{"ack": [doc["_id"]]}])
+            raise WriteQueueFullError(f"Write queue is full ({self._queue.maxsize} documents)")
+        return doc["_id"]
+
+    def latest_pending(self, patient_id: str) -> Optional[Dict[str, Any]]:
+        """The newest not-yet-written document for a patient, if any"""
+        candidates = [doc for doc in list(self._pending.values()) if doc.get("patient_id") == patient_id]
+        if not candidates:
+            return None
+        return max(candidates, key=lambda doc: (doc.get("created_at"), doc["_id"]))
+
+    def get_pending(self, doc_id: ObjectId) -> Optional[Dict[str, Any]]:
+        return self._pending.get(doc_id)
+
+    def flush(self, timeout: float = 10.0) -> bool:
+        """Wait until every queued document has been written; returns False on timeout"""
+        deadline = time.monotonic() + timeout
+        while self._pending and time.monotonic() < deadline:
+            time.sleep(0.05)
+        return not self._pending
+
+    def stop(self, timeout: float = 10.0):
+        if self._thread is None:
+            return
+        self.flush(timeout)
+        self._stop.set()
+        self._thread.join(timeout=timeout)
+        self._thread = None
+
+    def stats(self) -> Dict[str, Any]:
+        journal_bytes = os.path.getsize(self.journal_path) if os.path.exists(self.journal_path) else 0
+        return {
+            "queue_depth": self._queue.qsize() + len(self._backlog),
+            "queue_capacity": self._queue.maxsize,
+            "pending": len(self._pending),
+            "flushed_total": self._flushed_total,
+            "failed_flushes": self._failed_flushes,
+            "last_flush_ms": self._last_flush_ms,
+            "avg_flush_ms": round(self._total_flush_ms / self._flush_count, 3) if self._flush_count else None,
+            "journal_bytes": journal_bytes,
+            "last_error": self._last_error
+        }
+
+    # Flush thread
+
+    def _next_batch(self) -> List[Dict[str, Any]]:
+        """Collect up to batch_size documents, waiting at most flush_interval after the first"""
+        if self._backlog:
+            batch, self._backlog = self._backlog[:self.batch_size], self._backlog[self.batch_size:]
+            return batch
+        try:
+            batch = [self._queue.get(timeout=self.flush_interval)]
+        except queue.Empty:
+            return []
+        deadline = time.monotonic() + self.flush_interval
+        while len(batch) < self.batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _write_batch(self, batch: List[Dict[str, Any]]):
+        """Insert a batch; documents already in MongoDB are skipped"""
+        started = time.perf_counter()
+        try:
+            self.collection.insert_many(batch, ordered=False)
+        except BulkWriteError as e:
+            # Documents that already exist were written by an earlier attempt or replay
+            write_errors = e.details.get("writeErrors", [])
+            errors = [error for error in write_errors if error.get("code") != DUPLICATE_KEY_ERROR]
+            if errors:
+                raise
+        elapsed_ms = (time.perf_counter() - started) * 1000
+        self._last_flush_ms = round(elapsed_ms, 3)
+        self._total_flush_ms += elapsed_ms
+        self._flush_count += 1
+
+    def _run(self):
+        retry_delay = 0.5
+        batch: List[Dict[str, Any]] = []
+        while not (self._stop.is_set() and not batch and self._queue.empty()):
+            if not batch:
+                batch = self._next_batch()
+                if not batch:
+                    continue
+            try:
+                self._write_batch(batch)
+            except Exception as e:
+                self._failed_flushes += 1
+                self._last_error = str(e)
+                if self._stop.is_set():
+                    # Shutting down: unwritten documents stay in the journal for the next start
+                    logger.error(f"Write-behind flush of {len(batch)} reports failed during shutdown: {e}")
+                    break
+                logger.error(f"Write-behind flush of {len(batch)} reports failed, retrying in {retry_delay}s: {e}")
+                self._stop.wait(retry_delay)
+                retry_delay = min(retry_delay * 2, MAX_RETRY_DELAY)
+                continue
+
+            retry_delay = 0.5
+            written_ids = [doc["_id"] for doc in batch]
+            self._append_journal([{"ack": written_ids}])
+            for doc_id in written_ids:
+                self._pending.pop(doc_id, None)
+            self._flushed_total += len(batch)
+            if self.on_written is not None:
+                # The whole batch, including documents an earlier attempt or replay already
+                # inserted, so the callback must be idempotent per document _id
+                try:
+                    self.on_written(batch)
+                except Exception as e:
+                    logger.error(f"Write-behind on_written callback failed: {e}")
+            batch = []
+            if not self._pending:
+                self._compact_journal()
+
+
+def create_report_writer(collection, on_written=None) -> Optional[WriteBehindWriter]:
+    """Create and start the writer configured by the environment, or None for synchronous inserts"""
+    if not WRITE_BEHIND_ENABLED or collection is None:
+        return None
+    writer = WriteBehindWriter(collection, on_written=on_written)
+    writer.start()
+    return writer
@@ -0,0 +1,259 @@
+# profiling.py
+# Opt-in per-request profiling: stage timing tree, cProfile dumps and a slow-request log
+#
+# Profiling is enabled for a request by the "X-Profile: 1" header, the "profile=1"
+# query parameter, or random sampling (PROFILE_SAMPLE_RATE). When it is off, each
+# instrumented stage costs one ContextVar lookup.
+#
+# Only one request per process is run under cProfile at a time: from Python 3.12
+# a second profiler cannot be enabled while another thread's is active. Profiled
+# requests that overlap it still get their stage timing tree, without a dump.
+
+import os
+import io
+import json
+import time
+import uuid
+import random
+import pstats
+import cProfile
+import logging
+import threading
+import contextvars
+from collections import deque
+from functools import wraps
+from typing import Dict, Any, List, Optional
+
+# Configure logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Configuration
+PROFILE_DIR = os.environ.get(
+    'PROFILE_DIR',
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), 'profiles')
+)
+PROFILE_SAMPLE_RATE = float(os.environ.get('PROFILE_SAMPLE_RATE', 0))  # Fraction of requests profiled automatically
+PROFILE_SLOW_MS = float(os.environ.get('PROFILE_SLOW_MS', 1000))  # Profiled requests slower than this are kept
+PROFILE_HISTORY = int(os.environ.get('PROFILE_HISTORY', 50))  # Number of slow requests kept in memory
+
+_active_profile: contextvars.ContextVar = contextvars.ContextVar('active_profile', default=None)
+_slow_requests = deque(maxlen=PROFILE_HISTORY)
+_slow_requests_lock = threading.Lock()
+_cprofile_lock = threading.Lock()  # Held while a request runs under cProfile
+
+
+class _Stage:
+    __slots__ = ('name', 'start', 'duration_ms', 'children')
+
+    def __init__(self, name: str):
+        self.name = name
+        self.start = time.perf_counter()
+        self.duration_ms = None
+        self.children = []
+
+    def to_dict(self) -> Dict[str, Any]:
+        node = {"name": self.name, "ms": round(self.duration_ms or 0.0, 3)}
+        if self.children:
+            node["children"] = [child.to_dict() for child in self.children]
+        return node
+
+
+class RequestProfile:
+    """Stage timing tree plus cProfile data for a single request"""
+
+    def __init__(self, name: str):
+        self.id = uuid.uuid4().hex[:12]
+        self.name = name
+        self.root = _Stage(name)
+        self._stack = [self.root]
+        self._profiler = None  # Only set if this request got the cProfile lock
+        self._holds_lock = False
+        self.dump_path = None
+        self.token = None
+
+    def enter(self, name: str) -> _Stage:
+        stage = _Stage(name)
+        self._stack[-1].children.append(stage)
+        self._stack.append(stage)
+        return stage
+
+    def exit(self, stage: _Stage):
+        stage.duration_ms = (time.perf_counter() - stage.start) * 1000
+        if self._stack and self._stack[-1] is stage:
+            self._stack.pop()
+
+    def start(self):
+        """Start cProfile, unless another request in this process is already using it"""
+        if not _cprofile_lock.acquire(blocking=False):
+            return
+        try:
+            profiler = cProfile.Profile()
+            profiler.enable()
+        except Exception as e:
+            _cprofile_lock.release()
+            logger.warning(f"cProfile unavailable for {self.name}: {e}")
+            return
+        self._profiler = profiler
+        self._holds_lock = True
+
+    def stop(self):
+        if self._holds_lock:
+            self._profiler.disable()
+            self._holds_lock = False
+            _cprofile_lock.release()
+        self.root.duration_ms = (time.perf_counter() - self.root.start) * 1000
+
+    def dump(self, directory: str) -> Optional[str]:
+        """Write the cProfile data as a pstats file and return its path (None without cProfile data)"""
+        if self._profiler is None:
+            return None
+        os.makedirs(directory, exist_ok=True)
+        safe_name = ''.join(c if c.isalnum() else '_' for c in self.name).strip('_')
+        path = os.path.join(directory, f"{time.strftime('%Y%m%d-%H%M%S')}_{safe_name}_{self.id}.pstats")
+        self._profiler.dump_stats(path)
+        self.dump_path = path
+        return path
+
+    def top_functions(self, limit: int = 15) -> str:
+        if self._profiler is None:
+            return ""
+        buffer = io.StringIO()
+        pstats.Stats(self._profiler, stream=buffer).sort_stats('cumulative').print_stats(limit)
+        return buffer.getvalue()
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "id": self.id,
+            "total_ms": round(self.root.duration_ms or 0.0, 3),
+            "stages": self.root.to_dict(),
+            "dump_path": self.dump_path
+        }
+
+
+class _StageTimer:
+    __slots__ = ('profile', 'name', 'stage')
+
+    def __init__(self, profile: RequestProfile, name: str):
+        self.profile = profile
+        self.name = name
+
+    def __enter__(self):
+        self.stage = self.profile.enter(self.name)
+        return self.stage
+
+    def __exit__(self, *exc_info):
+        self.profile.exit(self.stage)
+        return False
+
+
+class _NullStage:
+    __slots__ = ()
+
+    def __enter__(self):
+        return None
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+_NULL_STAGE = _NullStage()
+
+
+def stage(name: str):
+    """Context manager timing a named stage of the current profiled request (no-op otherwise)"""
+    profile = _active_profile.get()
+    if profile is None:
+        return _NULL_STAGE
+    return _StageTimer(profile, name)
+
+
+def timed_stage(name: str):
+    """Decorator version of stage()"""
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            profile = _active_profile.get()
+            if profile is None:
+                return func(*args, **kwargs)
+            with _StageTimer(profile, name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def start_profile(name: str) -> RequestProfile:
+    """Start profiling the current context (used by the Flask hooks and by benchmarks)"""
+    profile = RequestProfile(name)
+    profile.token = _active_profile.set(profile)
+    profile.start()
+    return profile
+
+
+def finish_profile(profile: RequestProfile, dump_dir: Optional[str] = PROFILE_DIR) -> Dict[str, Any]:
+    """Stop profiling, write the pstats dump and record the request if it was slow"""
+    profile.stop()
+    _active_profile.reset(profile.token)
+    if dump_dir:
+        try:
+            profile.dump(dump_dir)
+        except Exception as e:
+            logger.error(f"Failed to write profile dump: {e}")
+
+    summary = profile.to_dict()
+    if summary["total_ms"] >= PROFILE_SLOW_MS:
+        with _slow_requests_lock:
+            _slow_requests.appendleft(dict(
+                summary,
+                name=profile.name,
+                recorded_at=time.time(),
+                top_functions=profile.top_functions()
+            ))
+    return summary
+
+
+def slow_requests(min_ms: float = 0) -> List[Dict[str, Any]]:
+    with _slow_requests_lock:
+        return [entry for entry in _slow_requests if entry["total_ms"] >= min_ms]
+
+
+def _profiling_requested(request) -> bool:
+    if request.headers.get('X-Profile') == '1' or request.args.get('profile') == '1':
+        return True
+    return PROFILE_SAMPLE_RATE > 0 and random.random() < PROFILE_SAMPLE_RATE
+
+
+def init_profiling(app):
+    """Register the Flask hooks that start and finish request profiles"""
+    from flask import request, g
+
+    @app.before_request
+    def _start_request_profile():
+        if _profiling_requested(request):
+            g.request_profile = start_profile(f"{request.method} {request.path}")
+
+    @app.after_request
+    def _finish_request_profile(response):
+        profile = g.pop('request_profile', None)
+        if profile is None:
+            return response
+
+        summary = finish_profile(profile)
+        response.headers['X-Profile-Id'] = profile.id
+        response.headers['X-Profile-Total-Ms'] = str(summary["total_ms"])
+
+        # Attach the stage tree to JSON object responses
+        if response.is_json and not response.is_streamed:
+            body = response.get_json(silent=True)
+            if isinstance(body, dict):
+                body["profile"] = summary
+                response.set_data(json.dumps(body))
+        return response
+
+    @app.teardown_request
+    def _discard_request_profile(_exc):
+        # Only reached with a profile still set if the request failed before after_request
+        profile = g.pop('request_profile', None)
+        if profile is not None:
+            profile.stop()
+            _active_profile.reset(profile.token)
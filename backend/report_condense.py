@@ -0,0 +1,207 @@
+# report_condense.py
+# Trim report text to a token budget before it is sent to the LLM
+#
+# Pasted multi-page histories are mostly letterheads, page footers, signatures
+# and sections repeated from earlier reports. Condensing removes those first,
+# then, if the text is still over budget, keeps the most clinically relevant
+# sentences (scored with the entity and severity patterns from compare.py) in
+# their original order.
+
+import os
+import re
+import math
+import logging
+import threading
+from typing import Dict, Any, List, Tuple
+from compare import extract_medical_entities, extract_severity_indicators, extract_explicit_percentages
+
+# Configure logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Configuration
+REPORT_CONDENSING_ENABLED = os.environ.get('REPORT_CONDENSING', '1') != '0'
+REPORT_TOKEN_BUDGET = int(os.environ.get('REPORT_TOKEN_BUDGET', 1500))  # Prompt tokens allowed for the report text
+CHARS_PER_TOKEN = 4  # Rough size of a Llama token in English clinical text
+MAX_DROPPED_LISTED = 50  # Dropped lines/sentences quoted back in the response
+DROPPED_PREVIEW_CHARS = 120
+OMISSION_MARKER = "[...]"
+
+# Lines that carry no clinical content
+BOILERPLATE_PATTERNS = [re.compile(pattern, re.IGNORECASE) for pattern in [
+    r"^\s*page\s+\d+(\s+of\s+\d+)?\s*$",
+    r"^\s*[-=_*#~.]{3,}\s*$",
+    r"^\s*(confidential|privileged and confidential|for internal use only)\b",
+    r"^\s*(electronically\s+)?(signed|verified|dictated|transcribed|approved)\s+(by|on)\b",
+    r"^\s*(printed|generated|faxed|report date|date printed)\s*(on|:)",
+    r"^\s*(tel|phone|fax|e-?mail)\s*[:.#]",
+    r"^\s*(https?://|www\.)\S+\s*$",
+    r"^\s*(mrn|acc(ession)?(\s+(no|number|#))?|account|dob|date of birth|ssn|encounter)\s*[:#]",
+    r"this (report|document|message) (is|may be) (confidential|intended)",
+    r"^\s*(disclaimer|cc|copies to)\s*:",
+]]
+# Section headings whose sentences matter most
+KEY_SECTION_PATTERN = re.compile(r"^\s*(impression|conclusion|findings|diagnosis|assessment|summary)\s*:?", re.IGNORECASE)
+SECTION_HEADING_PATTERN = re.compile(r"^\s*([A-Z][A-Za-z /&]{2,40}):\s*")
+SENTENCE_SPLIT_PATTERN = re.compile(r"(?<=[.!?;])\s+")
+
+_metrics = {
+    "requests": 0,
+    "condensed": 0,
+    "tokens_in": 0,
+    "tokens_out": 0
+}
+_metrics_lock = threading.Lock()
+
+
+def estimate_tokens(text: str) -> int:
+    """Approximate token count (no tokenizer for the remote model is available locally)"""
+    return math.ceil(len(text) / CHARS_PER_TOKEN)
+
+
+def _normalize(text: str) -> str:
+    return re.sub(r"\s+", " ", text).strip().lower()
+
+
+def _preview(text: str) -> str:
+    text = re.sub(r"\s+", " ", text).strip()
+    return text if len(text) <= DROPPED_PREVIEW_CHARS else text[:DROPPED_PREVIEW_CHARS - 3] + "..."
+
+
+def split_sentences(report_text: str) -> List[Tuple[str, str, bool]]:
+    """
+    Split a report into sentences, dropping boilerplate lines
+
+    Returns (sentence, reason, in_key_section) for every piece of text, where
+    reason is "" for kept sentences and "boilerplate" for dropped lines.
+    """
+    pieces = []
+    in_key_section = False
+    for line in report_text.splitlines():
+        if not line.strip():
+            continue
+        if any(pattern.search(line) for pattern in BOILERPLATE_PATTERNS):
+            pieces.append((line.strip(), "boilerplate", False))
+            continue
+        heading = SECTION_HEADING_PATTERN.match(line)
+        if heading:
+            in_key_section = bool(KEY_SECTION_PATTERN.match(line))
+        for sentence in SENTENCE_SPLIT_PATTERN.split(line.strip()):
+            if sentence:
+                pieces.append((sentence, "", in_key_section))
+    return pieces
+
+
+def relevance_score(sentence: str, in_key_section: bool) -> float:
+    """Clinical relevance of one sentence: entity, severity and percentage pattern hits"""
+    entities = extract_medical_entities(sentence)
+    severity = extract_severity_indicators(sentence)
+    percentages = extract_explicit_percentages(sentence)
+    score = (
+        2.0 * len(entities["conditions"]) +
+        1.5 * len(entities["findings"]) +
+        1.5 * len(entities["measurements"]) +
+        1.0 * len(entities["treatments"]) +
+        1.5 * len(entities["recovery_indicators"]) +
+        3.0 * len(severity["severity"]) +
+        2.0 * len(severity["improvement"]) +
+        2.0 * sum(len(found) for found in percentages)
+    )
+    if in_key_section:
+        score += 3.0
+    # Short fragments (headings, labels) cost little but say little
+    return score / max(1.0, estimate_tokens(sentence) / 20)
+
+
+def condense_report(report_text: str, token_budget: int = REPORT_TOKEN_BUDGET) -> Tuple[str, Dict[str, Any]]:
+    """
+    Remove boilerplate and repeated sentences, then keep the most relevant sentences within token_budget
+
+    Returns (condensed_text, info) where info has the token counts and lists what was dropped.
+    """
+    original_tokens = estimate_tokens(report_text)
+    dropped: List[Dict[str, str]] = []
+    counts = {"boilerplate": 0, "duplicate": 0, "low_relevance": 0, "truncated": 0}
+
+    candidates = []  # (position, sentence, in_key_section)
+    seen = set()
+    for sentence, reason, in_key_section in split_sentences(report_text):
+        if not reason:
+            key = _normalize(sentence)
+            if key in seen:
+                reason = "duplicate"
+            else:
+                seen.add(key)
+        if reason:
+            counts[reason] += 1
+            dropped.append({"reason": reason, "text": _preview(sentence)})
+        else:
+            candidates.append((len(candidates), sentence, in_key_section))
+
+    kept = {position for position, _sentence, _key in candidates}
+    truncated: Dict[int, str] = {}  # Position -> head of a sentence too long for the budget on its own
+    separator_tokens = 1
+    total_tokens = sum(estimate_tokens(sentence) + separator_tokens for _p, sentence, _k in candidates)
+    if total_tokens > token_budget:
+        # Most relevant first; ties go to the later sentence (newer reports come last in pasted histories)
+        ranked = sorted(candidates, key=lambda item: (relevance_score(item[1], item[2]), item[0]), reverse=True)
+        kept = set()
+        used = estimate_tokens(OMISSION_MARKER)
+        for position, sentence, _in_key_section in ranked:
+            cost = estimate_tokens(sentence) + separator_tokens
+            if used + cost <= token_budget:
+                kept.add(position)
+                used += cost
+            elif cost > token_budget - estimate_tokens(OMISSION_MARKER):
+                # Would never fit; keep its head rather than lose it whole
+                room = token_budget - used - separator_tokens - estimate_tokens(f" {OMISSION_MARKER}")
+                if room <= 0:
+                    continue
+                head = sentence[:room * CHARS_PER_TOKEN].rsplit(" ", 1)[0]
+                truncated[position] = f"{head} {OMISSION_MARKER}"
+                kept.add(position)
+                used += estimate_tokens(truncated[position]) + separator_tokens
+                counts["truncated"] += 1
+        for position, sentence, _in_key_section in candidates:
+            if position not in kept:
+                counts["low_relevance"] += 1
+                dropped.append({"reason": "low_relevance", "text": _preview(sentence)})
+
+    # Rebuild in the original order, marking where sentences were left out
+    parts = []
+    for position, sentence, _in_key_section in candidates:
+        if position in kept:
+            parts.append(truncated.get(position, sentence))
+        elif not parts or parts[-1] != OMISSION_MARKER:
+            parts.append(OMISSION_MARKER)
+    condensed = "\n".join(parts)
+    if not kept and report_text.strip():
+        # Nothing survived (e.g. every line looked like boilerplate); the start of the report beats no report
+        condensed = report_text[:token_budget * CHARS_PER_TOKEN]
+    condensed_tokens = estimate_tokens(condensed)
+
+    with _metrics_lock:
+        _metrics["requests"] += 1
+        _metrics["condensed"] += int(condensed_tokens < original_tokens)
+        _metrics["tokens_in"] += original_tokens
+        _metrics["tokens_out"] += condensed_tokens
+
+    return condensed, {
+        "token_budget": token_budget,
+        "original_tokens": original_tokens,
+        "condensed_tokens": condensed_tokens,
+        "tokens_saved": original_tokens - condensed_tokens,
+        "dropped_counts": counts,
+        "dropped": dropped[:MAX_DROPPED_LISTED]
+    }
+
+
+def condensing_stats() -> Dict[str, Any]:
+    """Totals since start; token counts are estimates"""
+    with _metrics_lock:
+        stats = dict(_metrics)
+    saved = stats["tokens_in"] - stats["tokens_out"]
+    stats["tokens_saved"] = saved
+    stats["avg_tokens_saved_per_request"] = round(saved / stats["requests"], 1) if stats["requests"] else 0.0
+    stats["token_budget"] = REPORT_TOKEN_BUDGET
+    return stats
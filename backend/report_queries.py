@@ -0,0 +1,330 @@
+# report_queries.py
+# Indexes, keyset pagination and count caching for patient report listings
+
+import time
+import json
+import base64
+import logging
+import threading
+from datetime import datetime
+from typing import Dict, Any, Optional, Tuple, List, Iterator
+from bson.objectid import ObjectId
+
+try:
+    import orjson
+except ImportError:  # Falls back to the standard library serializer
+    orjson = None
+
+# Configure logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Sort keys accepted by the listing endpoint, mapped to document fields.
+# Every entry has a matching (patient_id, field, _id) index, so sorting never happens in memory.
+SORT_FIELDS = {
+    "created_at": "created_at",
+    "anomaly_detected": "anomaly_detected",
+    "scan_type": "analysis_result.scan_type"
+}
+DEFAULT_SORT = "created_at"
+MAX_PAGE_SIZE = 100
+COUNT_CACHE_TTL = 60  # Seconds a per-patient report count is reused
+EXPORT_BATCH_SIZE = 500  # Documents fetched per round trip while exporting
+
+# Lightweight listing shape, computed inside MongoDB so large fields never leave the database
+SUMMARY_PROJECTION = {
+    "created_at": 1,
+    "scan_filename": 1,
+    "scan_hash": 1,
+    "anomaly_detected": 1,
+    "scan_type": "$analysis_result.scan_type",
+    "finding_count": {"$size": {"$ifNull": ["$analysis_result.anomaly_detection.findings", []]}}
+}
+# Fields a client may request explicitly with fields=
+SELECTABLE_FIELDS = {
+    "patient_id",
+    "scan_filename",
+    "scan_hash",
+    "created_at",
+    "anomaly_detected",
+    "report_text",
+    "analysis_result",
+    "analysis_result.scan_type",
+    "analysis_result.anomaly_detection",
+    "analysis_result.anomaly_detection.anomaly_detected",
+    "analysis_result.anomaly_detection.findings",
+    "analysis_result.report_analysis",
+    "longitudinal"
+}
+# Excluded from the full view: internal data that clients never render
+FULL_VIEW_EXCLUDED = {"analysis_artifacts": 0}
+
+
+def ensure_indexes(collection):
+    """Create the compound indexes that back every allowed listing sort"""
+    for sort_key, field in SORT_FIELDS.items():
+        collection.create_index(
+            [("patient_id", 1), (field, -1), ("_id", -1)],
+            name=f"patient_id_{sort_key}_id"
+        )
+    # Cohort-wide date-range exports and aggregations
+    collection.create_index([("created_at", -1)], name="created_at")
+    logger.info("Ensured patient_reports indexes")
+
+
+def ensure_indexes_async(collection):
+    """Ensure indexes without blocking startup when MongoDB is slow or unreachable"""
+    def run():
+        try:
+            ensure_indexes(collection)
+        except Exception as e:
+            logger.error(f"Failed to ensure patient_reports indexes: {e}")
+
+    thread = threading.Thread(target=run, daemon=True, name='ensure-indexes')
+    thread.start()
+    return thread
+
+
+def get_field(doc: Dict[str, Any], path: str):
+    """Read a dotted field path from a document"""
+    value = doc
+    for part in path.split('.'):
+        if not isinstance(value, dict):
+            return None
+        value = value.get(part)
+    return value
+
+
+def _encode_value(value):
+    if isinstance(value, datetime):
+        return {"$date": value.isoformat()}
+    return value
+
+
+def _decode_value(value):
+    if isinstance(value, dict) and "$date" in value:
+        return datetime.fromisoformat(value["$date"])
+    return value
+
+
+def encode_cursor(sort_key: str, direction: int, last_doc: Dict[str, Any]) -> str:
+    """Build an opaque continuation token pointing just after last_doc"""
+    payload = {
+        "s": sort_key,
+        "d": direction,
+        "v": _encode_value(get_field(last_doc, SORT_FIELDS[sort_key])),
+        "id": str(last_doc["_id"])
+    }
+    return base64.urlsafe_b64encode(json.dumps(payload, separators=(',', ':')).encode()).decode().rstrip('=')
+
+
+def decode_cursor(token: str) -> Dict[str, Any]:
+    """Parse a continuation token; raises ValueError if it is malformed"""
+    try:
+        padded = token + '=' * (-len(token) % 4)
+        payload = json.loads(base64.urlsafe_b64decode(padded.encode()))
+        return {
+            "sort": payload["s"],
+            "direction": int(payload["d"]),
+            "value": _decode_value(payload["v"]),
+            "id": ObjectId(payload["id"])
+        }
+    except Exception as e:
+        raise ValueError(f"Invalid cursor: {e}")
+
+
+def keyset_filter(field: str, direction: int, last_value, last_id: ObjectId) -> Dict[str, Any]:
+    """
+    Filter selecting the documents that sort after (last_value, last_id)
+
+    MongoDB sorts missing/null values before everything else, so they come last in
+    descending order and first in ascending order.
+    """
+    if direction < 0:
+        if last_value is None:
+            return {field: None, "_id": {"$lt": last_id}}
+        return {"$or": [
+            {field: {"$lt": last_value}},
+            {field: last_value, "_id": {"$lt": last_id}},
+            {field: None}
+        ]}
+
+    if last_value is None:
+        return {"$or": [
+            {field: None, "_id": {"$gt": last_id}},
+            {field: {"$ne": None}}
+        ]}
+    return {"$or": [
+        {field: {"$gt": last_value}},
+        {field: last_value, "_id": {"$gt": last_id}}
+    ]}
+
+
+def parse_listing_sort(sort_key: str, order: str) -> Tuple[str, int]:
+    """Validate the sort parameters; raises ValueError for fields without an index"""
+    if sort_key not in SORT_FIELDS:
+        raise ValueError(f"Invalid sort field '{sort_key}'. Allowed: {', '.join(SORT_FIELDS)}")
+    return sort_key, -1 if order.lower() == 'desc' else 1
+
+
+def build_listing_projection(view: str = 'summary', fields: Optional[str] = None) -> Dict[str, Any]:
+    """
+    Build the MongoDB projection for a report listing
+
+    Args:
+        view: 'summary' (default) for the lightweight shape or 'full' for whole documents
+        fields: Optional comma-separated field list; overrides view
+
+    Raises ValueError for unknown views or fields.
+    """
+    if fields:
+        requested = [field.strip() for field in fields.split(',') if field.strip()]
+        unknown = [field for field in requested if field not in SELECTABLE_FIELDS]
+        if unknown:
+            raise ValueError(f"Unknown fields: {', '.join(unknown)}. Allowed: {', '.join(sorted(SELECTABLE_FIELDS))}")
+        # A parent and its child cannot both be projected; keep the parent
+        requested = [field for field in requested
+                     if not any(field.startswith(other + '.') for other in requested)]
+        return {field: 1 for field in requested}
+    if view == 'summary':
+        return dict(SUMMARY_PROJECTION)
+    if view == 'full':
+        return dict(FULL_VIEW_EXCLUDED)
+    raise ValueError(f"Invalid view '{view}'. Allowed: summary, full")
+
+
+def _is_inclusion(projection: Dict[str, Any]) -> bool:
+    return any(value != 0 for value in projection.values())
+
+
+class CountCache:
+    """Short-lived per-patient report counts, invalidated when a patient gets a new report"""
+
+    def __init__(self, ttl: float = COUNT_CACHE_TTL):
+        self.ttl = ttl
+        self._counts: Dict[str, Tuple[int, float]] = {}
+        self._lock = threading.Lock()
+
+    def get_or_count(self, collection, patient_id: str) -> int:
+        now = time.monotonic()
+        with self._lock:
+            cached = self._counts.get(patient_id)
+        if cached and now - cached[1] < self.ttl:
+            return cached[0]
+
+        count = collection.count_documents({"patient_id": patient_id})
+        with self._lock:
+            self._counts[patient_id] = (count, now)
+        return count
+
+    def invalidate(self, patient_id: str):
+        with self._lock:
+            self._counts.pop(patient_id, None)
+
+
+def find_report_page(collection, patient_id: str, sort_key: str, direction: int, limit: int,
+                     cursor: Optional[Dict[str, Any]] = None, skip: int = 0,
+                     projection: Optional[Dict[str, Any]] = None):
+    """
+    Fetch one page of a patient's reports
+
+    Returns (documents, next_cursor). With a cursor the page starts right after it
+    (keyset pagination); without one, skip is applied for backwards compatibility.
+    """
+    assert limit >= 1, "limit must be at least 1"
+    field = SORT_FIELDS[sort_key]
+    query = {"patient_id": patient_id}
+    if cursor is not None:
+        if cursor["sort"] != sort_key or cursor["direction"] != direction:
+            raise ValueError("Cursor was issued for a different sort order")
+        query.update(keyset_filter(field, direction, cursor["value"], cursor["id"]))
+
+    # The continuation token needs the raw sort value, so make sure it is projected
+    added_field = None
+    if projection and _is_inclusion(projection) and not any(
+            field == key or field.startswith(key + '.') for key in projection):
+        top_level = field.split('.')[0]
+        if not any(key.split('.')[0] == top_level for key in projection):
+            added_field = top_level
+        projection = dict(projection, **{field: 1})
+
+    find_cursor = collection.find(query, projection).sort([(field, direction), ("_id", direction)])
+    if cursor is None and skip:
+        find_cursor = find_cursor.skip(skip)
+    # Fetch one extra document to know whether another page exists
+    docs = list(find_cursor.limit(limit + 1))
+
+    next_cursor = None
+    if len(docs) > limit:
+        docs = docs[:limit]
+        next_cursor = encode_cursor(sort_key, direction, docs[-1])
+    if added_field:
+        for doc in docs:
+            doc.pop(added_field, None)
+    return docs, next_cursor
+
+
+def _json_default(value):
+    if isinstance(value, ObjectId):
+        return str(value)
+    if isinstance(value, datetime):
+        return value.isoformat()
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+
+def dumps_document(doc: Dict[str, Any]) -> bytes:
+    """Serialize a MongoDB document to compact JSON, handling ObjectId and datetime natively"""
+    if orjson is not None:
+        return orjson.dumps(doc, default=_json_default)
+    return json.dumps(doc, default=_json_default, separators=(',', ':')).encode('utf-8')
+
+
+def build_export_query(patient_ids: Optional[List[str]] = None, date_from: Optional[datetime] = None,
+                       date_to: Optional[datetime] = None, anomaly_detected: Optional[bool] = None) -> Dict[str, Any]:
+    """Build the filter for a report export"""
+    query: Dict[str, Any] = {}
+    if patient_ids:
+        query["patient_id"] = patient_ids[0] if len(patient_ids) == 1 else {"$in": patient_ids}
+    if date_from or date_to:
+        query["created_at"] = {}
+        if date_from:
+            query["created_at"]["$gte"] = date_from
+        if date_to:
+            query["created_at"]["$lt"] = date_to
+    if anomaly_detected is not None:
+        query["anomaly_detected"] = anomaly_detected
+    return query
+
+
+def export_sort(query: Dict[str, Any]) -> List[Tuple[str, int]]:
+    """Pick a sort order that an index can serve for the given export filter"""
+    if "patient_id" in query:
+        return [("patient_id", 1), ("created_at", -1), ("_id", -1)]
+    if "created_at" in query:
+        # Served by the created_at index, which also bounds the scan to the date range
+        return [("created_at", -1)]
+    return [("_id", 1)]
+
+
+def iter_export(collection, query: Dict[str, Any], projection: Optional[Dict[str, Any]] = None,
+                output_format: str = 'ndjson', batch_size: int = EXPORT_BATCH_SIZE) -> Iterator[bytes]:
+    """
+    Stream matching reports as NDJSON lines or as a chunked JSON array
+
+    Documents are fetched from the cursor in batches and serialized one at a time,
+    so memory use does not depend on the size of the export.
+    """
+    cursor = collection.find(query, projection).sort(export_sort(query)).batch_size(batch_size)
+    try:
+        if output_format == 'json':
+            yield b'['
+            first = True
+            for doc in cursor:
+                yield dumps_document(doc) if first else b',' + dumps_document(doc)
+                first = False
+            yield b']'
+        else:
+            for doc in cursor:
+                yield dumps_document(doc) + b'\n'
+    finally:
+        cursor.close()
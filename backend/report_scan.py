@@ -9,9 +9,13 @@ from typing import List, Optional, Dict, Any, Union
 import numpy as np
 from PIL import Image
 import pydicom
+from pydicom.pixels import pixel_array
 import nibabel as nib
 from groq import Groq
 from pydantic import BaseModel, Field
+from profiling import timed_stage
+from report_condense import condense_report, REPORT_CONDENSING_ENABLED
+from model_calls import ModelCaller, DeadlineExceeded
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
@@ -21,6 +25,9 @@ logger = logging.getLogger(__name__)
 UPLOAD_FOLDER = 'uploads'
 ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'dcm', 'nii', 'nii.gz'}
 os.makedirs(UPLOAD_FOLDER, exist_ok=True)
+GROQ_API_KEY = os.environ.get('GROQ_API_KEY')
+GROQ_BASE_URL = os.environ.get('GROQ_BASE_URL')  # e.g. http://127.0.0.1:8900 for benchmarks.groq_standin
+GROQ_MAX_RETRIES = int(os.environ.get('GROQ_MAX_RETRIES', 2))
 
 # Pydantic models for structured output
 class Finding(BaseModel):
@@ -39,6 +46,7 @@ class AnomalyDetection(BaseModel):
 class ReportAnalysis(BaseModel):
     report_analysis: str
     findings: List[str] = []
+    condensing: Optional[Dict[str, Any]] = None  # What was removed from the report before the LLM call
 
 class ScanAnalysisResult(BaseModel):
     scan_type: str
@@ -50,69 +58,106 @@ class HealthStatus(BaseModel):
     groq_client_status: str
 
 # Initialize Groq client
-try:
-    groq_client = Groq(api_key="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")
-    logger.info("Groq client initialized successfully")
-except Exception as e:
-    logger.error(f"Failed to initialize Groq client: {str(e)}")
-    groq_client = None
+def init_groq_client():
+    """(Re)create the Groq client; forked workers call this so they don't share HTTP connections"""
+    global groq_client
+    if not GROQ_API_KEY:
+        logger.error("GROQ_API_KEY is not set; scan and report analysis are disabled")
+        groq_client = None
+        return groq_client
+    try:
+        groq_client = Groq(api_key=GROQ_API_KEY, base_url=GROQ_BASE_URL, max_retries=GROQ_MAX_RETRIES)
+        logger.info(f"Groq client initialized successfully ({GROQ_BASE_URL or 'default endpoint'})")
+    except Exception as e:
+        logger.error(f"Failed to initialize Groq client: {str(e)}")
+        groq_client = None
+    return groq_client
+
+groq_client = None
+init_groq_client()
+model_caller = ModelCaller()  # Every Groq call goes through this for deadlines and hedging
+
+def scan_format(filename):
+    """Format key for a scan file name ('nii.gz' for compressed NIfTI)"""
+    lower = filename.lower()
+    if lower.endswith('.nii.gz'):
+        return 'nii.gz'
+    return lower.split('.')[-1]
 
 def allowed_file(filename):
     """Check if file has an allowed extension"""
-    return '.' in filename and filename.split('.')[-1].lower() in ALLOWED_EXTENSIONS
+    return '.' in filename and scan_format(filename) in ALLOWED_EXTENSIONS
 
-def get_image_data_url(image_path):
-    """Convert image to data URL for Groq API"""
+def normalize_scan_image(image_path):
+    """
+    Decode a scan into image bytes the vision model accepts
+
+    DICOM and NIfTI are normalized to 8-bit PNG (the middle frame or slice of a
+    multi-frame series or volume); standard image formats are returned unchanged.
+    Only that frame or slice is decoded, so large studies are never loaded whole.
+    Returns (image_bytes, img_format).
+    """
     img_format = image_path.split('.')[-1].lower()
     
     if img_format in ['dcm']:
         # Handle DICOM - convert to PNG
-        dicom = pydicom.dcmread(image_path)
-        img_array = dicom.pixel_array
-        # Normalize pixel values
-        if img_array.max() > 0:
-            img_array = (img_array / img_array.max() * 255).astype(np.uint8)
-        img = Image.fromarray(img_array)
-        buffer = BytesIO()
-        img.save(buffer, format="PNG")
-        img_str = base64.b64encode(buffer.getvalue()).decode('utf-8')
-        return f"data:image/png;base64,{img_str}"
+        header = pydicom.dcmread(image_path, stop_before_pixels=True)
+        frames = int(getattr(header, 'NumberOfFrames', 1) or 1)
+        if frames > 1:
+            # Decode only the middle frame of a multi-frame series
+            img_array = pixel_array(image_path, index=frames // 2)
+        else:
+            img_array = pydicom.dcmread(image_path).pixel_array
     
     elif img_format in ['nii', 'gz']:
         # Handle NIfTI - convert to PNG
         nifti = nib.load(image_path)
-        img_array = nifti.get_fdata()
-        # Take a middle slice for 3D volumes
-        if len(img_array.shape) == 3:
-            middle_idx = img_array.shape[2] // 2
-            img_array = img_array[:, :, middle_idx]
-        # Normalize pixel values
-        if img_array.max() > 0:
-            img_array = (img_array / img_array.max() * 255).astype(np.uint8)
-        img = Image.fromarray(img_array)
-        buffer = BytesIO()
-        img.save(buffer, format="PNG")
-        img_str = base64.b64encode(buffer.getvalue()).decode('utf-8')
-        return f"data:image/png;base64,{img_str}"
+        # Take a middle slice for 3D volumes, read through the array proxy
+        if len(nifti.shape) == 3:
+            middle_idx = nifti.shape[2] // 2
+            img_array = np.asarray(nifti.dataobj[:, :, middle_idx], dtype=np.float64)
+        else:
+            img_array = nifti.get_fdata()
     
     else:
         # Handle standard image formats
         with open(image_path, "rb") as img_file:
-            img_str = base64.b64encode(img_file.read()).decode('utf-8')
-        return f"data:image/{img_format};base64,{img_str}"
+            return img_file.read(), img_format
+    
+    # Normalize pixel values
+    if img_array.max() > 0:
+        img_array = (img_array / img_array.max() * 255).astype(np.uint8)
+    img = Image.fromarray(img_array)
+    buffer = BytesIO()
+    img.save(buffer, format="PNG")
+    return buffer.getvalue(), 'png'
+
+def encode_data_url(image_bytes, img_format):
+    """Build a data URL from encoded image bytes"""
+    img_str = base64.b64encode(image_bytes).decode('utf-8')
+    return f"data:image/{img_format};base64,{img_str}"
 
-def classify_scan_type_with_groq(image_path):
-    """Classify scan type using Groq's vision model"""
+@timed_stage("image_encode")
+def get_image_data_url(image_path):
+    """Convert image to data URL for Groq API"""
+    return encode_data_url(*normalize_scan_image(image_path))
+
+@timed_stage("groq.classify_scan_type")
+def classify_scan_type_with_groq(image_path, image_data_url=None):
+    """Classify scan type using Groq's vision model (image_data_url skips re-encoding the scan)"""
     if groq_client is None:
         logger.error("Groq client not initialized")
         return "Unknown Scan Type"
     
     try:
         # Convert image to data URL
-        image_data_url = get_image_data_url(image_path)
+        if image_data_url is None:
+            image_data_url = get_image_data_url(image_path)
         
         # Prepare the prompt for scan type classification
-        completion = groq_client.chat.completions.create(
+        completion = model_caller.call(
+            "classify_scan_type",
+            groq_client.chat.completions.create,
             model="llama-3.2-90b-vision-preview",
             messages=[
                 {
@@ -150,7 +195,7 @@ def classify_scan_type_with_groq(image_path):
         # Try to extract from DICOM metadata if available
         if image_path.endswith('.dcm'):
             try:
-                dicom = pydicom.dcmread(image_path)
+                dicom = pydicom.dcmread(image_path, stop_before_pixels=True)
                 modality = getattr(dicom, 'Modality', '')
                 if modality == 'CT':
                     return "CT Scan"
@@ -166,12 +211,16 @@ def classify_scan_type_with_groq(image_path):
         # Return the original response if no match found
         return scan_type
         
+    except DeadlineExceeded:
+        # The request is out of time; an error report in its place would be stored as a result
+        raise
     except Exception as e:
         logger.error(f"Error in Groq API call for scan classification: {str(e)}")
         return "Unknown Scan Type"
 
-def detect_anomalies_with_groq(image_path):
-    """Detect anomalies using Groq's Llama 3.2 Vision model"""
+@timed_stage("groq.detect_anomalies")
+def detect_anomalies_with_groq(image_path, image_data_url=None):
+    """Detect anomalies using Groq's Llama 3.2 Vision model (image_data_url skips re-encoding the scan)"""
     if groq_client is None:
         logger.error("Groq client not initialized")
         return AnomalyDetection(
@@ -182,10 +231,13 @@ def detect_anomalies_with_groq(image_path):
     
     try:
         # Convert image to data URL
-        image_data_url = get_image_data_url(image_path)
+        if image_data_url is None:
+            image_data_url = get_image_data_url(image_path)
         
         # Prepare the prompt
-        completion = groq_client.chat.completions.create(
+        completion = model_caller.call(
+            "detect_anomalies",
+            groq_client.chat.completions.create,
             model="llama-3.2-90b-vision-preview",
             messages=[
                 {
@@ -251,6 +303,8 @@ def detect_anomalies_with_groq(image_path):
             findings=findings
         )
         
+    except DeadlineExceeded:
+        raise
     except Exception as e:
         error_msg = f"Error in Groq API call: {str(e)}"
         logger.error(error_msg)
@@ -260,6 +314,7 @@ def detect_anomalies_with_groq(image_path):
             error=error_msg
         )
 
+@timed_stage("groq.analyze_report")
 def analyze_report_with_groq(report_text):
     """Analyze medical report using Groq's LLM"""
     if groq_client is None:
@@ -269,9 +324,16 @@ def analyze_report_with_groq(report_text):
             findings=[]
         )
     
+    condensing = None
+    if REPORT_CONDENSING_ENABLED:
+        report_text, condensing = condense_report(report_text)
+        logger.info(f"Report condensed from ~{condensing['original_tokens']} to ~{condensing['condensed_tokens']} tokens")
+
     try:
         # Prepare the prompt for report analysis
-        completion = groq_client.chat.completions.create(
+        completion = model_caller.call(
+            "analyze_report",
+            groq_client.chat.completions.create,
             model="llama-3.2-90b",  # Text-only model is sufficient for report analysis
             messages=[
                 {
@@ -293,6 +355,8 @@ Format your response as follows:
         
         response_text = completion.choices[0].message.content
         logger.info(f"Report analysis received: {response_text[:100]}...")
+        if condensing is not None and getattr(completion, "usage", None) is not None:
+            condensing["prompt_tokens"] = completion.usage.prompt_tokens
         
         # Extract findings from the response
         findings = []
@@ -321,23 +385,40 @@ Format your response as follows:
         
         return ReportAnalysis(
             report_analysis=summary,
-            findings=findings
+            findings=findings,
+            condensing=condensing
         )
         
+    except DeadlineExceeded:
+        raise
     except Exception as e:
         error_msg = f"Error in Groq API call for report analysis: {str(e)}"
         logger.error(error_msg)
         return ReportAnalysis(
             report_analysis=f"Error analyzing report: {str(e)}",
-            findings=[]
+            findings=[],
+            condensing=condensing
         )
 
-def process_scan(scan_path, report_text=None):
-    """Process a scan image and optional report, returning full analysis"""
+def process_scan(scan_path, report_text=None, image_data_url=None):
+    """
+    Process a scan image and optional report, returning full analysis
+
+    The scan is decoded and encoded once and shared by both vision calls; pass
+    image_data_url (e.g. from the scan store) to skip decoding entirely. Raises
+    DeadlineExceeded when the request's deadline passes during a model call.
+    """
     try:
+        if image_data_url is None:
+            try:
+                image_data_url = get_image_data_url(scan_path)
+            except Exception as e:
+                # Leave it to each vision call to report the encoding error
+                logger.error(f"Failed to encode scan: {str(e)}")
+        
         # Perform analysis
-        scan_type = classify_scan_type_with_groq(scan_path)
-        anomalies = detect_anomalies_with_groq(scan_path)
+        scan_type = classify_scan_type_with_groq(scan_path, image_data_url)
+        anomalies = detect_anomalies_with_groq(scan_path, image_data_url)
         
         # Build response using Pydantic model
         response = ScanAnalysisResult(
@@ -352,6 +433,8 @@ def process_scan(scan_path, report_text=None):
         
         return response.dict(), None
     
+    except DeadlineExceeded:
+        raise
     except Exception as e:
         logger.error(f"Processing error: {str(e)}")
         return None, f"Processing error: {str(e)}"
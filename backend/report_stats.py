@@ -0,0 +1,362 @@
+# report_stats.py
+# Aggregations for patient and cohort dashboards
+#
+# Dashboards read two small summary collections that are updated as reports are
+# written: one document per patient, and one per (day, scan type) bucket. Every
+# endpoint can also aggregate patient_reports directly (the only option when a
+# query is restricted to one patient), and rebuild_summaries() recomputes both
+# collections from patient_reports.
+#
+# A third collection holds the _id of every report already counted, so folding
+# the same report in twice (a journal replay, a retried flush) is a no-op. When
+# an update fails part-way, schedule_rebuild() reconciles everything later.
+
+import os
+import re
+import logging
+import threading
+from datetime import datetime
+from typing import Dict, Any, List, Optional, Tuple
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError
+
+# Configure logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Configuration
+REPORT_SUMMARIES_ENABLED = os.environ.get('REPORT_SUMMARIES', '1') != '0'
+PATIENT_SUMMARIES = 'patient_summaries'
+DAILY_REPORT_STATS = 'daily_report_stats'
+SUMMARIZED_REPORTS = 'summarized_reports'  # _id of every report folded into the summaries
+SUMMARY_REBUILD_DELAY = float(os.environ.get('SUMMARY_REBUILD_DELAY', 30))  # Seconds before a scheduled rebuild runs
+DUPLICATE_KEY_ERROR = 11000
+UNKNOWN_SCAN_TYPE = 'Unknown'
+MAX_PATIENT_PAGE_SIZE = 200
+# $dateToString formats for each reporting period (ISO weeks for "week")
+PERIOD_FORMATS = {
+    "day": "%Y-%m-%d",
+    "week": "%G-W%V",
+    "month": "%Y-%m"
+}
+
+# Per-patient summary computed from patient_reports (documents sorted by created_at first)
+PATIENT_SUMMARY_STAGES = [
+    {"$group": {
+        "_id": "$patient_id",
+        "report_count": {"$sum": 1},
+        "anomaly_count": {"$sum": {"$cond": ["$anomaly_detected", 1, 0]}},
+        "first_report_at": {"$first": "$created_at"},
+        "last_report_at": {"$last": "$created_at"},
+        "last_report_id": {"$last": "$_id"},
+        "last_scan_type": {"$last": "$analysis_result.scan_type"},
+        "last_anomaly_detected": {"$last": "$anomaly_detected"}
+    }},
+    {"$set": {"last_scan_type": {"$ifNull": ["$last_scan_type", UNKNOWN_SCAN_TYPE]}}}
+]
+
+
+def ensure_summary_indexes(db):
+    """Create the indexes the dashboard queries sort and filter on"""
+    db[PATIENT_SUMMARIES].create_index([("last_report_at", -1), ("_id", 1)], name="last_report_at_id")
+    db[DAILY_REPORT_STATS].create_index([("day", 1), ("scan_type", 1)], name="day_scan_type", unique=True)
+    logger.info("Ensured report summary indexes")
+
+
+def ensure_summary_indexes_async(db):
+    """Ensure summary indexes without blocking startup when MongoDB is slow or unreachable"""
+    def run():
+        try:
+            ensure_summary_indexes(db)
+        except Exception as e:
+            logger.error(f"Failed to ensure report summary indexes: {e}")
+
+    thread = threading.Thread(target=run, daemon=True, name='ensure-summary-indexes')
+    thread.start()
+    return thread
+
+
+def report_scan_type(doc: Dict[str, Any]) -> str:
+    return (doc.get("analysis_result") or {}).get("scan_type") or UNKNOWN_SCAN_TYPE
+
+
+def start_of_day(value: datetime) -> datetime:
+    return value.replace(hour=0, minute=0, second=0, microsecond=0)
+
+
+def _claim_reports(db, docs: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """Mark reports as summarized; returns the ones no earlier call had marked"""
+    if not docs:
+        return []
+    try:
+        db[SUMMARIZED_REPORTS].insert_many([{"_id": doc["_id"]} for doc in docs], ordered=False)
+    except BulkWriteError as e:
+        write_errors = e.details.get("writeErrors", [])
+        if any(error.get("code") != DUPLICATE_KEY_ERROR for error in write_errors):
+            raise
+        counted = {error["index"] for error in write_errors}
+        return [doc for i, doc in enumerate(docs) if i not in counted]
+    return docs
+
+
+def record_reports(db, docs: List[Dict[str, Any]]):
+    """
+    Fold stored reports into the summary collections
+
+    Reports already counted (by _id) are skipped, so callers may pass the same report
+    more than once. Patient updates are ordered by created_at so the "last report"
+    fields end up pointing at the newest report even when a batch holds several for
+    one patient. If this raises, the summaries may be short of some reports until
+    the next rebuild.
+    """
+    docs = _claim_reports(db, list({doc["_id"]: doc for doc in docs}.values()))
+    if not docs:
+        return
+    patient_ops = []
+    daily_counts: Dict[Tuple[datetime, str], List[int]] = {}
+    for doc in sorted(docs, key=lambda doc: doc["created_at"]):
+        anomaly = int(bool(doc.get("anomaly_detected")))
+        scan_type = report_scan_type(doc)
+        last_fields = {
+            "last_report_id": doc["_id"],
+            "last_scan_type": scan_type,
+            "last_anomaly_detected": bool(anomaly)
+        }
+        # Replace the "last" fields only if this report is at least as new as the current one
+        patient_ops.append(UpdateOne(
+            {"_id": doc["patient_id"], "last_report_at": {"$lte": doc["created_at"]}},
+            {"$set": last_fields}
+        ))
+        patient_ops.append(UpdateOne(
+            {"_id": doc["patient_id"]},
+            {
+                "$inc": {"report_count": 1, "anomaly_count": anomaly},
+                "$min": {"first_report_at": doc["created_at"]},
+                "$max": {"last_report_at": doc["created_at"]},
+                "$setOnInsert": last_fields
+            },
+            upsert=True
+        ))
+        counts = daily_counts.setdefault((start_of_day(doc["created_at"]), scan_type), [0, 0])
+        counts[0] += 1
+        counts[1] += anomaly
+
+    daily_ops = [
+        UpdateOne(
+            {"day": day, "scan_type": scan_type},
+            {"$inc": {"report_count": report_count, "anomaly_count": anomaly_count}},
+            upsert=True
+        )
+        for (day, scan_type), (report_count, anomaly_count) in daily_counts.items()
+    ]
+    db[PATIENT_SUMMARIES].bulk_write(patient_ops, ordered=True)
+    db[DAILY_REPORT_STATS].bulk_write(daily_ops, ordered=False)
+
+
+def rebuild_summaries(db) -> Dict[str, int]:
+    """Recompute both summary collections from patient_reports (each $out replaces its collection atomically)"""
+    reports = db["patient_reports"]
+    reports.aggregate([
+        {"$sort": {"patient_id": 1, "created_at": 1, "_id": 1}},
+        *PATIENT_SUMMARY_STAGES,
+        {"$out": PATIENT_SUMMARIES}
+    ], allowDiskUse=True)
+    reports.aggregate([
+        {"$group": {
+            "_id": {
+                # Midnight of the report's day
+                "day": {"$dateFromParts": {
+                    "year": {"$year": "$created_at"},
+                    "month": {"$month": "$created_at"},
+                    "day": {"$dayOfMonth": "$created_at"}
+                }},
+                "scan_type": {"$ifNull": ["$analysis_result.scan_type", UNKNOWN_SCAN_TYPE]}
+            },
+            "report_count": {"$sum": 1},
+            "anomaly_count": {"$sum": {"$cond": ["$anomaly_detected", 1, 0]}}
+        }},
+        {"$project": {"_id": 0, "day": "$_id.day", "scan_type": "$_id.scan_type",
+                      "report_count": 1, "anomaly_count": 1}},
+        {"$out": DAILY_REPORT_STATS}
+    ], allowDiskUse=True)
+    reports.aggregate([{"$project": {"_id": 1}}, {"$out": SUMMARIZED_REPORTS}], allowDiskUse=True)
+    ensure_summary_indexes(db)
+    counts = {
+        "patients": db[PATIENT_SUMMARIES].estimated_document_count(),
+        "daily_buckets": db[DAILY_REPORT_STATS].estimated_document_count()
+    }
+    logger.info(f"Rebuilt report summaries: {counts}")
+    return counts
+
+
+_rebuild_lock = threading.Lock()
+_rebuild_timer: Optional[threading.Timer] = None
+
+
+def schedule_rebuild(db, delay: float = SUMMARY_REBUILD_DELAY) -> bool:
+    """
+    Rebuild the summaries in the background after delay seconds
+
+    Used when an incremental update failed part-way. Requests made while a rebuild
+    is already scheduled share it; returns False for those.
+    """
+    global _rebuild_timer
+
+    def run():
+        global _rebuild_timer
+        with _rebuild_lock:
+            _rebuild_timer = None
+        try:
+            rebuild_summaries(db)
+        except Exception as e:
+            logger.error(f"Scheduled report summary rebuild failed: {e}")
+
+    with _rebuild_lock:
+        if _rebuild_timer is not None:
+            return False
+        _rebuild_timer = threading.Timer(delay, run)
+        _rebuild_timer.daemon = True
+        _rebuild_timer.name = 'rebuild-summaries'
+        _rebuild_timer.start()
+    logger.warning(f"Report summaries will be rebuilt in {delay:g}s")
+    return True
+
+
+def _date_match(field: str, date_from: Optional[datetime], date_to: Optional[datetime]) -> Dict[str, Any]:
+    match = {}
+    if date_from:
+        match["$gte"] = date_from
+    if date_to:
+        match["$lt"] = date_to
+    return {field: match} if match else {}
+
+
+def list_patients(db, search: Optional[str] = None, limit: int = 50, skip: int = 0,
+                  use_summaries: bool = REPORT_SUMMARIES_ENABLED) -> Tuple[List[Dict[str, Any]], int]:
+    """
+    Patients ordered by most recent report, with report and anomaly counts
+
+    search matches a patient_id prefix. Returns (patients, total).
+    """
+    id_filter = {"$regex": f"^{re.escape(search)}"} if search else None
+
+    if use_summaries:
+        query = {"_id": id_filter} if id_filter else {}
+        summaries = db[PATIENT_SUMMARIES]
+        cursor = summaries.find(query).sort([("last_report_at", -1), ("_id", 1)]).skip(skip).limit(limit)
+        patients = list(cursor)
+        total = summaries.count_documents(query)
+    else:
+        match = {"patient_id": id_filter} if id_filter else {}
+        result = list(db["patient_reports"].aggregate([
+            {"$match": match},
+            {"$sort": {"patient_id": 1, "created_at": 1, "_id": 1}},
+            *PATIENT_SUMMARY_STAGES,
+            {"$facet": {
+                "patients": [{"$sort": {"last_report_at": -1, "_id": 1}}, {"$skip": skip}, {"$limit": limit}],
+                "total": [{"$count": "count"}]
+            }}
+        ], allowDiskUse=True))
+        patients = result[0]["patients"] if result else []
+        total = result[0]["total"][0]["count"] if result and result[0]["total"] else 0
+
+    for patient in patients:
+        patient["patient_id"] = patient.pop("_id")
+    return patients, total
+
+
+def anomaly_rate(db, period: str = 'month', date_from: Optional[datetime] = None,
+                 date_to: Optional[datetime] = None, scan_type: Optional[str] = None,
+                 patient_id: Optional[str] = None,
+                 use_summaries: bool = REPORT_SUMMARIES_ENABLED) -> List[Dict[str, Any]]:
+    """
+    Report count, anomaly count and anomaly rate per period, oldest first
+
+    Daily buckets serve cohort-wide queries (date bounds are applied per whole day);
+    queries for one patient aggregate that patient's reports directly.
+    """
+    if period not in PERIOD_FORMATS:
+        raise ValueError(f"Invalid period '{period}'. Allowed: {', '.join(PERIOD_FORMATS)}")
+    date_format = PERIOD_FORMATS[period]
+
+    if use_summaries and not patient_id:
+        match = _date_match("day", date_from and start_of_day(date_from), date_to)
+        if scan_type:
+            match["scan_type"] = scan_type
+        pipeline = [
+            {"$match": match},
+            {"$group": {
+                "_id": {"$dateToString": {"format": date_format, "date": "$day"}},
+                "report_count": {"$sum": "$report_count"},
+                "anomaly_count": {"$sum": "$anomaly_count"}
+            }}
+        ]
+        collection = db[DAILY_REPORT_STATS]
+    else:
+        match = _date_match("created_at", date_from, date_to)
+        if patient_id:
+            match["patient_id"] = patient_id
+        if scan_type:
+            match["analysis_result.scan_type"] = scan_type
+        pipeline = [
+            {"$match": match},
+            {"$group": {
+                "_id": {"$dateToString": {"format": date_format, "date": "$created_at"}},
+                "report_count": {"$sum": 1},
+                "anomaly_count": {"$sum": {"$cond": ["$anomaly_detected", 1, 0]}}
+            }}
+        ]
+        collection = db["patient_reports"]
+
+    pipeline.append({"$sort": {"_id": 1}})
+    return [
+        {
+            "period": row["_id"],
+            "report_count": row["report_count"],
+            "anomaly_count": row["anomaly_count"],
+            "anomaly_rate": round(row["anomaly_count"] / row["report_count"], 4) if row["report_count"] else 0.0
+        }
+        for row in collection.aggregate(pipeline)
+    ]
+
+
+def scan_type_distribution(db, date_from: Optional[datetime] = None, date_to: Optional[datetime] = None,
+                           patient_id: Optional[str] = None,
+                           use_summaries: bool = REPORT_SUMMARIES_ENABLED) -> List[Dict[str, Any]]:
+    """Report and anomaly counts per scan type, most common first"""
+    if use_summaries and not patient_id:
+        pipeline = [
+            {"$match": _date_match("day", date_from and start_of_day(date_from), date_to)},
+            {"$group": {
+                "_id": "$scan_type",
+                "report_count": {"$sum": "$report_count"},
+                "anomaly_count": {"$sum": "$anomaly_count"}
+            }}
+        ]
+        collection = db[DAILY_REPORT_STATS]
+    else:
+        match = _date_match("created_at", date_from, date_to)
+        if patient_id:
+            match["patient_id"] = patient_id
+        pipeline = [
+            {"$match": match},
+            {"$group": {
+                "_id": {"$ifNull": ["$analysis_result.scan_type", UNKNOWN_SCAN_TYPE]},
+                "report_count": {"$sum": 1},
+                "anomaly_count": {"$sum": {"$cond": ["$anomaly_detected", 1, 0]}}
+            }}
+        ]
+        collection = db["patient_reports"]
+
+    pipeline.append({"$sort": {"report_count": -1, "_id": 1}})
+    rows = list(collection.aggregate(pipeline))
+    total = sum(row["report_count"] for row in rows)
+    return [
+        {
+            "scan_type": row["_id"],
+            "report_count": row["report_count"],
+            "anomaly_count": row["anomaly_count"],
+            "share": round(row["report_count"] / total, 4) if total else 0.0
+        }
+        for row in rows
+    ]
@@ -0,0 +1,348 @@
+# scan_store.py
+# Content-addressed storage for uploaded scans and their derivatives
+#
+# Each scan is stored once under the SHA-256 of its bytes, together with the
+# normalized image sent to the vision model and downscaled previews, so a stored
+# scan can be re-analyzed or displayed without re-uploading or re-decoding it.
+#
+# Nothing is removed automatically: scans stay until delete() is called, and
+# per-scan caches (meshes, decoded volumes) until clear_cache() or prune_caches().
+
+import os
+import json
+import time
+import shutil
+import hashlib
+import logging
+import tempfile
+import threading
+from io import BytesIO
+from datetime import datetime
+from typing import Dict, Any, Optional, Tuple
+import numpy as np
+import pydicom
+import nibabel as nib
+from PIL import Image
+from report_scan import normalize_scan_image, encode_data_url, scan_format
+
+# Configure logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Configuration
+SCAN_STORE_DIR = os.environ.get(
+    'SCAN_STORE_DIR',
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), 'scans')
+)
+# Longest edge in pixels of each precomputed derivative
+DERIVATIVE_SIZES = {
+    "preview": 512,
+    "thumbnail": 128
+}
+HASH_CHUNK_SIZE = 1024 * 1024
+META_FILE = 'meta.json'  # Written last, so its presence marks a complete entry
+CACHE_DIR = 'cache'  # Per-scan files computed on demand (e.g. meshes)
+VOLUME_DATA_FILE = 'volume.npy'
+VOLUME_INFO_FILE = 'volume.json'
+
+
+def hash_file(path: str) -> str:
+    """SHA-256 hex digest of a file, read in chunks"""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def is_scan_hash(value) -> bool:
+    return isinstance(value, str) and len(value) == 64 and all(c in '0123456789abcdef' for c in value)
+
+
+def directory_size(path: str) -> int:
+    """Total size in bytes of the files under a directory"""
+    total = 0
+    for dirpath, _dirnames, filenames in os.walk(path):
+        for filename in filenames:
+            try:
+                total += os.path.getsize(os.path.join(dirpath, filename))
+            except OSError:
+                pass
+    return total
+
+
+def is_volume_file(path: str, img_format: str) -> bool:
+    """Whether a scan holds more than one slice (multi-frame DICOM, or NIfTI with a third axis); reads headers only"""
+    if img_format in ('nii', 'nii.gz'):
+        shape = nib.load(path).shape
+        return len(shape) >= 3 and shape[2] > 1
+    if img_format == 'dcm':
+        dataset = pydicom.dcmread(path, stop_before_pixels=True)
+        return int(getattr(dataset, 'NumberOfFrames', 1) or 1) > 1
+    return False
+
+
+class ScanStore:
+    """
+    Local blob store keyed by content hash
+
+    Layout: <root>/<hash[:2]>/<hash>/ holding original.<ext>, normalized.<fmt>
+    (unless the original is already a web image), <name>.png derivatives, meta.json
+    and a cache/ directory for files computed later on request.
+    """
+
+    def __init__(self, root: str = SCAN_STORE_DIR):
+        self.root = root
+        self._lock = threading.Lock()
+        os.makedirs(root, exist_ok=True)
+
+    def _entry_dir(self, scan_hash: str) -> str:
+        if not is_scan_hash(scan_hash):
+            raise ValueError(f"Invalid scan hash '{scan_hash}'")
+        return os.path.join(self.root, scan_hash[:2], scan_hash)
+
+    def __contains__(self, scan_hash: str) -> bool:
+        return is_scan_hash(scan_hash) and os.path.exists(os.path.join(self._entry_dir(scan_hash), META_FILE))
+
+    def meta(self, scan_hash: str) -> Optional[Dict[str, Any]]:
+        if scan_hash not in self:
+            return None
+        with open(os.path.join(self._entry_dir(scan_hash), META_FILE)) as f:
+            return json.load(f)
+
+    def put(self, path: str, filename: str, scan_hash: Optional[str] = None, move: bool = False) -> str:
+        """
+        Store a scan file and its derivatives; returns the content hash
+
+        A scan that is already stored is not decoded or written again. Pass scan_hash
+        when the caller already hashed the file, and move=True to move it into the
+        store instead of copying it (the file is consumed either way in that case).
+        """
+        scan_hash = scan_hash or hash_file(path)
+        if scan_hash in self:
+            if move:
+                os.remove(path)
+            return scan_hash
+
+        img_format = scan_format(filename)
+        entry_dir = self._entry_dir(scan_hash)
+        # Build the entry in a temporary directory and move it into place in one step
+        staging_dir = tempfile.mkdtemp(prefix='.staging-', dir=self.root)
+        try:
+            original_name = f"original.{img_format}"
+            original_path = os.path.join(staging_dir, original_name)
+            if move:
+                shutil.move(path, original_path)
+            else:
+                shutil.copyfile(path, original_path)
+
+            image_bytes, normalized_format = normalize_scan_image(original_path)
+            normalized_name = original_name
+            if normalized_format != img_format:
+                normalized_name = f"normalized.{normalized_format}"
+                with open(os.path.join(staging_dir, normalized_name), 'wb') as f:
+                    f.write(image_bytes)
+
+            image = Image.open(BytesIO(image_bytes))
+            derivatives = {}
+            for name, size in DERIVATIVE_SIZES.items():
+                derivative = image.copy()
+                derivative.thumbnail((size, size))
+                if derivative.mode not in ('L', 'RGB', 'RGBA'):
+                    derivative = derivative.convert('RGB')
+                derivatives[name] = f"{name}.png"
+                derivative.save(os.path.join(staging_dir, derivatives[name]), format="PNG")
+
+            meta = {
+                "scan_hash": scan_hash,
+                "filename": filename,
+                "format": img_format,
+                "size_bytes": os.path.getsize(original_path),
+                "original": original_name,
+                "normalized": normalized_name,
+                "normalized_format": normalized_format,
+                "width": image.width,
+                "height": image.height,
+                "is_volume": is_volume_file(original_path, img_format),
+                "derivatives": derivatives,
+                "created_at": datetime.now().isoformat()
+            }
+            with open(os.path.join(staging_dir, META_FILE), 'w') as f:
+                json.dump(meta, f)
+
+            with self._lock:
+                if scan_hash in self:
+                    return scan_hash
+                os.makedirs(os.path.dirname(entry_dir), exist_ok=True)
+                try:
+                    os.rename(staging_dir, entry_dir)
+                except OSError:
+                    # Another process stored the same content first
+                    if scan_hash not in self:
+                        raise
+            logger.info(f"Stored scan {scan_hash[:12]} ({filename})")
+            return scan_hash
+        finally:
+            if os.path.exists(staging_dir):
+                shutil.rmtree(staging_dir, ignore_errors=True)
+
+    def path(self, scan_hash: str, kind: str = 'original') -> Optional[str]:
+        """Path of the original, the normalized image or a named derivative"""
+        meta = self.meta(scan_hash)
+        if meta is None:
+            return None
+        if kind in ('original', 'normalized'):
+            name = meta[kind]
+        else:
+            name = meta["derivatives"].get(kind)
+            if name is None:
+                return None
+        return os.path.join(self._entry_dir(scan_hash), name)
+
+    def data_url(self, scan_hash: str) -> Optional[str]:
+        """Data URL of the stored normalized image, ready for the vision model"""
+        meta = self.meta(scan_hash)
+        if meta is None:
+            return None
+        with open(os.path.join(self._entry_dir(scan_hash), meta["normalized"]), 'rb') as f:
+            return encode_data_url(f.read(), meta["normalized_format"])
+
+    def cache_path(self, scan_hash: str, name: str) -> Optional[str]:
+        """Path for a file computed from a stored scan (the file may not exist yet)"""
+        if scan_hash not in self:
+            return None
+        cache_dir = os.path.join(self._entry_dir(scan_hash), CACHE_DIR)
+        os.makedirs(cache_dir, exist_ok=True)
+        return os.path.join(cache_dir, os.path.basename(name))
+
+    def _remove_dir(self, path: str):
+        """Move a directory out of the store in one step, then delete it"""
+        trash_dir = tempfile.mkdtemp(prefix='.deleting-', dir=self.root)
+        try:
+            os.rename(path, os.path.join(trash_dir, os.path.basename(path)))
+        finally:
+            shutil.rmtree(trash_dir, ignore_errors=True)
+
+    def delete(self, scan_hash: str) -> bool:
+        """Remove a stored scan with its derivatives and cache; False if it is not stored"""
+        if scan_hash not in self:
+            return False
+        with self._lock:
+            try:
+                self._remove_dir(self._entry_dir(scan_hash))
+            except FileNotFoundError:
+                return False
+        logger.info(f"Deleted scan {scan_hash[:12]}")
+        return True
+
+    def clear_cache(self, scan_hash: str) -> Optional[int]:
+        """Remove the files computed on request for a scan; returns the bytes freed, None if it is not stored"""
+        if scan_hash not in self:
+            return None
+        cache_dir = os.path.join(self._entry_dir(scan_hash), CACHE_DIR)
+        freed = directory_size(cache_dir)
+        try:
+            self._remove_dir(cache_dir)
+        except FileNotFoundError:
+            return 0
+        return freed
+
+    def prune_caches(self, max_age_seconds: float) -> Dict[str, int]:
+        """Clear the cache of every scan whose cached files were all written more than max_age_seconds ago"""
+        cutoff = time.time() - max_age_seconds
+        scans = 0
+        freed = 0
+        for prefix in os.listdir(self.root):
+            prefix_dir = os.path.join(self.root, prefix)
+            if prefix.startswith('.') or not os.path.isdir(prefix_dir):
+                continue
+            for scan_hash in os.listdir(prefix_dir):
+                cache_dir = os.path.join(prefix_dir, scan_hash, CACHE_DIR)
+                if not is_scan_hash(scan_hash) or not os.path.isdir(cache_dir):
+                    continue
+                newest = max((entry.stat().st_mtime for entry in os.scandir(cache_dir)), default=0)
+                if newest < cutoff:
+                    freed += self.clear_cache(scan_hash) or 0
+                    scans += 1
+        logger.info(f"Pruned caches of {scans} scans, freed {freed} bytes")
+        return {"scans": scans, "bytes_freed": freed}
+
+    def open_volume(self, scan_hash: str) -> Optional[Tuple[np.ndarray, Dict[str, Any]]]:
+        """
+        Memory-mapped voxel array of a volumetric scan, with its volume info
+
+        The array is ordered (z, y, x): axial slices are contiguous, z runs inferior to
+        superior and y anterior to posterior. The scan is decoded into this layout
+        once, on first use, and cached; later calls only map the file. Returns None
+        for scans that are single images.
+        """
+        info_path = self.cache_path(scan_hash, VOLUME_INFO_FILE)
+        if info_path is None:
+            return None
+        if not os.path.exists(info_path):
+            self._decode_volume(scan_hash)
+        with open(info_path) as f:
+            info = json.load(f)
+        if not info["is_volume"]:
+            return None
+        return np.load(self.cache_path(scan_hash, VOLUME_DATA_FILE), mmap_mode='r'), info
+
+    def _decode_volume(self, scan_hash: str):
+        """Write the (z, y, x) voxel array and volume info of a scan to its cache directory"""
+        meta = self.meta(scan_hash)
+        path = os.path.join(self._entry_dir(scan_hash), meta["original"])
+        volume = None
+        spacing = None
+
+        if meta["format"] in ('nii', 'nii.gz'):
+            nifti = nib.as_closest_canonical(nib.load(path))  # RAS+ axes
+            if len(nifti.shape) >= 3 and nifti.shape[2] > 1:
+                data = np.asarray(nifti.dataobj if len(nifti.shape) == 3 else nifti.dataobj[..., 0])
+                volume = data.transpose(2, 1, 0)[:, ::-1, :]
+                zooms = nifti.header.get_zooms()
+                spacing = (float(zooms[2]), float(zooms[1]), float(zooms[0]))
+
+        elif meta["format"] == 'dcm':
+            dataset = pydicom.dcmread(path)
+            if int(getattr(dataset, 'NumberOfFrames', 1) or 1) > 1:
+                # Frames are stacked along the first axis: (frame, row, column)
+                volume = dataset.pixel_array
+                if volume.ndim == 4:
+                    volume = volume.mean(axis=-1)  # Color frames
+                row_spacing, column_spacing = (float(value) for value in getattr(dataset, 'PixelSpacing', (1.0, 1.0)))
+                slice_spacing = float(getattr(dataset, 'SpacingBetweenSlices', 0) or getattr(dataset, 'SliceThickness', 0) or 1.0)
+                spacing = (slice_spacing, row_spacing, column_spacing)
+
+        info = {"is_volume": volume is not None}
+        if volume is not None:
+            if volume.dtype == np.float64:
+                volume = volume.astype(np.float32)
+            volume = np.ascontiguousarray(volume)
+            # Default display window from robust intensity bounds (estimated on a subsample)
+            low, high = (float(value) for value in np.percentile(volume[::2, ::4, ::4], [1, 99.5]))
+            info.update(
+                shape=list(volume.shape),
+                spacing=list(spacing),
+                dtype=str(volume.dtype),
+                window={"center": (low + high) / 2, "width": max(high - low, 1e-6)}
+            )
+            self._write_cache_file(scan_hash, VOLUME_DATA_FILE, lambda f: np.save(f, volume))
+        # Written last, so its presence means the data file is complete
+        self._write_cache_file(scan_hash, VOLUME_INFO_FILE, lambda f: f.write(json.dumps(info).encode('utf-8')))
+        logger.info(f"Decoded volume of scan {scan_hash[:12]}: {info.get('shape')}")
+
+    def _write_cache_file(self, scan_hash: str, name: str, write):
+        """Write a cache file under a temporary name and move it into place"""
+        path = self.cache_path(scan_hash, name)
+        temp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(temp_path, 'wb') as f:
+            write(f)
+        os.replace(temp_path, path)
+
+    def load_volume(self, scan_hash: str) -> Optional[Tuple[np.ndarray, Tuple[float, float, float]]]:
+        """The voxel array of a volumetric scan as float32, with its (z, y, x) voxel spacing; None for single images"""
+        opened = self.open_volume(scan_hash)
+        if opened is None:
+            return None
+        volume, info = opened
+        return np.asarray(volume, dtype=np.float32), tuple(info["spacing"])
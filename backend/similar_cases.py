@@ -0,0 +1,488 @@
+# similar_cases.py
+# Local vector index for "find reports similar to this one" retrieval
+
+import os
+import json
+import math
+import logging
+import threading
+from contextlib import contextmanager
+from typing import List, Dict, Any, Optional, Tuple
+import numpy as np
+
+try:
+    import fcntl
+except ImportError:  # Windows: only the single-process dev server is supported there
+    fcntl = None
+
+# Configure logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Configuration
+SIMILAR_INDEX_DIR = os.environ.get(
+    'SIMILAR_INDEX_DIR',
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), 'vector_index')
+)
+# Below this many vectors an exact scan is fast enough; above it an IVF index is trained
+IVF_MIN_VECTORS = int(os.environ.get('SIMILAR_IVF_MIN_VECTORS', 100000))
+# Number of inverted lists probed per query
+IVF_NPROBE = int(os.environ.get('SIMILAR_IVF_NPROBE', 16))
+# Retrain the IVF centroids once the collection has grown by this factor
+IVF_RETRAIN_GROWTH = 4.0
+# Rows scored per block during exact search, bounds temporary memory
+SEARCH_BLOCK_ROWS = 65536
+INITIAL_CAPACITY = 1024
+ID_DTYPE = 'S24'  # Hex ObjectId strings
+
+
+def report_document_text(doc: Dict[str, Any]) -> str:
+    """Build the text that represents a stored report: report text plus analysis text"""
+    analysis_result = doc.get('analysis_result') or {}
+    parts = [
+        doc.get('report_text') or '',
+        (analysis_result.get('anomaly_detection') or {}).get('analysis') or '',
+        (analysis_result.get('report_analysis') or {}).get('report_analysis') or ''
+    ]
+    return "\n".join(part for part in parts if part)
+
+
+def normalize_vectors(vectors: np.ndarray) -> np.ndarray:
+    """L2-normalize vectors row-wise as float32 so dot product equals cosine similarity"""
+    vectors = np.atleast_2d(np.asarray(vectors, dtype=np.float32))
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return vectors / norms
+
+
+def _merge_top_k(scores: np.ndarray, rows: np.ndarray, k: int) -> Tuple[np.ndarray, np.ndarray]:
+    """Keep the k highest scores (and their rows), sorted descending"""
+    if len(scores) > k:
+        keep = np.argpartition(-scores, k - 1)[:k]
+        scores, rows = scores[keep], rows[keep]
+    order = np.argsort(-scores, kind='stable')
+    return scores[order], rows[order]
+
+
+class VectorIndex:
+    """
+    Append-only vector index over normalized float32 embeddings stored in memory-mapped files
+
+    Small collections are searched exactly, block by block. Once the collection reaches
+    IVF_MIN_VECTORS an inverted-file (IVF) index is trained in the background and queries
+    only score the vectors in the IVF_NPROBE closest lists. Each row also carries the
+    scan_type and anomaly_detected values used for filtering.
+
+    Several server worker processes can share one index directory: writes hold an
+    exclusive file lock, and each process picks up rows appended by the others from
+    the shared header before writing or searching.
+    """
+
+    def __init__(self, index_dir: str, dim: int):
+        self.index_dir = index_dir
+        self.dim = dim
+        self.count = 0
+        self.capacity = 0
+        self.scan_types: List[str] = []
+        self.ivf_trained_at = 0
+        self._lock = threading.RLock()
+        self._training = False
+        self._row_by_id: Dict[str, int] = {}
+        self._centroids: Optional[np.ndarray] = None
+        self._postings: List[np.ndarray] = []
+        self._pending_postings: List[List[int]] = []
+
+        os.makedirs(index_dir, exist_ok=True)
+        self._load()
+
+    # Cross-process coordination
+
+    @contextmanager
+    def _file_lock(self, name: str, blocking: bool = True):
+        """
+        Exclusive lock on a file in the index directory, shared by every process using it
+
+        Yields False instead of waiting when blocking=False and another process holds it.
+        The file is opened per acquisition because forked processes would otherwise share
+        one open file, and with it the lock.
+        """
+        if fcntl is None:
+            yield True
+            return
+        with open(self._path(name), 'w') as lock_file:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                yield False
+                return
+            try:
+                yield True
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    @contextmanager
+    def _exclusive(self):
+        """Lock against other threads and processes, then catch up with their writes"""
+        with self._lock, self._file_lock('index.lock'):
+            self.refresh()
+            yield
+
+    def refresh(self):
+        """Pick up rows, scan types and IVF centroids written to the index files by other processes"""
+        header_path = self._path('header.json')
+        if not os.path.exists(header_path):
+            return
+        with open(header_path) as f:
+            header = json.load(f)
+        if header['count'] == self.count and header.get('ivf_trained_at', 0) == self.ivf_trained_at:
+            return
+
+        with self._lock:
+            if header['capacity'] != self.capacity:
+                self._open_columns(header['capacity'])
+            self.scan_types = header['scan_types']
+            previous_count = self.count
+            for row in range(previous_count, header['count']):
+                self._row_by_id[self._ids[row].decode('ascii')] = row
+            self.count = header['count']
+
+            if header.get('ivf_trained_at', 0) != self.ivf_trained_at:
+                self.ivf_trained_at = header.get('ivf_trained_at', 0)
+                self._set_postings(np.load(self._path('centroids.npy')), np.asarray(self._lists[:self.count]))
+            elif self._centroids is not None:
+                for row in range(previous_count, self.count):
+                    list_id = int(self._lists[row])
+                    if list_id < 0:
+                        # Appended by a process that had not loaded the centroids yet
+                        list_id = int(np.argmax(self._centroids @ self._vectors[row]))
+                    self._pending_postings[list_id].append(row)
+
+    # Storage
+
+    def _path(self, name: str) -> str:
+        return os.path.join(self.index_dir, name)
+
+    def _open_columns(self, capacity: int):
+        """(Re)open every column as a memmap sized for `capacity` rows"""
+        columns = {
+            'vectors': (np.float32, (capacity, self.dim)),
+            'ids': (ID_DTYPE, (capacity,)),
+            'scan_codes': (np.int16, (capacity,)),
+            'anomaly': (np.int8, (capacity,)),
+            'lists': (np.int32, (capacity,))
+        }
+        for name, (dtype, shape) in columns.items():
+            path = self._path(f"{name}.bin")
+            nbytes = int(np.prod(shape)) * np.dtype(dtype).itemsize
+            with open(path, 'ab') as f:
+                if f.tell() < nbytes:
+                    f.truncate(nbytes)
+            setattr(self, f"_{name}", np.memmap(path, dtype=dtype, mode='r+', shape=shape))
+        self.capacity = capacity
+
+    def _write_header(self):
+        header = {
+            'dim': self.dim,
+            'count': self.count,
+            'capacity': self.capacity,
+            'scan_types': self.scan_types,
+            'ivf_trained_at': self.ivf_trained_at
+        }
+        tmp_path = self._path('header.json.tmp')
+        with open(tmp_path, 'w') as f:
+            json.dump(header, f)
+        os.replace(tmp_path, self._path('header.json'))
+
+    def _load(self):
+        header_path = self._path('header.json')
+        if os.path.exists(header_path):
+            with open(header_path) as f:
+                header = json.load(f)
+            if header['dim'] != self.dim:
+                raise ValueError(f"Index at {self.index_dir} has dimension {header['dim']}, expected {self.dim}")
+            self.count = header['count']
+            self.scan_types = header['scan_types']
+            self.ivf_trained_at = header.get('ivf_trained_at', 0)
+            self._open_columns(header['capacity'])
+        else:
+            self._open_columns(INITIAL_CAPACITY)
+            self._write_header()
+
+        self._row_by_id = {row_id.decode('ascii'): row for row, row_id in enumerate(self._ids[:self.count])}
+
+        centroids_path = self._path('centroids.npy')
+        if self.ivf_trained_at and os.path.exists(centroids_path):
+            self._set_postings(np.load(centroids_path), np.asarray(self._lists[:self.count]))
+
+        logger.info(f"Loaded similar-case index with {self.count} vectors from {self.index_dir}")
+
+    def _flush(self):
+        for name in ('vectors', 'ids', 'scan_codes', 'anomaly', 'lists'):
+            getattr(self, f"_{name}").flush()
+
+    def _grow(self):
+        self._flush()
+        self._open_columns(max(INITIAL_CAPACITY, self.capacity * 2))
+
+    def _scan_code(self, scan_type: Optional[str], create: bool) -> int:
+        if not scan_type:
+            return -1
+        if scan_type in self.scan_types:
+            return self.scan_types.index(scan_type)
+        if not create:
+            return -2  # Matches nothing
+        self.scan_types.append(scan_type)
+        return len(self.scan_types) - 1
+
+    # Writes
+
+    def __len__(self) -> int:
+        return self.count
+
+    def __contains__(self, report_id: str) -> bool:
+        return report_id in self._row_by_id
+
+    def add(self, report_id: str, vector: np.ndarray, scan_type: Optional[str] = None,
+            anomaly_detected: Optional[bool] = None) -> bool:
+        """Add one report embedding; returns False if the report is already indexed"""
+        return self.add_many([report_id], [vector], [scan_type], [anomaly_detected]) == 1
+
+    def add_many(self, report_ids: List[str], vectors, scan_types: List[Optional[str]],
+                 anomaly_flags: List[Optional[bool]]) -> int:
+        """Append a batch of report embeddings, skipping ids already present"""
+        vectors = normalize_vectors(vectors)
+        added = 0
+        with self._exclusive():
+            for report_id, vector, scan_type, anomaly in zip(report_ids, vectors, scan_types, anomaly_flags):
+                if report_id in self._row_by_id:
+                    continue
+                if self.count == self.capacity:
+                    self._grow()
+
+                row = self.count
+                self._vectors[row] = vector
+                self._ids[row] = report_id.encode('ascii')
+                self._scan_codes[row] = self._scan_code(scan_type, create=True)
+                self._anomaly[row] = -1 if anomaly is None else int(bool(anomaly))
+                self._lists[row] = -1
+                if self._centroids is not None:
+                    list_id = int(np.argmax(self._centroids @ vector))
+                    self._lists[row] = list_id
+                    self._pending_postings[list_id].append(row)
+
+                self._row_by_id[report_id] = row
+                self.count += 1
+                added += 1
+
+            if added:
+                self._flush()
+                self._write_header()
+
+        if added:
+            self._maybe_train_async()
+        return added
+
+    # IVF training
+
+    def _maybe_train_async(self):
+        if self._training or self.count < IVF_MIN_VECTORS:
+            return
+        if self.ivf_trained_at and self.count < self.ivf_trained_at * IVF_RETRAIN_GROWTH:
+            return
+        self._training = True
+        threading.Thread(target=self.train_ivf, daemon=True, name='ivf-train').start()
+
+    def train_ivf(self, n_lists: Optional[int] = None, iterations: int = 10, seed: int = 0):
+        """Train IVF centroids with spherical k-means on a sample and assign every row to a list"""
+        with self._file_lock('train.lock', blocking=False) as acquired:
+            if not acquired:
+                # Another worker process is already training
+                self._training = False
+                return
+            self._train_ivf(n_lists, iterations, seed)
+
+    def _train_ivf(self, n_lists: Optional[int], iterations: int, seed: int):
+        try:
+            self.refresh()
+            n_rows = self.count
+            if n_rows == 0:
+                return
+            n_lists = n_lists or max(1, min(65536, int(4 * math.sqrt(n_rows))))
+            rng = np.random.default_rng(seed)
+            sample_size = min(n_rows, n_lists * 64)
+            sample = np.asarray(self._vectors[np.sort(rng.choice(n_rows, sample_size, replace=False))])
+
+            centroids = sample[rng.choice(sample_size, n_lists, replace=False)]
+            for _ in range(iterations):
+                assignment = np.argmax(sample @ centroids.T, axis=1)
+                sums = np.zeros_like(centroids)
+                np.add.at(sums, assignment, sample)
+                empty = ~sums.any(axis=1)
+                sums[empty] = centroids[empty]
+                centroids = normalize_vectors(sums)
+
+            # Assign the rows that existed when training started, then catch up under the lock
+            lists = np.empty(n_rows, dtype=np.int32)
+            for start in range(0, n_rows, SEARCH_BLOCK_ROWS):
+                block = self._vectors[start:min(start + SEARCH_BLOCK_ROWS, n_rows)]
+                lists[start:start + len(block)] = np.argmax(block @ centroids.T, axis=1)
+
+            with self._exclusive():
+                if self.count > n_rows:
+                    tail = np.asarray(self._vectors[n_rows:self.count])
+                    lists = np.concatenate([lists, np.argmax(tail @ centroids.T, axis=1).astype(np.int32)])
+                self._lists[:self.count] = lists
+                self._lists.flush()
+                np.save(self._path('centroids.npy'), centroids)
+                self.ivf_trained_at = self.count
+                self._write_header()
+                self._set_postings(centroids, lists)
+
+            logger.info(f"Trained IVF index with {n_lists} lists over {n_rows} vectors")
+        except Exception as e:
+            logger.error(f"Failed to train IVF index: {e}")
+        finally:
+            self._training = False
+
+    def _set_postings(self, centroids: np.ndarray, lists: np.ndarray):
+        order = np.argsort(lists, kind='stable')
+        bounds = np.searchsorted(lists[order], np.arange(len(centroids) + 1))
+        self._postings = [order[bounds[i]:bounds[i + 1]] for i in range(len(centroids))]
+        self._pending_postings = [[] for _ in range(len(centroids))]
+        self._centroids = centroids
+
+    def _probe_rows(self, query: np.ndarray, nprobe: int) -> np.ndarray:
+        with self._lock:
+            nprobe = min(nprobe, len(self._centroids))
+            probed = np.argpartition(-(self._centroids @ query), nprobe - 1)[:nprobe]
+            rows = []
+            for list_id in probed:
+                if self._pending_postings[list_id]:
+                    self._postings[list_id] = np.concatenate([
+                        self._postings[list_id],
+                        np.asarray(self._pending_postings[list_id], dtype=np.int64)
+                    ])
+                    self._pending_postings[list_id] = []
+                rows.append(self._postings[list_id])
+        return np.sort(np.concatenate(rows)) if rows else np.empty(0, dtype=np.int64)
+
+    # Queries
+
+    def _filter_mask(self, rows, scan_code: Optional[int], anomaly_detected: Optional[bool]) -> Optional[np.ndarray]:
+        mask = None
+        if scan_code is not None:
+            mask = self._scan_codes[rows] == scan_code
+        if anomaly_detected is not None:
+            anomaly_mask = self._anomaly[rows] == int(bool(anomaly_detected))
+            mask = anomaly_mask if mask is None else mask & anomaly_mask
+        return mask
+
+    def search(self, vector: np.ndarray, top_k: int = 10, scan_type: Optional[str] = None,
+               anomaly_detected: Optional[bool] = None, exact: bool = False,
+               nprobe: int = IVF_NPROBE) -> List[Tuple[str, float]]:
+        """
+        Return up to top_k (report_id, cosine similarity) pairs, best first
+
+        Uses the IVF index when one is trained unless exact=True.
+        """
+        query = normalize_vectors(vector)[0]
+        self.refresh()
+        n_rows = self.count
+        if n_rows == 0 or top_k <= 0:
+            return []
+
+        scan_code = None
+        if scan_type is not None:
+            scan_code = self._scan_code(scan_type, create=False)
+            if scan_code == -2:
+                return []
+
+        best_scores = np.empty(0, dtype=np.float32)
+        best_rows = np.empty(0, dtype=np.int64)
+
+        if self._centroids is not None and not exact:
+            candidate_rows = self._probe_rows(query, nprobe)
+            blocks = [candidate_rows[i:i + SEARCH_BLOCK_ROWS] for i in range(0, len(candidate_rows), SEARCH_BLOCK_ROWS)]
+        else:
+            blocks = [slice(start, min(start + SEARCH_BLOCK_ROWS, n_rows)) for start in range(0, n_rows, SEARCH_BLOCK_ROWS)]
+
+        for rows in blocks:
+            row_numbers = np.arange(rows.start, rows.stop) if isinstance(rows, slice) else rows
+            if len(row_numbers) == 0:
+                continue
+            mask = self._filter_mask(rows, scan_code, anomaly_detected)
+            if mask is not None:
+                if not mask.any():
+                    continue
+                row_numbers = row_numbers[mask]
+                scores = self._vectors[row_numbers] @ query
+            else:
+                scores = self._vectors[rows] @ query
+            best_scores, best_rows = _merge_top_k(
+                np.concatenate([best_scores, scores]), np.concatenate([best_rows, row_numbers]), top_k
+            )
+
+        return [(self._ids[row].decode('ascii'), float(score)) for score, row in zip(best_scores, best_rows)]
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            'vectors': self.count,
+            'dimension': self.dim,
+            'ivf_lists': 0 if self._centroids is None else len(self._centroids),
+            'ivf_training': self._training
+        }
+
+
+def sync_index_with_collection(index: VectorIndex, collection, vectorize_batch, batch_size: int = 256) -> int:
+    """
+    Add every stored report that is not yet in the index
+
+    vectorize_batch takes a list of texts and returns a 2D array of embeddings.
+    """
+    projection = {
+        'report_text': 1,
+        'analysis_result.scan_type': 1,
+        'analysis_result.anomaly_detection.analysis': 1,
+        'analysis_result.report_analysis.report_analysis': 1,
+        'anomaly_detected': 1
+    }
+    added = 0
+    batch = []
+
+    def flush(batch):
+        texts = [report_document_text(doc) for doc in batch]
+        return index.add_many(
+            [str(doc['_id']) for doc in batch],
+            vectorize_batch(texts),
+            [(doc.get('analysis_result') or {}).get('scan_type') for doc in batch],
+            [doc.get('anomaly_detected') for doc in batch]
+        )
+
+    for doc in collection.find({}, projection).sort('_id', 1).batch_size(batch_size):
+        if str(doc['_id']) in index:
+            continue
+        batch.append(doc)
+        if len(batch) >= batch_size:
+            added += flush(batch)
+            batch = []
+    if batch:
+        added += flush(batch)
+
+    if added:
+        logger.info(f"Added {added} stored reports to the similar-case index")
+    return added
+
+
+def start_index_sync(index: VectorIndex, collection, vectorize_batch):
+    """Run sync_index_with_collection on a background thread (in one worker process at a time)"""
+    def run():
+        try:
+            with index._file_lock('sync.lock', blocking=False) as acquired:
+                if acquired:
+                    sync_index_with_collection(index, collection, vectorize_batch)
+        except Exception as e:
+            logger.error(f"Failed to sync similar-case index with MongoDB: {e}")
+
+    thread = threading.Thread(target=run, daemon=True, name='similar-index-sync')
+    thread.start()
+    return thread
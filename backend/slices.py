@@ -0,0 +1,281 @@
+# slices.py
+# On-demand slices of stored volumes for scrolling through a CT/MR study
+#
+# Any axial, coronal or sagittal slice is cut from the memory-mapped voxel array
+# (see ScanStore.open_volume), windowed, resampled to the requested size and
+# encoded. Encoded slices are kept in an LRU cache, and the slices just ahead in
+# the scroll direction are encoded in the background before they are requested.
+#
+# For progressive delivery the viewer first requests a small size (cheap, and
+# usually already prefetched) and replaces it with the full-size slice once
+# scrolling pauses; format=jpeg is encoded as progressive JPEG as well.
+
+import os
+import logging
+import threading
+from io import BytesIO
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Any, Optional, Tuple
+import numpy as np
+from PIL import Image
+
+# Configure logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Configuration
+SLICE_CACHE_BYTES = int(os.environ.get('SLICE_CACHE_MB', 128)) * 1024 * 1024  # Encoded slices kept per process
+SLICE_PREFETCH_AHEAD = int(os.environ.get('SLICE_PREFETCH_AHEAD', 4))  # Slices encoded ahead of the scroll (0 disables)
+SLICE_PREFETCH_WORKERS = int(os.environ.get('SLICE_PREFETCH_WORKERS', 2))
+SLICE_MAX_SIZE = 2048  # Longest edge in pixels
+OPEN_VOLUMES = 4  # Memory-mapped volumes kept open
+PLANES = ('axial', 'coronal', 'sagittal')
+SLICE_FORMATS = {
+    "png": "image/png",
+    "jpeg": "image/jpeg"
+}
+
+
+class SliceError(Exception):
+    """Invalid slice request (HTTP 400)"""
+
+
+def slice_counts(shape) -> Dict[str, int]:
+    """Slices per plane of a (z, y, x) volume"""
+    return {"axial": shape[0], "coronal": shape[1], "sagittal": shape[2]}
+
+
+def extract_slice(volume: np.ndarray, spacing, plane: str, index: int) -> Tuple[np.ndarray, Tuple[float, float]]:
+    """
+    One slice of a (z, y, x) volume, oriented for display, with its (row, column) pixel spacing
+
+    Coronal and sagittal slices are flipped so superior is at the top.
+    """
+    dz, dy, dx = spacing
+    if plane == 'axial':
+        return volume[index], (dy, dx)
+    if plane == 'coronal':
+        return volume[::-1, index, :], (dz, dx)
+    return volume[::-1, :, index], (dz, dy)
+
+
+def render_slice(pixels: np.ndarray, pixel_spacing: Tuple[float, float], center: float, width: float,
+                 size: Optional[int] = None, img_format: str = 'png') -> bytes:
+    """
+    Window a slice to 8 bits, resample it to square pixels and encode it
+
+    Without a size the slice keeps its finest native resolution; with one, its
+    longest edge is `size` pixels.
+    """
+    low = center - width / 2
+    windowed = np.clip((np.asarray(pixels, dtype=np.float32) - low) * (255.0 / width), 0, 255).astype(np.uint8)
+
+    rows, columns = windowed.shape
+    row_spacing, column_spacing = pixel_spacing
+    finest = min(row_spacing, column_spacing)
+    out_height = rows * row_spacing / finest
+    out_width = columns * column_spacing / finest
+    if size:
+        scale = size / max(out_height, out_width)
+        out_height, out_width = out_height * scale, out_width * scale
+    out_size = (max(1, round(out_width)), max(1, round(out_height)))
+
+    image = Image.fromarray(windowed)
+    if out_size != image.size:
+        image = image.resize(out_size, Image.BILINEAR, reducing_gap=2.0)
+
+    buffer = BytesIO()
+    if img_format == 'jpeg':
+        image.save(buffer, format="JPEG", quality=85, progressive=True)
+    else:
+        image.save(buffer, format="PNG", compress_level=3)
+    return buffer.getvalue()
+
+
+class SliceServer:
+    """
+    Serves encoded slices of stored volumes from an LRU cache
+
+    The cache and the open memory maps are per process; the decoded volumes they
+    map live in the scan store and are shared by every worker through the page cache.
+    """
+
+    def __init__(self, scan_store, cache_bytes: int = SLICE_CACHE_BYTES,
+                 prefetch_ahead: int = SLICE_PREFETCH_AHEAD):
+        self.scan_store = scan_store
+        self.cache_bytes = cache_bytes
+        self.prefetch_ahead = prefetch_ahead
+        self._cache: "OrderedDict[tuple, bytes]" = OrderedDict()
+        self._cache_size = 0
+        self._volumes: "OrderedDict[str, Tuple[np.ndarray, Dict[str, Any]]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._open_locks: Dict[str, threading.Lock] = {}  # Per scan, while its volume is being opened
+        self._executor = None  # Created on first prefetch, i.e. in the worker process
+        self._pending = set()
+        self._last_index: Dict[Tuple[str, str], int] = {}
+        self._hits = 0
+        self._misses = 0
+        self._prefetched = 0
+
+    def _open(self, scan_hash: str) -> Optional[Tuple[np.ndarray, Dict[str, Any]]]:
+        """The memory-mapped volume of a scan; raises SliceError if the scan is a single image"""
+        with self._lock:
+            if scan_hash in self._volumes:
+                self._volumes.move_to_end(scan_hash)
+                return self._volumes[scan_hash]
+        if scan_hash not in self.scan_store:
+            return None
+        with self._lock:
+            open_lock = self._open_locks.setdefault(scan_hash, threading.Lock())
+        # One decode per scan at a time; a large volume is decoded only on its first request,
+        # and opening one scan does not hold up requests for the others
+        try:
+            with open_lock:
+                with self._lock:
+                    if scan_hash in self._volumes:
+                        return self._volumes[scan_hash]
+                opened = self.scan_store.open_volume(scan_hash)
+                if opened is None:
+                    raise SliceError("Scan is not a volume")
+                with self._lock:
+                    self._volumes[scan_hash] = opened
+                    while len(self._volumes) > OPEN_VOLUMES:
+                        evicted_hash, _evicted = self._volumes.popitem(last=False)
+                        for plane in PLANES:
+                            self._last_index.pop((evicted_hash, plane), None)
+        finally:
+            with self._lock:
+                if self._open_locks.get(scan_hash) is open_lock:
+                    del self._open_locks[scan_hash]
+        return opened
+
+    def volume_info(self, scan_hash: str) -> Optional[Dict[str, Any]]:
+        """Shape, spacing, slices per plane and default window of a stored volume; None if the scan is unknown"""
+        opened = self._open(scan_hash)
+        if opened is None:
+            return None
+        _volume, info = opened
+        return {
+            "scan_hash": scan_hash,
+            "shape": info["shape"],
+            "spacing": info["spacing"],
+            "slices": slice_counts(info["shape"]),
+            "window": info["window"]
+        }
+
+    def get_slice(self, scan_hash: str, plane: str, index: int, size: Optional[int] = None,
+                  center: Optional[float] = None, width: Optional[float] = None,
+                  img_format: str = 'png', prefetch: bool = True) -> Optional[Tuple[bytes, bool]]:
+        """
+        An encoded slice and whether it came from the cache; None if the scan is unknown
+
+        center and width default to the volume's window.
+        """
+        if plane not in PLANES:
+            raise SliceError(f"Invalid plane '{plane}'. Allowed: {', '.join(PLANES)}")
+        if img_format not in SLICE_FORMATS:
+            raise SliceError(f"Invalid format '{img_format}'. Allowed: {', '.join(SLICE_FORMATS)}")
+        if size is not None and not 0 < size <= SLICE_MAX_SIZE:
+            raise SliceError(f"size must be between 1 and {SLICE_MAX_SIZE}")
+        if width is not None and width <= 0:
+            raise SliceError("width must be positive")
+
+        opened = self._open(scan_hash)
+        if opened is None:
+            return None
+        volume, info = opened
+        count = slice_counts(info["shape"])[plane]
+        if not 0 <= index < count:
+            raise SliceError(f"index must be between 0 and {count - 1} for the {plane} plane")
+        center = info["window"]["center"] if center is None else center
+        width = info["window"]["width"] if width is None else width
+        params = (size, center, width, img_format)
+
+        key = (scan_hash, plane, index) + params
+        with self._lock:
+            data = self._cache.get(key)
+            if data is not None:
+                self._cache.move_to_end(key)
+                self._hits += 1
+            else:
+                self._misses += 1
+        hit = data is not None
+        if not hit:
+            data = self._render(volume, info, key)
+
+        if prefetch and self.prefetch_ahead > 0:
+            self._schedule_prefetch(volume, info, scan_hash, plane, index, count, params)
+        return data, hit
+
+    def _render(self, volume: np.ndarray, info: Dict[str, Any], key: tuple) -> bytes:
+        _scan_hash, plane, index, size, center, width, img_format = key
+        pixels, pixel_spacing = extract_slice(volume, info["spacing"], plane, index)
+        data = render_slice(pixels, pixel_spacing, center, width, size, img_format)
+        self._store(key, data)
+        return data
+
+    def _store(self, key: tuple, data: bytes):
+        if len(data) > self.cache_bytes:
+            return
+        with self._lock:
+            if key in self._cache:
+                return
+            self._cache[key] = data
+            self._cache_size += len(data)
+            while self._cache_size > self.cache_bytes:
+                _key, evicted = self._cache.popitem(last=False)
+                self._cache_size -= len(evicted)
+
+    def _schedule_prefetch(self, volume, info, scan_hash: str, plane: str, index: int, count: int, params: tuple):
+        """Encode the next slices in the scroll direction (and one behind) in the background"""
+        with self._lock:
+            previous = self._last_index.get((scan_hash, plane))
+            if scan_hash in self._volumes:  # Entries are dropped with the volume; don't re-add one just evicted
+                self._last_index[(scan_hash, plane)] = index
+            direction = -1 if previous is not None and index < previous else 1
+            targets = [index + direction * step for step in range(1, self.prefetch_ahead + 1)] + [index - direction]
+            keys = [
+                (scan_hash, plane, target) + params
+                for target in targets
+                if 0 <= target < count
+            ]
+            keys = [key for key in keys if key not in self._cache and key not in self._pending]
+            self._pending.update(keys)
+            if keys and self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=SLICE_PREFETCH_WORKERS,
+                                                    thread_name_prefix='slice-prefetch')
+        for key in keys:
+            self._executor.submit(self._prefetch, volume, info, key)
+
+    def _prefetch(self, volume, info, key: tuple):
+        try:
+            self._render(volume, info, key)
+            with self._lock:
+                self._prefetched += 1
+        except Exception as e:
+            logger.error(f"Failed to prefetch slice {key[1]} {key[2]} of scan {key[0][:12]}: {e}")
+        finally:
+            with self._lock:
+                self._pending.discard(key)
+
+    def forget(self, scan_hash: str):
+        """Drop a scan's open volume and cached slices, e.g. after it was deleted from the store"""
+        with self._lock:
+            self._volumes.pop(scan_hash, None)
+            for key in [key for key in self._last_index if key[0] == scan_hash]:
+                del self._last_index[key]
+            for key in [key for key in self._cache if key[0] == scan_hash]:
+                self._cache_size -= len(self._cache.pop(key))
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "cached_slices": len(self._cache),
+                "cache_bytes": self._cache_size,
+                "open_volumes": len(self._volumes),
+                "hits": self._hits,
+                "misses": self._misses,
+                "prefetched": self._prefetched,
+                "prefetch_pending": len(self._pending)
+            }
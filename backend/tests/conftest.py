@@ -0,0 +1,7 @@
+# conftest.py
+# The backend modules are flat, imported by name from the backend directory
+
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,166 @@
+# test_admission.py
+# Queueing, dispatch order and deadline handling of the admission controller
+
+import time
+import threading
+import pytest
+import admission
+from admission import AdmissionController, AdmissionRejected
+
+
+def make_controller(concurrency=1, service_time=0.1):
+    controller = AdmissionController(concurrency=concurrency, client_max_in_flight=10)
+    controller._service_time["analyze"] = service_time
+    return controller
+
+
+def acquire_in_thread(controller, results, name, priority="routine", timeout=None, client_id=None):
+    """Start acquire() in a thread that appends (name, ticket or exception) to results"""
+    def run():
+        try:
+            results.append((name, controller.acquire("analyze", priority, client_id or name, timeout)))
+        except AdmissionRejected as e:
+            results.append((name, e))
+
+    thread = threading.Thread(target=run)
+    thread.start()
+    return thread
+
+
+def wait_queued(controller, count):
+    deadline = time.monotonic() + 2
+    while sum(len(queue) for queue in controller._queues.values()) < count:
+        assert time.monotonic() < deadline, "requests were not queued"
+        time.sleep(0.005)
+
+
+def test_free_slot_goes_to_most_urgent_class_first():
+    controller = make_controller()
+    holder = controller.acquire("analyze", "routine", "holder")
+    results = []
+    threads = [acquire_in_thread(controller, results, "routine", "routine")]
+    wait_queued(controller, 1)
+    threads.append(acquire_in_thread(controller, results, "stat", "stat"))
+    wait_queued(controller, 2)
+
+    controller.release(holder)
+    threads[1].join(2)
+    assert [name for name, _ticket in results] == ["stat"]
+    controller.release(results[0][1])
+    threads[0].join(2)
+    assert [name for name, _ticket in results] == ["stat", "routine"]
+    controller.release(results[1][1])
+    assert controller._running == 0
+    assert controller._client_in_flight == {}
+
+
+def test_earliest_deadline_first_within_a_class():
+    controller = make_controller()
+    holder = controller.acquire("analyze", "routine", "holder")
+    results = []
+    threads = [acquire_in_thread(controller, results, "late", timeout=60)]
+    wait_queued(controller, 1)
+    threads.append(acquire_in_thread(controller, results, "early", timeout=30))
+    wait_queued(controller, 2)
+
+    controller.release(holder)
+    threads[1].join(2)
+    assert [name for name, _ticket in results] == ["early"]
+    controller.release(results[0][1])
+    threads[0].join(2)
+    controller.release(results[1][1])
+
+
+def test_queued_request_is_dropped_when_it_can_no_longer_finish_in_time():
+    controller = make_controller()
+    holder = controller.acquire("analyze", "routine", "holder")
+    results = []
+    thread = acquire_in_thread(controller, results, "queued", timeout=1.0)
+    wait_queued(controller, 1)
+
+    # The operation turned out slower than the time the queued request has left
+    controller._service_time["analyze"] = 5.0
+    controller.release(holder)
+    thread.join(2)
+
+    [(_name, error)] = results
+    assert isinstance(error, AdmissionRejected)
+    assert error.reason == "dropped_deadline"
+    assert controller._counters["routine"]["dropped_deadline"] == 1
+    assert controller._running == 0
+    assert controller._client_in_flight == {}
+
+
+def test_request_whose_deadline_passes_in_the_queue_is_rejected_and_not_run_later():
+    controller = make_controller(service_time=0.01)
+    holder = controller.acquire("analyze", "routine", "holder")
+    results = []
+    thread = acquire_in_thread(controller, results, "queued", timeout=0.2)
+    thread.join(2)
+
+    [(_name, error)] = results
+    assert isinstance(error, AdmissionRejected)
+    assert error.status == 503
+    assert controller._client_in_flight == {"holder": 1}
+
+    controller.release(holder)
+    # The timed-out ticket must not be handed the freed slot
+    assert controller._running == 0
+    assert controller._client_in_flight == {}
+
+
+def test_grant_that_lands_as_the_wait_times_out_is_honoured(monkeypatch):
+    class LateEvent(threading.Event):
+        """Reports a timeout even though the slot was granted, as when both happen at once"""
+
+        def wait(self, timeout=None):
+            super().wait(2)
+            return False
+
+    monkeypatch.setattr(admission.threading, "Event", LateEvent)
+    controller = make_controller()
+    holder = controller.acquire("analyze", "routine", "holder")
+    results = []
+    thread = acquire_in_thread(controller, results, "queued", timeout=30)
+    wait_queued(controller, 1)
+
+    controller.release(holder)
+    thread.join(2)
+    [(_name, ticket)] = results
+    assert isinstance(ticket, admission.Ticket)
+    assert controller._running == 1
+    assert controller._counters["routine"]["admitted"] == 2
+    assert controller._counters["routine"]["dropped_deadline"] == 0
+
+    controller.release(ticket)
+    assert controller._running == 0
+    assert controller._client_in_flight == {}
+
+
+def test_requests_that_cannot_meet_their_deadline_are_refused_up_front():
+    controller = make_controller(service_time=5.0)
+    with pytest.raises(AdmissionRejected) as rejected:
+        controller.acquire("analyze", "routine", "client", timeout=1.0)
+    assert rejected.value.reason == "rejected_deadline"
+    assert controller._client_in_flight == {}
+
+
+def test_client_limit():
+    controller = AdmissionController(concurrency=4, client_max_in_flight=1)
+    ticket = controller.acquire("analyze", "routine", "client")
+    with pytest.raises(AdmissionRejected) as rejected:
+        controller.acquire("analyze", "routine", "client")
+    assert rejected.value.status == 429
+    controller.release(ticket)
+
+
+@pytest.mark.parametrize("value", [1, 2.5, ["stat"], {"class": "stat"}, "asap"])
+def test_parse_priority_rejects_malformed_values(value):
+    with pytest.raises(ValueError):
+        AdmissionController().parse_priority(value)
+
+
+def test_parse_priority_defaults_and_normalizes():
+    controller = AdmissionController()
+    assert controller.parse_priority(None) == "routine"
+    assert controller.parse_priority(" STAT ") == "stat"
@@ -0,0 +1,101 @@
+# test_compare_align.py
+# Sentence segmentation and banded alignment of the sentence-level report diff
+
+import numpy as np
+import pytest
+
+pytest.importorskip("sentence_transformers")  # compare loads the embedding model on import
+
+from compare import align_sentences, segment_sentences
+
+
+def matching(old_to_new, n, m, score=0.9):
+    """Similarity matrix where old sentence i matches new sentence old_to_new[i] and nothing else"""
+    similarity = np.zeros((n, m))
+    for i, j in old_to_new.items():
+        similarity[i, j] = score
+    return similarity
+
+
+def assert_valid_alignment(pairs, n, m):
+    """Every sentence appears exactly once, and matched pairs are in order on both sides"""
+    assert sorted(i for i, _ in pairs if i is not None) == list(range(n))
+    assert sorted(j for _, j in pairs if j is not None) == list(range(m))
+    matched = [(i, j) for i, j in pairs if i is not None and j is not None]
+    assert matched == sorted(matched)
+    assert [j for _, j in matched] == sorted(j for _, j in matched)
+
+
+def test_identical_reports_align_on_the_diagonal():
+    assert align_sentences(np.eye(5)) == [(i, i) for i in range(5)]
+
+
+def test_empty_sides_are_all_added_or_removed():
+    assert align_sentences(np.zeros((0, 3))) == [(None, 0), (None, 1), (None, 2)]
+    assert align_sentences(np.zeros((2, 0))) == [(0, None), (1, None)]
+
+
+def test_pairs_below_the_threshold_are_added_and_removed():
+    pairs = align_sentences(np.full((1, 1), 0.5), threshold=0.6)
+    assert sorted(pairs, key=str) == sorted([(0, None), (None, 0)], key=str)
+
+
+def test_inserted_block_is_skipped_and_the_rest_still_matches():
+    # 40 new sentences inserted in the middle: further than the band, but the band widens by the length difference
+    n, inserted = 60, 40
+    old_to_new = {i: i if i < 30 else i + inserted for i in range(n)}
+    pairs = align_sentences(matching(old_to_new, n, n + inserted), band=8)
+    assert_valid_alignment(pairs, n, n + inserted)
+    assert [(i, j) for i, j in pairs if i is not None and j is not None] == sorted(old_to_new.items())
+
+
+def test_sentences_that_drifted_past_the_band_are_reported_as_changed():
+    # The last old sentence moved to the start of an equally long report
+    n = 50
+    old_to_new = {i: i + 1 for i in range(n - 1)}
+    old_to_new[n - 1] = 0
+    pairs = align_sentences(matching(old_to_new, n, n), band=4)
+    assert_valid_alignment(pairs, n, n)
+    assert (n - 1, None) in pairs
+    assert (None, 0) in pairs
+
+
+@pytest.mark.parametrize("n, m", [(3, 400), (400, 3), (1, 300), (120, 7)])
+def test_very_skewed_lengths_stay_valid_under_the_band_cap(n, m):
+    rng = np.random.default_rng(n * 1000 + m)
+    pairs = align_sentences(rng.random((n, m)), band=2, max_band=5)
+    assert_valid_alignment(pairs, n, m)
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_wide_band_finds_the_best_monotone_matching(seed):
+    rng = np.random.default_rng(seed)
+    n, m = 7, 9
+    similarity = rng.random((n, m))
+    pairs = align_sentences(similarity, threshold=0.6, band=100, max_band=100)
+    assert_valid_alignment(pairs, n, m)
+
+    # Best total gain over all monotone matchings, computed without a band
+    best = np.zeros((n + 1, m + 1))
+    for i in range(1, n + 1):
+        for j in range(1, m + 1):
+            best[i, j] = max(best[i - 1, j], best[i, j - 1],
+                             best[i - 1, j - 1] + max(0.0, similarity[i - 1, j - 1] - 0.6))
+    total = sum(similarity[i, j] - 0.6 for i, j in pairs if i is not None and j is not None)
+    assert total == pytest.approx(best[n, m])
+
+
+def test_segmentation_splits_all_caps_and_sentences_starting_with_digits_or_brackets():
+    text = "FINDINGS: NO ACUTE FRACTURE. IMPRESSION: NORMAL STUDY.\nMild effusion. 2 nodules seen. (Stable.)"
+    assert segment_sentences(text) == [
+        "FINDINGS: NO ACUTE FRACTURE.",
+        "IMPRESSION: NORMAL STUDY.",
+        "Mild effusion.",
+        "2 nodules seen.",
+        "(Stable.)"
+    ]
+
+
+def test_segmentation_keeps_abbreviations_and_decimals_inside_a_sentence():
+    text = "Nodule measures 3.5 cm, e.g. stable vs. prior.   Follow up   in 6 months!"
+    assert segment_sentences(text) == ["Nodule measures 3.5 cm, e.g. stable vs. prior.", "Follow up in 6 months!"]
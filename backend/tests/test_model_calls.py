@@ -0,0 +1,165 @@
+# test_model_calls.py
+# Deadlines and hedging of outbound model calls
+
+import time
+import threading
+import pytest
+import model_calls
+from model_calls import ModelCaller, DeadlineExceeded, call_deadline, remaining_time, HEDGE_MIN_SAMPLES
+
+
+class FakeModel:
+    """create(**kwargs) that sleeps for the next scripted delay, or raises it if it is an exception"""
+
+    def __init__(self, *delays, default=0.0):
+        self.delays = list(delays)
+        self.default = default
+        self.timeouts = []
+        self._lock = threading.Lock()
+
+    def create(self, **kwargs):
+        with self._lock:
+            self.timeouts.append(kwargs["timeout"])
+            delay = self.delays.pop(0) if self.delays else self.default
+        if isinstance(delay, Exception):
+            raise delay
+        time.sleep(delay)
+        return "ok"
+
+
+def warm_up(caller, name="chat", latency=0.0):
+    """Record enough fast calls that the operation becomes eligible for hedging"""
+    model = FakeModel(default=latency)
+    for _ in range(HEDGE_MIN_SAMPLES):
+        caller.call(name, model.create)
+    # Latencies are recorded by a done callback, which may run just after the caller returns
+    deadline = time.monotonic() + 2
+    while len(caller._operations[name].attempt_latencies) < HEDGE_MIN_SAMPLES:
+        assert time.monotonic() < deadline, "latencies were not recorded"
+        time.sleep(0.005)
+
+
+def test_nested_deadlines_only_shorten_the_outer_one():
+    assert remaining_time() is None
+    now = time.monotonic()
+    with call_deadline(now + 10):
+        with call_deadline(now + 20):
+            assert remaining_time() <= 10
+        with call_deadline(now + 5):
+            assert remaining_time() <= 5
+        with call_deadline(None):
+            assert 5 < remaining_time() <= 10
+    assert remaining_time() is None
+
+
+def test_call_timeout_is_the_time_left():
+    caller = ModelCaller(hedge=False)
+    model = FakeModel()
+    with call_deadline(time.monotonic() + 3):
+        caller.call("chat", model.create)
+    assert 2 < model.timeouts[0] <= 3
+
+    caller.call("chat", model.create)
+    assert model.timeouts[1] == model_calls.MODEL_CALL_TIMEOUT
+
+
+def test_call_is_not_started_without_enough_time_left():
+    caller = ModelCaller(hedge=False)
+    model = FakeModel()
+    with call_deadline(time.monotonic() + model_calls.MIN_CALL_TIME / 2):
+        with pytest.raises(DeadlineExceeded):
+            caller.call("chat", model.create)
+    assert model.timeouts == []
+    assert caller.stats()["operations"]["chat"]["deadline_exceeded"] == 1
+
+
+def test_caller_stops_waiting_at_the_deadline():
+    caller = ModelCaller(hedge=False)
+    model = FakeModel(2.0)
+    started = time.monotonic()
+    with call_deadline(started + 0.6):
+        with pytest.raises(DeadlineExceeded):
+            caller.call("chat", model.create)
+    assert time.monotonic() - started < 1.5
+    assert caller.stats()["operations"]["chat"]["deadline_exceeded"] == 1
+
+
+def test_provider_timeout_at_the_deadline_is_reported_as_deadline_exceeded():
+    caller = ModelCaller(hedge=False)
+
+    def create(**kwargs):
+        time.sleep(kwargs["timeout"])
+        raise TimeoutError("read timed out")
+
+    with call_deadline(time.monotonic() + 0.6):
+        with pytest.raises(DeadlineExceeded):
+            caller.call("chat", create)
+    counters = caller.stats()["operations"]["chat"]
+    assert counters["deadline_exceeded"] == 1
+    assert counters["errors"] == 0
+
+
+def test_errors_without_a_deadline_are_re_raised():
+    caller = ModelCaller(hedge=False)
+    with pytest.raises(ValueError):
+        caller.call("chat", FakeModel(ValueError("bad request")).create)
+    assert caller.stats()["operations"]["chat"]["errors"] == 1
+
+
+def test_slow_call_is_hedged_and_the_faster_attempt_wins():
+    caller = ModelCaller(hedge=True, hedge_percentile=95, hedge_budget=0.05)
+    warm_up(caller, latency=0.01)
+    model = FakeModel(1.0, 0.0)
+    started = time.monotonic()
+    assert caller.call("chat", model.create) == "ok"
+    assert time.monotonic() - started < 0.5
+    assert len(model.timeouts) == 2
+    assert model.timeouts[1] < model.timeouts[0]
+    counters = caller.stats()["operations"]["chat"]
+    assert counters["hedged"] == 1
+    assert counters["hedge_won"] == 1
+
+
+def test_hedge_succeeds_when_the_first_attempt_fails():
+    caller = ModelCaller(hedge=True)
+    warm_up(caller, latency=0.01)
+    attempts = []
+
+    def create(**kwargs):
+        attempts.append(kwargs["timeout"])
+        if len(attempts) == 1:
+            time.sleep(0.3)  # Fails only after the hedge has been sent
+            raise RuntimeError("connection reset")
+        return "ok"
+
+    assert caller.call("chat", create) == "ok"
+    assert len(attempts) == 2
+    assert caller.stats()["operations"]["chat"]["hedge_won"] == 1
+
+
+def test_hedges_are_limited_by_the_budget():
+    # The median stays at the warm-up latency however many slow calls follow
+    caller = ModelCaller(hedge=True, hedge_percentile=50, hedge_budget=0.0)
+    warm_up(caller, latency=0.01)
+    model = FakeModel(default=0.1)
+    for _ in range(model_calls.HEDGE_BURST + 2):
+        caller.call("chat", model.create)
+    counters = caller.stats()["operations"]["chat"]
+    assert counters["hedged"] == model_calls.HEDGE_BURST
+    assert counters["hedge_over_budget"] == 2
+
+
+def test_calls_are_not_hedged_before_enough_samples():
+    caller = ModelCaller(hedge=True)
+    model = FakeModel(0.2)
+    caller.call("chat", model.create)
+    assert len(model.timeouts) == 1
+
+
+def test_calls_are_not_hedged_when_hedging_is_off():
+    caller = ModelCaller(hedge=False)
+    warm_up(caller, latency=0.01)
+    model = FakeModel(0.2)
+    caller.call("chat", model.create)
+    assert len(model.timeouts) == 1
+    assert caller.stats()["operations"]["chat"]["hedged"] == 0
@@ -0,0 +1,125 @@
+# test_persistence.py
+# Journal replay and retries of the write-behind writer
+
+import os
+import pytest
+from bson.objectid import ObjectId
+from pymongo.errors import BulkWriteError
+import persistence
+from persistence import WriteBehindWriter, DUPLICATE_KEY_ERROR
+
+
+class FakeCollection:
+    """insert_many with MongoDB's unordered duplicate-key behaviour, optionally failing the first calls"""
+
+    def __init__(self, failures=0):
+        self.docs = {}
+        self.failures = failures
+        self.calls = 0
+
+    def insert_many(self, batch, ordered=True):
+        self.calls += 1
+        if self.failures:
+            self.failures -= 1
+            raise ConnectionError("primary unavailable")
+        errors = []
+        for i, doc in enumerate(batch):
+            if doc["_id"] in self.docs:
+                errors.append({"index": i, "code": DUPLICATE_KEY_ERROR})
+            else:
+                self.docs[doc["_id"]] = doc
+        if errors:
+            raise BulkWriteError({"writeErrors": errors})
+
+
+def make_writer(collection, journal_path, written=None):
+    return WriteBehindWriter(collection, journal_path=journal_path, flush_interval=0.01, fsync=False,
+                             on_written=written.extend if written is not None else None)
+
+
+def journal_docs(path):
+    with open(path) as f:
+        return [line for line in f if line.strip()]
+
+
+@pytest.fixture
+def journal_path(tmp_path):
+    return str(tmp_path / "journal" / "pending.jsonl")
+
+
+def test_replay_writes_only_unacknowledged_documents(journal_path):
+    crashed = make_writer(FakeCollection(), journal_path)
+    ids = [crashed.submit({"patient_id": f"p{i}"}) for i in range(3)]
+    crashed._append_journal([{"ack": [ids[0]]}])
+    with open(journal_path, 'a') as f:
+        f.write('{"doc": {"_id": {"$oid"')  # Torn final line
+
+    collection = FakeCollection()
+    writer = make_writer(collection, journal_path)
+    writer.start()
+    try:
+        assert writer.flush(5)
+    finally:
+        writer.stop()
+    assert sorted(collection.docs) == sorted(ids[1:])
+    assert journal_docs(journal_path) == []
+
+
+def test_replayed_documents_already_in_mongodb_are_not_an_error(journal_path):
+    crashed = make_writer(FakeCollection(), journal_path)
+    ids = [crashed.submit({"patient_id": "p1"}) for _ in range(2)]
+
+    collection = FakeCollection()
+    collection.docs[ids[0]] = {"_id": ids[0]}  # Written before the crash, but never acknowledged
+    written = []
+    writer = make_writer(collection, journal_path, written)
+    writer.start()
+    try:
+        assert writer.flush(5)
+    finally:
+        writer.stop()
+    assert sorted(collection.docs) == sorted(ids)
+    # The callback sees the whole batch, so it can count reports an earlier attempt inserted
+    assert sorted(doc["_id"] for doc in written) == sorted(ids)
+    assert writer.stats()["failed_flushes"] == 0
+
+
+def test_failed_flush_is_retried_without_losing_documents(journal_path):
+    collection = FakeCollection(failures=1)
+    writer = make_writer(collection, journal_path)
+    writer.start()
+    try:
+        doc_id = writer.submit({"patient_id": "p1"})
+        assert writer.get_pending(doc_id) is not None
+        assert writer.flush(5)
+    finally:
+        writer.stop()
+    assert list(collection.docs) == [doc_id]
+    assert writer.stats()["failed_flushes"] == 1
+    assert writer.get_pending(doc_id) is None
+
+
+def test_submit_queues_a_snapshot(journal_path):
+    writer = make_writer(FakeCollection(), journal_path)
+    doc = {"patient_id": "p1", "analysis_result": {"scan_type": "CT"}}
+    doc_id = writer.submit(doc)
+    doc["analysis_result"]["report_id"] = str(doc_id)
+    assert "report_id" not in writer.get_pending(doc_id)["analysis_result"]
+
+
+@pytest.mark.skipif(persistence.fcntl is None, reason="journal slots need fcntl")
+def test_orphaned_journal_of_a_dead_worker_is_adopted(journal_path):
+    orphan_path = persistence._journal_slot_path(journal_path, 1)
+    crashed = make_writer(FakeCollection(), orphan_path)
+    doc_id = crashed.submit({"patient_id": "p1"})
+
+    collection = FakeCollection()
+    writer = make_writer(collection, journal_path)
+    writer.start()
+    try:
+        assert writer.flush(5)
+    finally:
+        writer.stop()
+    assert writer.journal_path == journal_path
+    assert list(collection.docs) == [doc_id]
+    assert not os.path.exists(orphan_path)
@@ -0,0 +1,67 @@
+# test_report_condense.py
+# Token budgets and what survives condensing
+
+import pytest
+
+pytest.importorskip("sentence_transformers")  # report_condense scores sentences with compare's patterns
+
+from report_condense import condense_report, estimate_tokens, OMISSION_MARKER, CHARS_PER_TOKEN
+
+KEY_FINDING = "Displaced fracture of the left femoral neck with severe angulation."
+FILLER = "The patient was seen in the outpatient clinic today for a routine visit number {}."
+
+
+def pasted_history(filler_sentences=40):
+    lines = [
+        "St. Example Hospital Radiology",
+        "Page 1 of 3",
+        "MRN: 123456",
+        *[FILLER.format(i) for i in range(filler_sentences)],
+        "IMPRESSION:",
+        KEY_FINDING,
+        "Electronically signed by Dr. Smith on 2026-01-01",
+    ]
+    return "\n".join(lines)
+
+
+def test_text_within_budget_only_loses_boilerplate_and_repeats():
+    text = "Findings: Mild effusion.\nPage 2 of 3\nFindings: Mild effusion.\nNo acute fracture."
+    condensed, info = condense_report(text, token_budget=1000)
+    assert condensed == "Findings: Mild effusion.\nNo acute fracture."
+    assert info["dropped_counts"] == {"boilerplate": 1, "duplicate": 1, "low_relevance": 0, "truncated": 0}
+
+
+@pytest.mark.parametrize("budget", [30, 60, 120, 300])
+def test_condensed_text_fits_the_budget(budget):
+    condensed, info = condense_report(pasted_history(), token_budget=budget)
+    assert info["condensed_tokens"] == estimate_tokens(condensed)
+    assert info["condensed_tokens"] <= budget
+    assert info["original_tokens"] > budget
+    assert info["tokens_saved"] == info["original_tokens"] - info["condensed_tokens"]
+
+
+def test_key_findings_outrank_filler_and_order_is_kept():
+    condensed, info = condense_report(pasted_history(), token_budget=60)
+    assert KEY_FINDING in condensed
+    assert OMISSION_MARKER in condensed
+    assert info["dropped_counts"]["low_relevance"] > 0
+    lines = condensed.splitlines()
+    assert lines[-1] == KEY_FINDING
+    kept_filler = [int(line.rstrip(".").rsplit(" ", 1)[1]) for line in lines if line.startswith("The patient")]
+    assert kept_filler == sorted(kept_filler)
+
+
+def test_sentence_longer_than_the_budget_keeps_its_head():
+    sentence = "Severe " + " ".join(f"segment{i}" for i in range(200)) + " fracture."
+    condensed, info = condense_report(sentence, token_budget=40)
+    assert condensed.startswith("Severe segment0")
+    assert condensed.endswith(OMISSION_MARKER)
+    assert info["dropped_counts"]["truncated"] == 1
+    assert info["condensed_tokens"] <= 40
+
+
+def test_report_that_is_all_boilerplate_falls_back_to_its_start():
+    text = "\n".join(f"Page {i} of 200" for i in range(1, 200))
+    condensed, info = condense_report(text, token_budget=25)
+    assert condensed == text[:25 * CHARS_PER_TOKEN]
+    assert info["condensed_tokens"] <= 25
@@ -0,0 +1,107 @@
+# test_report_queries.py
+# Continuation tokens and keyset filters of the patient report listing
+
+from datetime import datetime, timedelta
+import pytest
+from bson.objectid import ObjectId
+from report_queries import encode_cursor, decode_cursor, keyset_filter
+
+
+def matches(doc, query):
+    """Evaluate the subset of MongoDB query operators keyset_filter produces"""
+    for key, condition in query.items():
+        if key == "$or":
+            if not any(matches(doc, branch) for branch in condition):
+                return False
+            continue
+        value = doc.get(key)
+        if isinstance(condition, dict):
+            for operator, operand in condition.items():
+                if operator == "$ne" and value == operand:
+                    return False
+                if operator == "$lt" and not (value is not None and value < operand):
+                    return False
+                if operator == "$gt" and not (value is not None and value > operand):
+                    return False
+        elif value != condition:
+            return False
+    return True
+
+
+def mongo_sort_key(doc, field):
+    # MongoDB orders null before any value
+    value = doc.get(field)
+    return (value is not None, value if value is not None else 0, doc["_id"])
+
+
+def paginate(docs, field, direction, limit):
+    """Walk every page the way find_report_page does, returning the _ids in page order"""
+    ordered = sorted(docs, key=lambda doc: mongo_sort_key(doc, field), reverse=direction < 0)
+    seen = []
+    query = {}
+    while True:
+        page = [doc for doc in ordered if matches(doc, query)][:limit]
+        seen.extend(doc["_id"] for doc in page)
+        if len(page) < limit:
+            return seen
+        cursor = decode_cursor(encode_cursor("created_at", direction, page[-1]))
+        query = keyset_filter(field, direction, cursor["value"], cursor["id"])
+
+
+def make_docs():
+    start = datetime(2026, 1, 1)
+    docs = []
+    for i in range(11):
+        # Repeated timestamps and missing values exercise the _id tie-break and the null branch
+        created_at = None if i % 4 == 0 else start + timedelta(days=i // 2)
+        docs.append({"_id": ObjectId(), "created_at": created_at})
+    return docs
+
+
+def test_cursor_round_trips_datetime_and_id():
+    doc = {"_id": ObjectId(), "created_at": datetime(2026, 3, 4, 5, 6, 7, 890000)}
+    cursor = decode_cursor(encode_cursor("created_at", -1, doc))
+    assert cursor == {"sort": "created_at", "direction": -1, "value": doc["created_at"], "id": doc["_id"]}
+
+
+def test_cursor_round_trips_missing_and_nested_values():
+    doc = {"_id": ObjectId(), "analysis_result": {"scan_type": "CT"}}
+    assert decode_cursor(encode_cursor("scan_type", 1, doc))["value"] == "CT"
+    assert decode_cursor(encode_cursor("created_at", 1, doc))["value"] is None
+
+
+def test_cursor_token_is_url_safe():
+    token = encode_cursor("created_at", 1, {"_id": ObjectId(), "created_at": datetime(2026, 1, 1)})
+    assert set(token) <= set("ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789-_")
+
+
+@pytest.mark.parametrize("token", ["", "not-a-cursor", "eyJzIjoiY3JlYXRlZF9hdCJ9", encode_cursor(
+    "created_at", 1, {"_id": ObjectId(), "created_at": None})[:-4]])
+def test_malformed_cursor_raises_value_error(token):
+    with pytest.raises(ValueError):
+        decode_cursor(token)
+
+
+def test_descending_null_cursor_only_continues_through_nulls():
+    last_id = ObjectId()
+    query = keyset_filter("created_at", -1, None, last_id)
+    assert matches({"_id": ObjectId("0" * 24), "created_at": None}, query)
+    assert not matches({"_id": ObjectId("f" * 24), "created_at": None}, query)
+    assert not matches({"_id": ObjectId("0" * 24), "created_at": datetime(2026, 1, 1)}, query)
+
+
+def test_ascending_null_cursor_continues_into_values():
+    last_id = ObjectId()
+    query = keyset_filter("created_at", 1, None, last_id)
+    assert matches({"_id": ObjectId("0" * 24), "created_at": datetime(2026, 1, 1)}, query)
+    assert matches({"_id": ObjectId("f" * 24), "created_at": None}, query)
+    assert not matches({"_id": ObjectId("0" * 24), "created_at": None}, query)
+
+
+@pytest.mark.parametrize("direction", [1, -1])
+@pytest.mark.parametrize("limit", [1, 2, 3, 5])
+def test_pages_cover_every_document_once_in_order(direction, limit):
+    docs = make_docs()
+    expected = [doc["_id"] for doc in sorted(docs, key=lambda doc: mongo_sort_key(doc, "created_at"),
+                                              reverse=direction < 0)]
+    assert paginate(docs, "created_at", direction, limit) == expected
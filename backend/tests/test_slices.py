@@ -0,0 +1,123 @@
+# test_slices.py
+# Slice cache eviction and open volume bookkeeping of the slice server
+
+import time
+import threading
+import numpy as np
+import pytest
+import slices
+from slices import SliceServer, SliceError, OPEN_VOLUMES
+
+
+class FakeVolumeStore:
+    """Scan store holding small random volumes; "image" scans are not volumes"""
+
+    def __init__(self, decode_time=0.0):
+        self.decode_time = decode_time
+        self.opened = []
+
+    def __contains__(self, scan_hash):
+        return scan_hash.startswith(("volume", "image"))
+
+    def open_volume(self, scan_hash):
+        self.opened.append(scan_hash)
+        time.sleep(self.decode_time)
+        if scan_hash.startswith("image"):
+            return None
+        volume = np.random.default_rng(len(self.opened)).integers(-1000, 1000, (6, 16, 16)).astype(np.int16)
+        info = {"shape": list(volume.shape), "spacing": [2.0, 1.0, 1.0], "window": {"center": 40, "width": 400}}
+        return volume, info
+
+
+def wait_for_prefetch(server):
+    deadline = time.monotonic() + 5
+    while server.stats()["prefetch_pending"]:
+        assert time.monotonic() < deadline, "prefetch did not finish"
+        time.sleep(0.005)
+
+
+def test_cache_evicts_least_recently_used_slices_to_stay_under_its_size():
+    server = SliceServer(FakeVolumeStore(), prefetch_ahead=0)
+    slice_bytes = len(server.get_slice("volume-a", "axial", 0)[0])
+    server.cache_bytes = slice_bytes * 3
+
+    for index in range(1, 6):
+        server.get_slice("volume-a", "axial", index)
+        assert server.stats()["cache_bytes"] <= server.cache_bytes
+        # Keep slice 1 recently used
+        if index > 1:
+            assert server.get_slice("volume-a", "axial", 1)[1]
+    assert server.stats()["cache_bytes"] == sum(len(data) for data in server._cache.values())
+    assert not server.get_slice("volume-a", "axial", 2)[1]
+
+
+def test_slice_larger_than_the_cache_is_served_but_not_cached():
+    server = SliceServer(FakeVolumeStore(), cache_bytes=10, prefetch_ahead=0)
+    data, hit = server.get_slice("volume-a", "axial", 0)
+    assert data and not hit
+    assert server.stats()["cached_slices"] == 0
+    assert not server.get_slice("volume-a", "axial", 0)[1]
+
+
+def test_evicted_volume_drops_its_scroll_positions():
+    server = SliceServer(FakeVolumeStore(), prefetch_ahead=1)
+    hashes = [f"volume-{i}" for i in range(OPEN_VOLUMES + 1)]
+    for scan_hash in hashes:
+        server.get_slice(scan_hash, "axial", 2)
+        server.get_slice(scan_hash, "coronal", 3)
+    wait_for_prefetch(server)
+
+    assert list(server._volumes) == hashes[1:]
+    assert {scan_hash for scan_hash, _plane in server._last_index} == set(hashes[1:])
+    assert server.stats()["open_volumes"] == OPEN_VOLUMES
+
+
+def test_volume_is_decoded_once_under_concurrent_requests():
+    store = FakeVolumeStore(decode_time=0.1)
+    server = SliceServer(store, prefetch_ahead=0)
+    threads = [threading.Thread(target=server.get_slice, args=("volume-a", "axial", i)) for i in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert store.opened == ["volume-a"]
+    assert server._open_locks == {}
+
+
+def test_unknown_scans_and_single_images_leave_no_open_locks():
+    server = SliceServer(FakeVolumeStore(), prefetch_ahead=0)
+    assert server.get_slice("missing", "axial", 0) is None
+    assert server.volume_info("missing") is None
+    with pytest.raises(SliceError, match="not a volume"):
+        server.get_slice("image-a", "axial", 0)
+    assert server._open_locks == {}
+    assert server.stats()["open_volumes"] == 0
+
+
+def test_forget_drops_the_volume_and_its_cached_slices():
+    server = SliceServer(FakeVolumeStore(), prefetch_ahead=1)
+    server.get_slice("volume-a", "axial", 0)
+    server.get_slice("volume-b", "axial", 0)
+    wait_for_prefetch(server)
+
+    server.forget("volume-a")
+    assert list(server._volumes) == ["volume-b"]
+    assert all(key[0] == "volume-b" for key in server._cache)
+    assert all(scan_hash == "volume-b" for scan_hash, _plane in server._last_index)
+    assert server.stats()["cache_bytes"] == sum(len(data) for data in server._cache.values())
+    # The scan is opened again on its next request
+    assert not server.get_slice("volume-a", "axial", 0, prefetch=False)[1]
+
+
+@pytest.mark.parametrize("kwargs, message", [
+    ({"plane": "oblique"}, "plane"),
+    ({"index": 6}, "index"),
+    ({"size": slices.SLICE_MAX_SIZE + 1}, "size"),
+    ({"width": 0}, "width"),
+    ({"img_format": "gif"}, "format")
+])
+def test_invalid_slice_requests_raise_slice_error(kwargs, message):
+    server = SliceServer(FakeVolumeStore(), prefetch_ahead=0)
+    request = dict({"scan_hash": "volume-a", "plane": "axial", "index": 0}, **kwargs)
+    with pytest.raises(SliceError, match=message):
+        server.get_slice(**request)
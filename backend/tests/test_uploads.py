@@ -0,0 +1,127 @@
+# test_uploads.py
+# Offsets, resumption and conflicts of resumable chunked uploads
+
+import io
+import os
+import hashlib
+import pytest
+
+pytest.importorskip("sentence_transformers")  # uploads -> report_scan -> compare loads the embedding model
+
+import uploads
+from uploads import ChunkedUploads, UploadError, UploadConflictError, UploadNotFoundError
+
+PNG_BYTES = b'\x89PNG\r\n\x1a\n' + bytes(range(256)) * 40
+
+
+class FakeScanStore:
+    def __init__(self):
+        self.stored = {}
+
+    def put(self, path, filename, scan_hash=None, move=False):
+        with open(path, 'rb') as f:
+            self.stored[scan_hash] = f.read()
+        if move:
+            os.remove(path)
+        return scan_hash
+
+
+@pytest.fixture
+def sessions(tmp_path):
+    return ChunkedUploads(str(tmp_path))
+
+
+def send(sessions, upload_id, offset, data, length=None):
+    return sessions.write_chunk(upload_id, offset, io.BytesIO(data), len(data) if length is None else length)
+
+
+def test_chunks_in_order_finalize_into_the_scan_store(sessions):
+    upload = sessions.create("scan.png", len(PNG_BYTES))
+    for offset in range(0, len(PNG_BYTES), 4000):
+        upload = send(sessions, upload["upload_id"], offset, PNG_BYTES[offset:offset + 4000])
+    assert upload["offset"] == len(PNG_BYTES)
+
+    store = FakeScanStore()
+    result = sessions.finalize(upload["upload_id"], store)
+    assert result["status"] == "finalized"
+    assert result["scan_hash"] == hashlib.sha256(PNG_BYTES).hexdigest()
+    assert store.stored[result["scan_hash"]] == PNG_BYTES
+    # Finalizing again returns the same scan
+    assert sessions.finalize(upload["upload_id"], store)["scan_hash"] == result["scan_hash"]
+
+
+def test_chunk_at_wrong_offset_reports_the_offset_to_resume_from(sessions):
+    upload_id = sessions.create("scan.png", len(PNG_BYTES))["upload_id"]
+    send(sessions, upload_id, 0, PNG_BYTES[:1000])
+    for offset in (0, 500, 2000):
+        with pytest.raises(UploadConflictError) as conflict:
+            send(sessions, upload_id, offset, PNG_BYTES[offset:offset + 1000])
+        assert conflict.value.offset == 1000
+    assert sessions.get(upload_id)["offset"] == 1000
+
+
+def test_cut_short_chunk_advances_offset_and_can_be_resumed(sessions):
+    upload_id = sessions.create("scan.png", len(PNG_BYTES))["upload_id"]
+    with pytest.raises(UploadConflictError) as conflict:
+        send(sessions, upload_id, 0, PNG_BYTES[:3000], length=len(PNG_BYTES))
+    assert conflict.value.offset == 3000
+
+    send(sessions, upload_id, 3000, PNG_BYTES[3000:])
+    result = sessions.finalize(upload_id, FakeScanStore())
+    assert result["scan_hash"] == hashlib.sha256(PNG_BYTES).hexdigest()
+
+
+def test_another_process_continues_the_hash_from_disk(sessions):
+    upload_id = sessions.create("scan.png", len(PNG_BYTES))["upload_id"]
+    send(sessions, upload_id, 0, PNG_BYTES[:5000])
+
+    other_worker = ChunkedUploads(sessions.root)
+    send(other_worker, upload_id, 5000, PNG_BYTES[5000:])
+    assert other_worker.finalize(upload_id, FakeScanStore())["scan_hash"] == hashlib.sha256(PNG_BYTES).hexdigest()
+
+
+def test_chunk_past_declared_size_and_incomplete_finalize_are_rejected(sessions):
+    upload_id = sessions.create("scan.png", 100)["upload_id"]
+    with pytest.raises(UploadError):
+        send(sessions, upload_id, 0, PNG_BYTES[:101])
+    send(sessions, upload_id, 0, PNG_BYTES[:60])
+    with pytest.raises(UploadConflictError) as conflict:
+        sessions.finalize(upload_id, FakeScanStore())
+    assert conflict.value.offset == 60
+
+
+def test_checksum_and_format_are_verified_on_finalize(sessions):
+    upload_id = sessions.create("scan.png", len(PNG_BYTES), sha256="0" * 64)["upload_id"]
+    send(sessions, upload_id, 0, PNG_BYTES)
+    with pytest.raises(UploadError, match="SHA-256 mismatch"):
+        sessions.finalize(upload_id, FakeScanStore())
+
+    upload_id = sessions.create("scan.dcm", len(PNG_BYTES))["upload_id"]
+    send(sessions, upload_id, 0, PNG_BYTES)
+    with pytest.raises(UploadError, match="DICOM"):
+        sessions.finalize(upload_id, FakeScanStore())
+
+
+def test_finalized_upload_accepts_no_more_chunks(sessions):
+    upload_id = sessions.create("scan.png", len(PNG_BYTES))["upload_id"]
+    send(sessions, upload_id, 0, PNG_BYTES)
+    sessions.finalize(upload_id, FakeScanStore())
+    with pytest.raises(UploadConflictError, match="finalized"):
+        send(sessions, upload_id, len(PNG_BYTES), b'x')
+
+
+@pytest.mark.skipif(uploads.fcntl is None, reason="upload locking needs fcntl")
+def test_concurrent_writer_gets_a_conflict(sessions):
+    upload_id = sessions.create("scan.png", len(PNG_BYTES))["upload_id"]
+    with sessions._locked(upload_id):
+        with pytest.raises(UploadConflictError, match="Another request"):
+            send(sessions, upload_id, 0, PNG_BYTES[:100])
+    assert send(sessions, upload_id, 0, PNG_BYTES[:100])["offset"] == 100
+
+
+def test_aborted_and_unknown_uploads_are_not_found(sessions):
+    upload_id = sessions.create("scan.png", len(PNG_BYTES))["upload_id"]
+    sessions.abort(upload_id)
+    for unknown in (upload_id, "not-an-id"):
+        with pytest.raises(UploadNotFoundError):
+            sessions.get(unknown)
@@ -0,0 +1,303 @@
+# uploads.py
+# Resumable chunked uploads for scans larger than a single request
+#
+# Protocol: create an upload with the file name and total size, PUT the bytes in
+# order (each chunk at the offset the server reports), then finalize. Chunks are
+# streamed to disk and hashed as they arrive; finalize validates the file format
+# and moves it into the scan store. After a dropped connection, the client asks
+# for the current offset and continues from there.
+
+import os
+import json
+import time
+import uuid
+import gzip
+import struct
+import hashlib
+import logging
+import threading
+from contextlib import contextmanager
+from typing import Dict, Any, Optional, BinaryIO
+from report_scan import allowed_file, scan_format
+
+try:
+    import fcntl
+except ImportError:  # Windows: only the single-process dev server is supported there
+    fcntl = None
+
+# Configure logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Configuration
+UPLOAD_SESSION_DIR = os.environ.get(
+    'UPLOAD_SESSION_DIR',
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), 'upload_sessions')
+)
+UPLOAD_MAX_BYTES = int(os.environ.get('UPLOAD_MAX_BYTES', 4 * 1024 ** 3))  # 4GB per file
+# Largest chunk accepted per PUT; must stay below the app's MAX_CONTENT_LENGTH
+UPLOAD_CHUNK_BYTES = int(os.environ.get('UPLOAD_CHUNK_BYTES', 16 * 1024 * 1024))
+UPLOAD_SESSION_TTL = int(os.environ.get('UPLOAD_SESSION_TTL', 24 * 60 * 60))  # Seconds an idle upload is kept
+STREAM_BUFFER_BYTES = 1024 * 1024
+
+
+class UploadError(Exception):
+    """Invalid upload request (HTTP 400)"""
+
+
+class UploadNotFoundError(Exception):
+    """Unknown or expired upload (HTTP 404)"""
+
+
+class UploadConflictError(Exception):
+    """Chunk at the wrong offset, or another request is writing this upload (HTTP 409)"""
+
+    def __init__(self, message: str, offset: int):
+        super().__init__(message)
+        self.offset = offset
+
+
+def validate_scan_file(path: str, img_format: str):
+    """Check the file's magic bytes against its declared format; raises UploadError"""
+    with open(path, 'rb') as f:
+        head = f.read(352)
+
+    if img_format == 'dcm':
+        if head[128:132] != b'DICM':
+            raise UploadError("File is not a DICOM file (missing DICM preamble)")
+    elif img_format in ('nii', 'nii.gz'):
+        if img_format == 'nii.gz':
+            if head[:2] != b'\x1f\x8b':
+                raise UploadError("File is not gzip-compressed")
+            try:
+                with gzip.open(path, 'rb') as f:
+                    head = f.read(352)
+            except OSError as e:
+                raise UploadError(f"Corrupt gzip stream: {e}")
+        # sizeof_hdr is 348 for NIfTI-1 and 540 for NIfTI-2, in either byte order
+        if len(head) < 4 or not {struct.unpack('<i', head[:4])[0], struct.unpack('>i', head[:4])[0]} & {348, 540}:
+            raise UploadError("File is not a NIfTI volume (bad header size)")
+    elif img_format == 'png':
+        if not head.startswith(b'\x89PNG\r\n\x1a\n'):
+            raise UploadError("File is not a PNG image")
+    elif img_format in ('jpg', 'jpeg'):
+        if not head.startswith(b'\xff\xd8\xff'):
+            raise UploadError("File is not a JPEG image")
+
+
+class ChunkedUploads:
+    """
+    Upload sessions stored as <id>.json (state) and <id>.part (data) in one directory
+
+    State changes hold an exclusive file lock on the upload, so server workers can
+    receive chunks of the same upload. Each process keeps the running SHA-256 of the
+    uploads it is receiving; if a chunk lands in a process that did not see the
+    earlier ones, it catches up by hashing the bytes already on disk.
+    """
+
+    def __init__(self, root: str = UPLOAD_SESSION_DIR):
+        self.root = root
+        self._hashers: Dict[str, Any] = {}  # upload_id -> (hasher, bytes hashed)
+        self._hashers_lock = threading.Lock()
+        os.makedirs(root, exist_ok=True)
+
+    def _path(self, upload_id: str, suffix: str) -> str:
+        try:
+            uuid.UUID(hex=upload_id)
+        except ValueError:
+            raise UploadNotFoundError(f"Upload {upload_id} not found")
+        return os.path.join(self.root, f"{upload_id}{suffix}")
+
+    @contextmanager
+    def _locked(self, upload_id: str):
+        """Exclusive access to one upload; raises UploadConflictError if another request has it"""
+        state_path = self._path(upload_id, '.json')
+        if not os.path.exists(state_path):
+            raise UploadNotFoundError(f"Upload {upload_id} not found")
+        if fcntl is None:
+            yield self._read_state(upload_id)
+            return
+        with open(self._path(upload_id, '.lock'), 'w') as lock_file:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                state = self._read_state(upload_id)
+                raise UploadConflictError("Another request is writing to this upload", state["offset"])
+            try:
+                yield self._read_state(upload_id)
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _read_state(self, upload_id: str) -> Dict[str, Any]:
+        try:
+            with open(self._path(upload_id, '.json')) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            raise UploadNotFoundError(f"Upload {upload_id} not found")
+
+    def _write_state(self, state: Dict[str, Any]):
+        state["updated_at"] = time.time()
+        path = self._path(state["upload_id"], '.json')
+        with open(path + '.tmp', 'w') as f:
+            json.dump(state, f)
+        os.replace(path + '.tmp', path)
+
+    def _remove(self, upload_id: str, keep_state: bool = False):
+        suffixes = ['.part', '.lock'] if keep_state else ['.part', '.lock', '.json']
+        for suffix in suffixes:
+            try:
+                os.remove(self._path(upload_id, suffix))
+            except FileNotFoundError:
+                pass
+        with self._hashers_lock:
+            self._hashers.pop(upload_id, None)
+
+    def _hasher_at(self, upload_id: str, offset: int):
+        """The running hash of the first `offset` bytes, catching up from disk if needed"""
+        with self._hashers_lock:
+            hasher, hashed = self._hashers.get(upload_id, (None, 0))
+        if hasher is None or hashed > offset:
+            hasher, hashed = hashlib.sha256(), 0
+        if hashed < offset:
+            with open(self._path(upload_id, '.part'), 'rb') as f:
+                f.seek(hashed)
+                remaining = offset - hashed
+                while remaining:
+                    data = f.read(min(STREAM_BUFFER_BYTES, remaining))
+                    if not data:
+                        break
+                    hasher.update(data)
+                    remaining -= len(data)
+        return hasher
+
+    # Public API
+
+    def create(self, filename: str, size: int, sha256: Optional[str] = None,
+               metadata: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+        """Start an upload; sha256, if given, is checked on finalize"""
+        if not filename or not allowed_file(filename):
+            raise UploadError("File type not allowed. Supported types: png, jpg, jpeg, dcm, nii, nii.gz")
+        if size <= 0 or size > UPLOAD_MAX_BYTES:
+            raise UploadError(f"size must be between 1 and {UPLOAD_MAX_BYTES} bytes")
+        self.cleanup_expired()
+
+        upload_id = uuid.uuid4().hex
+        open(self._path(upload_id, '.part'), 'wb').close()
+        state = {
+            "upload_id": upload_id,
+            "filename": os.path.basename(filename),
+            "format": scan_format(filename),
+            "size": size,
+            "offset": 0,
+            "expected_sha256": sha256.lower() if sha256 else None,
+            "status": "uploading",
+            "scan_hash": None,
+            "metadata": metadata or {},
+            "created_at": time.time()
+        }
+        self._write_state(state)
+        return self.describe(state)
+
+    def get(self, upload_id: str) -> Dict[str, Any]:
+        return self.describe(self._read_state(upload_id))
+
+    def write_chunk(self, upload_id: str, offset: int, stream: BinaryIO, length: int) -> Dict[str, Any]:
+        """
+        Append `length` bytes read from stream at `offset`
+
+        The offset must equal the bytes received so far; otherwise UploadConflictError
+        carries the offset to resume from.
+        """
+        if length <= 0 or length > UPLOAD_CHUNK_BYTES:
+            raise UploadError(f"Chunk length must be between 1 and {UPLOAD_CHUNK_BYTES} bytes")
+
+        with self._locked(upload_id) as state:
+            if state["status"] != "uploading":
+                raise UploadConflictError(f"Upload is already {state['status']}", state["offset"])
+            if offset != state["offset"]:
+                raise UploadConflictError(f"Expected offset {state['offset']}, got {offset}", state["offset"])
+            if offset + length > state["size"]:
+                raise UploadError(f"Chunk ends at {offset + length}, past the declared size {state['size']}")
+
+            hasher = self._hasher_at(upload_id, offset)
+            written = 0
+            with open(self._path(upload_id, '.part'), 'r+b') as f:
+                f.seek(offset)
+                f.truncate()  # Drop any partial bytes from an interrupted chunk
+                while written < length:
+                    data = stream.read(min(STREAM_BUFFER_BYTES, length - written))
+                    if not data:
+                        break
+                    f.write(data)
+                    hasher.update(data)
+                    written += len(data)
+
+            # A short body (dropped connection) still advances the offset by what arrived
+            state["offset"] = offset + written
+            with self._hashers_lock:
+                self._hashers[upload_id] = (hasher, state["offset"])
+            self._write_state(state)
+            if written < length:
+                raise UploadConflictError(f"Chunk was cut short after {written} of {length} bytes", state["offset"])
+            return self.describe(state)
+
+    def finalize(self, upload_id: str, scan_store) -> Dict[str, Any]:
+        """Verify size, hash and format, then move the file into the scan store"""
+        with self._locked(upload_id) as state:
+            if state["status"] == "finalized":
+                return self.describe(state)
+            if state["offset"] != state["size"]:
+                raise UploadConflictError(
+                    f"Upload incomplete: {state['offset']} of {state['size']} bytes received", state["offset"]
+                )
+
+            part_path = self._path(upload_id, '.part')
+            scan_hash = self._hasher_at(upload_id, state["size"]).hexdigest()
+            if state["expected_sha256"] and scan_hash != state["expected_sha256"]:
+                raise UploadError(f"SHA-256 mismatch: expected {state['expected_sha256']}, received {scan_hash}")
+            validate_scan_file(part_path, state["format"])
+
+            scan_store.put(part_path, state["filename"], scan_hash=scan_hash, move=True)
+            state["status"] = "finalized"
+            state["scan_hash"] = scan_hash
+            self._write_state(state)
+            # Keep the state so the upload_id can still be resolved to its scan
+            self._remove(upload_id, keep_state=True)
+            logger.info(f"Finalized upload {upload_id} ({state['size']} bytes) as scan {scan_hash[:12]}")
+            return self.describe(state)
+
+    def abort(self, upload_id: str):
+        with self._locked(upload_id):
+            self._remove(upload_id)
+
+    def cleanup_expired(self, ttl: float = UPLOAD_SESSION_TTL) -> int:
+        """Delete uploads (finished or not) untouched for longer than ttl seconds"""
+        removed = 0
+        cutoff = time.time() - ttl
+        for name in os.listdir(self.root):
+            if not name.endswith('.json'):
+                continue
+            upload_id = name[:-len('.json')]
+            try:
+                if os.path.getmtime(os.path.join(self.root, name)) < cutoff:
+                    self._remove(upload_id)
+                    removed += 1
+            except (OSError, UploadNotFoundError):
+                continue
+        if removed:
+            logger.info(f"Removed {removed} expired uploads")
+        return removed
+
+    @staticmethod
+    def describe(state: Dict[str, Any]) -> Dict[str, Any]:
+        """Client-facing view of an upload"""
+        return {
+            "upload_id": state["upload_id"],
+            "filename": state["filename"],
+            "size": state["size"],
+            "offset": state["offset"],
+            "status": state["status"],
+            "scan_hash": state["scan_hash"],
+            "chunk_size": UPLOAD_CHUNK_BYTES,
+            "expires_at": state.get("updated_at", state["created_at"]) + UPLOAD_SESSION_TTL
+        }
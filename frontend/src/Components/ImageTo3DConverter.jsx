@@ -1,6 +1,9 @@
 import React, { useState, useEffect, useRef } from 'react';
 import * as THREE from 'three';
 import { OrbitControls } from 'three/examples/jsm/controls/OrbitControls';
+import { GLTFLoader } from 'three/examples/jsm/loaders/GLTFLoader';
+
+const API_BASE_URL = 'http://localhost:5000';
 
 const ImageTo3DConverter = () => {
   // State for settings
@@ -12,6 +15,7 @@ const ImageTo3DConverter = () => {
   const [autoRotate, setAutoRotate] = useState(false);
   const [isLoading, setIsLoading] = useState(false);
   const [imagePreview, setImagePreview] = useState(null);
+  const [isVolume, setIsVolume] = useState(false);
 
   // Refs for Three.js objects
   const containerRef = useRef(null);
@@ -20,7 +24,8 @@ const ImageTo3DConverter = () => {
   const rendererRef = useRef(null);
   const controlsRef = useRef(null);
   const object3DRef = useRef(null);
-  const imageDataRef = useRef(null);
+  const scanRef = useRef(null);
+  const gltfLoaderRef = useRef(new GLTFLoader());
   const imageTextureRef = useRef(null);
   const animationFrameRef = useRef(null);
 
@@ -103,262 +108,135 @@ const ImageTo3DConverter = () => {
     };
   }, [autoRotate, rotateSpeed]);
 
-  // Handle image upload
-  const handleImageUpload = (e) => {
+  // Handle image upload: store the scan on the server, which builds the 3D geometry
+  const handleImageUpload = async (e) => {
     const file = e.target.files[0];
     if (!file) return;
     
-    const reader = new FileReader();
-    reader.onload = (event) => {
-      // Set preview
-      setImagePreview(event.target.result);
+    setIsLoading(true);
+    try {
+      const formData = new FormData();
+      formData.append('scan', file);
+      const response = await fetch(`${API_BASE_URL}/api/scans`, {
+        method: 'POST',
+        body: formData
+      });
+      const scan = await response.json();
+      if (!response.ok) {
+        throw new Error(scan.error || 'Upload failed');
+      }
+      scanRef.current = scan;
       
-      // Create image element to get pixel data
-      const img = new Image();
-      img.onload = function() {
-        // Create a canvas to get image data
-        const canvas = document.createElement('canvas');
-        canvas.width = img.width;
-        canvas.height = img.height;
-        
-        const ctx = canvas.getContext('2d');
-        ctx.drawImage(img, 0, 0);
-        
-        // Get image data
-        imageDataRef.current = ctx.getImageData(0, 0, canvas.width, canvas.height);
-        
-        // Create texture
-        imageTextureRef.current = new THREE.CanvasTexture(canvas);
-      };
-      img.src = event.target.result;
-    };
-    reader.readAsDataURL(file);
+      // Previews come from the server, so DICOM and NIfTI scans can be shown too
+      setImagePreview(`${API_BASE_URL}/api/scans/${scan.scan_hash}/thumbnail`);
+      imageTextureRef.current = new THREE.TextureLoader().load(
+        `${API_BASE_URL}/api/scans/${scan.scan_hash}/preview`
+      );
+      setIsVolume(Boolean(scan.is_volume));
+    } catch (error) {
+      console.error('Error uploading scan:', error);
+      alert(`Could not upload scan: ${error.message}`);
+    } finally {
+      setIsLoading(false);
+    }
   };
 
-  // Function to calculate height values with optional smoothing
-  const calculateHeightValues = (imageData, width, height, smoothingLevel) => {
-    const imgWidth = imageData.width;
-    const imgHeight = imageData.height;
-    const heightValues = new Array(width * height);
-    
-    // Sample image pixels
-    for (let y = 0; y < height; y++) {
-      for (let x = 0; x < width; x++) {
-        const imgX = Math.floor((x / width) * imgWidth);
-        const imgY = Math.floor((y / height) * imgHeight);
-        
-        const pixelIndex = (imgY * imgWidth + imgX) * 4;
-        
-        // Get pixel values
-        const r = imageData.data[pixelIndex] / 255;
-        const g = imageData.data[pixelIndex + 1] / 255;
-        const b = imageData.data[pixelIndex + 2] / 255;
-        
-        // Calculate grayscale (brightness)
-        const brightness = 0.299 * r + 0.587 * g + 0.114 * b;
-        
-        heightValues[y * width + x] = brightness;
-      }
+  // Download one level of detail of the scan's mesh as binary glTF
+  const loadMeshGeometry = (scanHash, lod) => {
+    const params = new URLSearchParams({ lod: String(lod) });
+    if (isVolume) {
+      params.set('kind', 'isosurface');
+    } else {
+      params.set('kind', 'heightmap');
+      params.set('resolution', String(resolution));
+      params.set('smoothing', String(smoothing));
     }
-    
-    // Apply smoothing if needed
-    if (smoothingLevel > 0) {
-      for (let s = 0; s < smoothingLevel; s++) {
-        const tempValues = [...heightValues];
-        
-        for (let y = 0; y < height; y++) {
-          for (let x = 0; x < width; x++) {
-            const index = y * width + x;
-            
-            // Skip edges
-            if (x === 0 || x === width - 1 || y === 0 || y === height - 1) {
-              continue;
-            }
-            
-            // Average with neighbors
-            const avg = (
-              tempValues[(y - 1) * width + x] +  // top
-              tempValues[(y + 1) * width + x] +  // bottom
-              tempValues[y * width + (x - 1)] +  // left
-              tempValues[y * width + (x + 1)] +  // right
-              tempValues[index]                  // center
-            ) / 5;
-            
-            heightValues[index] = avg;
-          }
-        }
+    return new Promise((resolve, reject) => {
+      gltfLoaderRef.current.load(
+        `${API_BASE_URL}/api/scans/${scanHash}/mesh?${params}`,
+        (gltf) => {
+          let geometry = null;
+          gltf.scene.traverse((child) => {
+            if (child.isMesh && !geometry) geometry = child.geometry;
+          });
+          resolve(geometry);
+        },
+        undefined,
+        reject
+      );
+    });
+  };
+
+  // Build the scene object for the selected mode from server-built geometry
+  const createObject3D = (geometry) => {
+    if (mode === 'pointcloud') {
+      // Grey level from the height of each point (heights are brightness in [0, 1])
+      const positions = geometry.attributes.position;
+      const colors = new Float32Array(positions.count * 3);
+      for (let i = 0; i < positions.count; i++) {
+        const brightness = isVolume ? 1 : positions.getZ(i);
+        colors[i * 3] = colors[i * 3 + 1] = colors[i * 3 + 2] = brightness;
       }
+      geometry.setAttribute('color', new THREE.BufferAttribute(colors, 3));
+      return new THREE.Points(geometry, new THREE.PointsMaterial({ size: 0.5, vertexColors: true }));
     }
-    
-    return heightValues;
+    if (mode === 'mesh') {
+      return new THREE.Mesh(geometry, new THREE.MeshBasicMaterial({ wireframe: true, color: 0x00ffff }));
+    }
+    return new THREE.Mesh(geometry, new THREE.MeshPhongMaterial({
+      map: isVolume ? null : imageTextureRef.current,
+      color: isVolume ? 0xe8d8c8 : 0xffffff,
+      side: THREE.DoubleSide
+    }));
   };
 
-  // Generate 3D visualization
-  const generateFrom2DImage = () => {
-    if (!imageDataRef.current || !sceneRef.current) {
-      return;
-    }
-    
-    setIsLoading(true);
-    
-    // Remove previous 3D object
+  const showObject3D = (object3D) => {
     if (object3DRef.current) {
       sceneRef.current.remove(object3DRef.current);
-      object3DRef.current = null;
+      object3DRef.current.geometry.dispose();
     }
+    if (!isVolume) {
+      // Rotate to face camera (X-rotation of -90 degrees); heights are scaled here
+      object3D.rotation.x = -Math.PI / 2;
+      object3D.scale.z = heightScale;
+    }
+    object3DRef.current = object3D;
+    sceneRef.current.add(object3D);
     
-    // Get image data
-    const imageData = imageDataRef.current;
-    const width = imageData.width;
-    const height = imageData.height;
-    
-    // Calculate dimensions based on resolution
-    const segmentsX = Math.floor(width * resolution);
-    const segmentsY = Math.floor(height * resolution);
-    
-    // Calculate scales to center the object
-    const scaleX = width / Math.max(width, height);
-    const scaleY = height / Math.max(width, height);
+    // Center camera
+    if (controlsRef.current) {
+      controlsRef.current.target.set(0, 0, 0);
+      controlsRef.current.update();
+    }
+  };
+
+  // Generate 3D visualization: show the coarsest level of detail first, then the finest
+  const generateFrom2DImage = async () => {
+    if (!scanRef.current || !sceneRef.current) {
+      return;
+    }
     
-    // Generate different visualizations based on mode
-    setTimeout(() => {
-      if (mode === 'heightmap') {
-        // Create a plane geometry
-        const geometry = new THREE.PlaneGeometry(
-          100 * scaleX, 
-          100 * scaleY, 
-          segmentsX, 
-          segmentsY
-        );
-        
-        // Sample pixel values and adjust vertices
-        const positionAttribute = geometry.attributes.position;
-        
-        // Calculate height values with smoothing if needed
-        const heightValues = calculateHeightValues(imageData, segmentsX + 1, segmentsY + 1, smoothing);
-        
-        // Apply height values to vertices
-        for (let i = 0; i < positionAttribute.count; i++) {
-          const x = i % (segmentsX + 1);
-          const y = Math.floor(i / (segmentsX + 1));
-          
-          const z = heightValues[y * (segmentsX + 1) + x] * heightScale;
-          positionAttribute.setZ(i, z);
-        }
-        
-        // Update the geometry
-        geometry.computeVertexNormals();
-        
-        // Create material
-        const material = new THREE.MeshPhongMaterial({
-          map: imageTextureRef.current,
-          wireframe: false,
-          side: THREE.DoubleSide
-        });
-        
-        // Create mesh
-        object3DRef.current = new THREE.Mesh(geometry, material);
-        
-      } else if (mode === 'pointcloud') {
-        // Create point cloud geometry
-        const geometry = new THREE.BufferGeometry();
-        const positions = [];
-        const colors = [];
-        
-        // Sample at reduced resolution
-        const stepX = Math.ceil(width / segmentsX);
-        const stepY = Math.ceil(height / segmentsY);
-        
-        for (let y = 0; y < height; y += stepY) {
-          for (let x = 0; x < width; x += stepX) {
-            const pixelIndex = (y * width + x) * 4;
-            
-            // Get pixel values
-            const r = imageData.data[pixelIndex] / 255;
-            const g = imageData.data[pixelIndex + 1] / 255;
-            const b = imageData.data[pixelIndex + 2] / 255;
-            
-            // Calculate grayscale (brightness)
-            const brightness = 0.299 * r + 0.587 * g + 0.114 * b;
-            
-            // Calculate position
-            const posX = (x / width - 0.5) * 100 * scaleX;
-            const posY = (0.5 - y / height) * 100 * scaleY;
-            const posZ = brightness * heightScale;
-            
-            // Add position and color
-            positions.push(posX, posY, posZ);
-            colors.push(r, g, b);
-          }
-        }
-        
-        // Set attributes
-        geometry.setAttribute('position', new THREE.Float32BufferAttribute(positions, 3));
-        geometry.setAttribute('color', new THREE.Float32BufferAttribute(colors, 3));
-        
-        // Create material
-        const material = new THREE.PointsMaterial({
-          size: 0.5,
-          vertexColors: true
-        });
-        
-        // Create point cloud
-        object3DRef.current = new THREE.Points(geometry, material);
-        
-      } else if (mode === 'mesh') {
-        // Create a plane geometry
-        const geometry = new THREE.PlaneGeometry(
-          100 * scaleX, 
-          100 * scaleY, 
-          segmentsX, 
-          segmentsY
-        );
-        
-        // Sample pixel values and adjust vertices
-        const positionAttribute = geometry.attributes.position;
-        
-        // Calculate height values with smoothing if needed
-        const heightValues = calculateHeightValues(imageData, segmentsX + 1, segmentsY + 1, smoothing);
-        
-        // Apply height values to vertices
-        for (let i = 0; i < positionAttribute.count; i++) {
-          const x = i % (segmentsX + 1);
-          const y = Math.floor(i / (segmentsX + 1));
-          
-          const z = heightValues[y * (segmentsX + 1) + x] * heightScale;
-          positionAttribute.setZ(i, z);
-        }
-        
-        // Update the geometry
-        geometry.computeVertexNormals();
-        
-        // Create material for wireframe
-        const material = new THREE.MeshBasicMaterial({
-          wireframe: true,
-          color: 0x00ffff
-        });
-        
-        // Create mesh
-        object3DRef.current = new THREE.Mesh(geometry, material);
-      }
-      
-      // Add to scene
-      if (object3DRef.current && sceneRef.current) {
-        // Rotate to face camera (X-rotation of -90 degrees)
-        object3DRef.current.rotation.x = -Math.PI / 2;
-        sceneRef.current.add(object3DRef.current);
-        
-        // Center camera
-        if (controlsRef.current) {
-          controlsRef.current.target.set(0, 0, 0);
-          controlsRef.current.update();
-        }
-      }
-      
+    setIsLoading(true);
+    const scanHash = scanRef.current.scan_hash;
+    try {
+      showObject3D(createObject3D(await loadMeshGeometry(scanHash, 2)));
+      setIsLoading(false);
+      showObject3D(createObject3D(await loadMeshGeometry(scanHash, 0)));
+    } catch (error) {
+      console.error('Error loading 3D model:', error);
+      alert('Could not build a 3D model for this scan');
+    } finally {
       setIsLoading(false);
-    }, 100);
+    }
   };
 
+  // The height scale only stretches the model, so no new geometry is needed
+  useEffect(() => {
+    if (object3DRef.current && !isVolume) {
+      object3DRef.current.scale.z = heightScale;
+    }
+  }, [heightScale, isVolume]);
+
   // Take screenshot
   const takeScreenshot = () => {
     if (rendererRef.current && sceneRef.current && cameraRef.current) {
@@ -406,7 +284,7 @@ const ImageTo3DConverter = () => {
         <div>
           <input 
             type="file" 
-            accept="image/*" 
+            accept="image/*,.dcm,.nii,.nii.gz" 
             onChange={handleImageUpload} 
           />
           {imagePreview && (
@@ -484,7 +362,7 @@ const ImageTo3DConverter = () => {
         
         <button 
           onClick={generateFrom2DImage}
-          disabled={!imageDataRef.current || isLoading}
+          disabled={!scanRef.current || isLoading}
           style={{ padding: '8px', cursor: 'pointer' }}
         >
           {isLoading ? 'Processing...' : 'Generate 3D'}
@@ -319,7 +319,7 @@ const PatientHistory = () => {
                                 </span>
                               </div>
                               <span className="text-xs text-gray-500">
-                                {report.analysis_result?.scan_type || 'Unknown Scan'}
+                                {report.scan_type || report.analysis_result?.scan_type || 'Unknown Scan'}
                               </span>
                             </div>
                           </div>